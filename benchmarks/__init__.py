@@ -0,0 +1,4 @@
+"""Benchmarks for the experiments, with the synthetic data they and the tests run on.
+
+Run a benchmark from the repository root, e.g. python -m benchmarks.benchmark_scrub
+"""
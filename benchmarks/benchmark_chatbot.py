@@ -0,0 +1,123 @@
+"""Benchmark the row-by-row `iloc` message grouping and pairing that `chatbot.py` used
+to do against the vectorized `group_consecutive_messages` and `pair_turns`, on a
+synthetic chat log.
+
+The row-by-row version takes minutes on a million messages, so it only runs on the first
+`legacy_messages` rows, where both outputs are checked to be identical.
+
+Run with: python -m benchmarks.benchmark_chatbot
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from llm_experiments.chatbot import CONTEXT, group_consecutive_messages, pair_turns
+
+
+def make_chat_log(num_messages, seed=0):
+    """Messages between "Sender" and "Recipient", in runs of 1-4 from one person."""
+    rng = np.random.default_rng(seed)
+    run_lengths = rng.integers(1, 5, num_messages // 2 + 1)
+    senders = np.repeat(
+        np.resize(np.array(["Sender", "Recipient"], dtype=object), len(run_lengths)),
+        run_lengths,
+    )[:num_messages]
+    messages = np.array([f"message {i}" for i in range(num_messages)], dtype=object)
+    messages[rng.random(num_messages) < 0.01] = np.nan
+    return pd.DataFrame(
+        {
+            "datetime": (
+                pd.Timestamp("2023-01-01")
+                + pd.to_timedelta(np.arange(num_messages) * 30, unit="s")
+            ).strftime("%Y-%m-%d %H:%M:%S"),
+            "sender": senders,
+            "message": messages,
+        }
+    )
+
+
+def pair_messages_row_by_row(df, sender_name):
+    """The original loops from `chatbot.py`."""
+    new_rows = []
+    current_message = str(
+        df.iloc[0]["message"] if df.iloc[0]["message"] is not np.nan else ""
+    )
+    current_sender = df.iloc[0]["sender"]
+    for i in range(1, len(df)):
+        if df.iloc[i]["sender"] == current_sender:
+            current_message += " " + str(
+                df.iloc[i]["message"] if df.iloc[i]["message"] is not np.nan else ""
+            )
+        else:
+            new_rows.append(
+                {
+                    "datetime": df.iloc[i - 1]["datetime"],
+                    "sender": current_sender,
+                    "message": current_message,
+                }
+            )
+            current_message = str(
+                df.iloc[i]["message"] if df.iloc[i]["message"] is not np.nan else ""
+            )
+            current_sender = df.iloc[i]["sender"]
+    new_rows.append(
+        {
+            "datetime": df.iloc[-1]["datetime"],
+            "sender": current_sender,
+            "message": current_message,
+        }
+    )
+    grouped_df = pd.DataFrame(new_rows)
+
+    data = []
+    for i in range(0, len(grouped_df) - 1):
+        if (
+            grouped_df.iloc[i]["sender"] == sender_name
+            and grouped_df.iloc[i + 1]["sender"] != sender_name
+        ):
+            data.append(
+                {
+                    "input_text": grouped_df.iloc[i]["message"] + CONTEXT,
+                    "output_text": grouped_df.iloc[i + 1]["message"],
+                }
+            )
+    return grouped_df, data
+
+
+def pair_messages_vectorized(df, sender_name):
+    grouped_df = group_consecutive_messages(df)
+    return grouped_df, pair_turns(grouped_df, sender_name)
+
+
+def main(num_messages=1000000, legacy_messages=20000):
+    df = make_chat_log(num_messages)
+
+    df_legacy = df.head(legacy_messages)
+    start = time.perf_counter()
+    grouped_legacy, data_legacy = pair_messages_row_by_row(df_legacy, "Sender")
+    legacy_seconds = time.perf_counter() - start
+    grouped_df, data = pair_messages_vectorized(df_legacy, "Sender")
+    pd.testing.assert_frame_equal(grouped_df, grouped_legacy)
+    assert data == data_legacy
+
+    start = time.perf_counter()
+    grouped_df, data = pair_messages_vectorized(df, "Sender")
+    vectorized_seconds = time.perf_counter() - start
+
+    logger.info(
+        f"row by row: {legacy_messages} messages in {legacy_seconds:.2f}s "
+        f"(~{legacy_seconds * num_messages / legacy_messages:.0f}s "
+        f"for {num_messages}), outputs identical"
+    )
+    logger.info(
+        f"vectorized: {num_messages} messages in {vectorized_seconds:.2f}s, "
+        f"{len(grouped_df)} runs, {len(data)} pairs"
+    )
+    return legacy_seconds, vectorized_seconds
+
+
+if __name__ == "__main__":
+    main()
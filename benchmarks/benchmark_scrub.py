@@ -0,0 +1,153 @@
+"""Benchmark the original `applymap` scrub, which runs scrubadub and three regexes over
+every cell, against `scrub_df`, which skips cells without candidate characters, uses one
+combined regex and can spread the rows over a process pool. Reports rows per second and
+checks that the scrubbed text is identical, then `scrub_df` with a `ScrubCache` on disk,
+cold and then warm as in a second run over the same export, and the peak memory of
+streaming gzipped exports of growing size through `scrub_csv`.
+
+Run with: python -m benchmarks.benchmark_scrub
+"""
+
+import os
+import re
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scrubadub
+from loguru import logger
+
+from llm_experiments.scrub import (
+    ScrubCache,
+    TextScrubber,
+    email_pattern,
+    phone_pattern,
+    postcode_pattern,
+    scrub_csv,
+    scrub_df,
+)
+
+MESSAGE_TEMPLATES = [
+    "Hi, I'd like to change my collection date please",
+    "Thanks for getting back to me so quickly",
+    "Can you call me on 07700 900{i:03d}?",
+    "My email is customer{i}@example.com",
+    "The car is at {i} High Street, SW1A 1AA",
+    "Please see https://www.example.com/orders/{i}",
+    "Order {i} still hasn't been picked up",
+    "No worries, have a lovely day",
+    "Our team is available 9am to 5pm, Monday to Friday",
+]
+
+
+def make_messages(num_rows, seed=0):
+    """Contact centre style messages, about half of them without any digits or PII."""
+    rng = np.random.default_rng(seed)
+    templates = rng.integers(0, len(MESSAGE_TEMPLATES), num_rows)
+    return pd.DataFrame(
+        {
+            "id": np.arange(num_rows),
+            "sender": np.where(np.arange(num_rows) % 2, "Agent", "Customer"),
+            "content": [
+                MESSAGE_TEMPLATES[template].format(i=i)
+                for i, template in enumerate(templates)
+            ],
+        }
+    )
+
+
+def scrub_df_applymap(data):
+    """The original implementation, scrubbing every cell of every column."""
+    scrubber = scrubadub.Scrubber()
+
+    def clean_text(text):
+        text = str(text)
+        text = scrubber.clean(text)
+        text = re.sub(email_pattern, "[email]", text)
+        text = re.sub(phone_pattern, "[phone]", text)
+        text = re.sub(postcode_pattern, "[postcode]", text)
+        return text
+
+    return data.applymap(clean_text)
+
+
+def _rows_per_second(scrub, df):
+    start = time.perf_counter()
+    scrubbed = scrub(df)
+    return scrubbed, len(df) / (time.perf_counter() - start)
+
+
+def streaming_peak_memory(num_rows, rows_per_chunk=5000):
+    """Peak traced memory (bytes) of `scrub_csv` on a gzipped `num_rows` row export."""
+    with tempfile.TemporaryDirectory() as folder:
+        input_path = Path(folder) / "messages.csv.gz"
+        make_messages(num_rows).to_csv(input_path, index=False)
+        tracemalloc.start()
+        scrub_csv(
+            input_path,
+            Path(folder) / "scrubbed.csv.gz",
+            columns=["content"],
+            rows_per_chunk=rows_per_chunk,
+        )
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return peak
+
+
+def main(num_rows=20000):
+    df = make_messages(num_rows)
+    text_columns = ["sender", "content"]
+
+    legacy, legacy_rate = _rows_per_second(
+        lambda data: scrub_df_applymap(data[text_columns]), df
+    )
+    single, single_rate = _rows_per_second(
+        lambda data: scrub_df(data, columns=text_columns), df
+    )
+    pooled, pooled_rate = _rows_per_second(
+        lambda data: scrub_df(data, columns=text_columns, max_workers=os.cpu_count()),
+        df,
+    )
+
+    pd.testing.assert_frame_equal(single[text_columns], legacy)
+    pd.testing.assert_frame_equal(pooled, single)
+    logger.info(f"applymap: {legacy_rate:,.0f} rows/s")
+    logger.info(
+        f"scrub_df, 1 process: {single_rate:,.0f} rows/s "
+        f"({single_rate / legacy_rate:.1f}x)"
+    )
+    logger.info(
+        f"scrub_df, {os.cpu_count()} processes: {pooled_rate:,.0f} rows/s "
+        f"({pooled_rate / legacy_rate:.1f}x), outputs identical"
+    )
+
+    with tempfile.TemporaryDirectory() as folder:
+        for run in ["cold", "warm"]:
+            text_scrubber = TextScrubber(
+                cache=ScrubCache(Path(folder) / "scrub_cache.sqlite3")
+            )
+            cached, cached_rate = _rows_per_second(
+                lambda data: scrub_df(
+                    data, columns=text_columns, text_scrubber=text_scrubber
+                ),
+                df,
+            )
+            pd.testing.assert_frame_equal(cached, single)
+            logger.info(
+                f"scrub_df, {run} cache: {cached_rate:,.0f} rows/s "
+                f"({cached_rate / legacy_rate:.1f}x), "
+                f"{text_scrubber.hit_rate:.1%} of cells with candidates reused"
+            )
+            text_scrubber.cache.close()
+
+    peaks = {rows: streaming_peak_memory(rows) for rows in [num_rows, num_rows * 4]}
+    for rows, peak in peaks.items():
+        logger.info(f"scrub_csv: {rows} rows streamed with {peak / 2**20:.1f} MiB peak")
+    return legacy_rate, single_rate, pooled_rate, peaks
+
+
+if __name__ == "__main__":
+    main()
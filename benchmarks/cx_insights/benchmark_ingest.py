@@ -0,0 +1,69 @@
+"""Benchmark serial vs process-pool parsing of a folder of Talkdesk transcript zips.
+
+Run with: python -m benchmarks.cx_insights.benchmark_ingest
+"""
+
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+import pandas as pd
+from loguru import logger
+
+from benchmarks.cx_insights.benchmark_transform import make_synthetic_calls
+from llm_experiments.cx_insights.process_talkdesk_conversations import (
+    list_zip_files,
+    read_transcripts,
+    read_transcripts_parallel,
+)
+
+
+def write_synthetic_zips(
+    zip_files_dir, num_zips=8, files_per_zip=4, interactions_per_file=500
+):
+    """Write `num_zips` zips of `files_per_zip` transcript CSVs into `zip_files_dir`."""
+    zip_files_dir = Path(zip_files_dir)
+    for zip_number in range(num_zips):
+        with zipfile.ZipFile(
+            zip_files_dir / f"transcripts_{zip_number:03d}.zip",
+            "w",
+            compression=zipfile.ZIP_DEFLATED,
+        ) as zip_ref:
+            for file_number in range(files_per_zip):
+                df = make_synthetic_calls(
+                    interactions_per_file, seed=zip_number * files_per_zip + file_number
+                ).drop(columns="filename")
+                df["_merge"] = "both"
+                zip_ref.writestr(
+                    f"transcripts_{zip_number:03d}_{file_number}.csv",
+                    df.to_csv(index=False),
+                )
+
+
+def main(num_zips=8, files_per_zip=4, interactions_per_file=500, max_workers=None):
+    with tempfile.TemporaryDirectory() as zip_files_dir:
+        write_synthetic_zips(
+            zip_files_dir, num_zips, files_per_zip, interactions_per_file
+        )
+        zip_file_paths = list_zip_files(zip_files_dir)
+
+        start = time.perf_counter()
+        df_serial = read_transcripts(zip_file_paths)
+        serial_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        df_parallel = read_transcripts_parallel(zip_file_paths, max_workers)
+        parallel_seconds = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(df_serial, df_parallel)
+    logger.info(
+        f"{len(df_serial)} rows in {num_zips * files_per_zip} files: "
+        f"serial {serial_seconds:.2f}s, parallel {parallel_seconds:.2f}s "
+        f"({serial_seconds / parallel_seconds:.1f}x speedup), frames identical"
+    )
+    return serial_seconds, parallel_seconds
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Compare per-conversation JSON files with NDJSON shards (plain and gzipped) on a
+synthetic export: number of files, bytes on disk and wall-clock time to write and to
+list/read back.
+
+Run with: python -m benchmarks.cx_insights.benchmark_output
+"""
+
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from loguru import logger
+
+from benchmarks.cx_insights.benchmark_transform import make_synthetic_calls
+from llm_experiments.cx_insights.convert_to_ccai import ConversationDataTransformer
+from llm_experiments.cx_insights.ndjson_shards import iter_shard_conversations
+
+
+def _write(transformer, conversations, output_format, compress=False):
+    start = time.perf_counter()
+    if output_format == "json":
+        paths = [
+            transformer.save_to_file(interaction_id, conversation_data)
+            for interaction_id, conversation_data in conversations
+        ]
+    else:
+        paths = transformer.save_to_shards(conversations, compress=compress)
+    return paths, time.perf_counter() - start
+
+
+def _read_back(output_folder, output_format):
+    start = time.perf_counter()
+    if output_format == "json":
+        count = sum(
+            1 for path in output_folder.glob("*.json") if json.loads(path.read_text())
+        )
+    else:
+        paths = sorted(output_folder.glob("*.ndjson*"))
+        count = sum(1 for _ in iter_shard_conversations(paths))
+    return count, time.perf_counter() - start
+
+
+def main(num_interactions=20000, messages_per_interaction=20):
+    df_calls = make_synthetic_calls(num_interactions, messages_per_interaction)
+    for output_format, compress in [
+        ("json", False),
+        ("ndjson", False),
+        ("ndjson", True),
+    ]:
+        with tempfile.TemporaryDirectory() as output_folder:
+            output_folder = Path(output_folder)
+            transformer = ConversationDataTransformer(
+                "all_calls.csv", output_folder, None, None, bucket=object()
+            )
+            conversations = list(transformer.transform_all_data(df_calls))
+
+            paths, write_seconds = _write(
+                transformer, conversations, output_format, compress
+            )
+            count, read_seconds = _read_back(output_folder, output_format)
+            total_bytes = sum(Path(path).stat().st_size for path in paths)
+
+            label = f"{output_format}{' (gzip)' if compress else ''}"
+            logger.info(
+                f"{label:14} files={len(paths):6d} bytes={total_bytes:12d} "
+                f"write={write_seconds:.2f}s read_back={read_seconds:.2f}s "
+                f"conversations={count}"
+            )
+
+
+if __name__ == "__main__":
+    main()
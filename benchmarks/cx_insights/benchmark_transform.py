@@ -0,0 +1,86 @@
+"""Benchmark the per-row `transform_data` path against the columnar `transform_all_data`
+path on a synthetic Talkdesk-style export, checking both produce identical CCAI JSON.
+
+Run with: python -m benchmarks.cx_insights.benchmark_transform
+"""
+
+import json
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from llm_experiments.cx_insights.convert_to_ccai import ConversationDataTransformer
+
+
+def make_synthetic_calls(num_interactions, messages_per_interaction=20, seed=0):
+    """DataFrame shaped like `all_calls.csv`, with interactions' rows interleaved."""
+    rng = np.random.default_rng(seed)
+    num_rows = num_interactions * messages_per_interaction
+    interaction_numbers = np.repeat(
+        np.arange(num_interactions), messages_per_interaction
+    )
+    is_customer = rng.random(num_rows) < 0.5
+    agent_names = np.array([f"Agent {i}" for i in range(50)], dtype=object)
+    start_times = pd.Timestamp("2023-11-01 09:00:00") + pd.to_timedelta(
+        rng.integers(0, 7 * 24 * 3600, num_interactions), unit="s"
+    )
+    df = pd.DataFrame(
+        {
+            "interaction_id": [f"int-{i:08d}" for i in interaction_numbers],
+            "enquiry_id": (interaction_numbers + 1000000).astype(float),
+            "message_text": [f"message {i}" for i in range(num_rows)],
+            "message_participant": np.where(is_customer, "CUSTOMER", "AGENT"),
+            "message_agent_name": np.where(
+                is_customer, np.nan, agent_names[rng.integers(0, 50, num_rows)]
+            ),
+            "interaction_started": start_times.strftime("%Y-%m-%d %H:%M:%S")[
+                interaction_numbers
+            ],
+            "filename": [f"transcripts_{i % 7}.csv" for i in interaction_numbers],
+        }
+    )
+    # interleave interactions like a real multi-file export
+    return df.sample(frac=1, random_state=seed, ignore_index=True)
+
+
+def run_per_row(transformer, df_calls):
+    return [
+        (interaction_id, transformer.transform_data(group, interaction_id))
+        for interaction_id, group in df_calls.groupby("interaction_id")
+    ]
+
+
+def run_vectorized(transformer, df_calls):
+    return list(transformer.transform_all_data(df_calls))
+
+
+def main(num_interactions=2000, messages_per_interaction=20):
+    df_calls = make_synthetic_calls(num_interactions, messages_per_interaction)
+    with tempfile.TemporaryDirectory() as output_folder:
+        # transform only, the bucket is never touched
+        transformer = ConversationDataTransformer(
+            "all_calls.csv", output_folder, None, None, bucket=object()
+        )
+
+        start = time.perf_counter()
+        per_row = run_per_row(transformer, df_calls)
+        per_row_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vectorized = run_vectorized(transformer, df_calls)
+        vectorized_seconds = time.perf_counter() - start
+
+    assert json.dumps(per_row) == json.dumps(vectorized), "outputs differ"
+    logger.info(
+        f"{len(df_calls)} rows / {num_interactions} interactions: "
+        f"per-row {per_row_seconds:.2f}s, vectorized {vectorized_seconds:.2f}s "
+        f"({per_row_seconds / vectorized_seconds:.1f}x speedup), outputs identical"
+    )
+    return per_row_seconds, vectorized_seconds
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Benchmark one-message-per-request classification against packed multi-message
+prompts, on a fake model with a fixed per-request latency, checking both give the same
+classifications.
+
+Run with: python -m benchmarks.cx_support.benchmark_classify
+"""
+
+import re
+import threading
+import time
+
+from loguru import logger
+
+from llm_experiments.cx_support.classify_data_rows import (
+    CHARS_PER_TOKEN,
+    CLASSIFICATIONS,
+    PROMPT_PREAMBLE,
+    PROMPT_SUFFIX,
+    TextGenerator,
+    classify_batched,
+    make_prompt,
+)
+
+BATCH_MESSAGE_PATTERN = re.compile(
+    r"####\n\n    (\d+): (.*?)\n\n    (?=####)", re.DOTALL
+)
+
+
+def fake_classification(message):
+    return CLASSIFICATIONS[sum(map(ord, message)) % len(CLASSIFICATIONS)]
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeClassifierModel:
+    """Answers single and numbered batch prompts, sleeping `latency_seconds` per request
+    plus `seconds_per_token` per prompt token. Counts requests and prompt characters."""
+
+    def __init__(self, latency_seconds=0.05, seconds_per_token=0.0):
+        self.latency_seconds = latency_seconds
+        self.seconds_per_token = seconds_per_token
+        self.requests = 0
+        self.prompt_chars = 0
+        self._lock = threading.Lock()
+
+    def predict(self, prompt, **parameters):
+        with self._lock:
+            self.requests += 1
+            self.prompt_chars += len(prompt)
+        time.sleep(
+            self.latency_seconds
+            + len(prompt) / CHARS_PER_TOKEN * self.seconds_per_token
+        )
+        if prompt.startswith(PROMPT_PREAMBLE):
+            message = prompt[len(PROMPT_PREAMBLE) : -len(PROMPT_SUFFIX)]
+            return FakeResponse(fake_classification(message))
+        return FakeResponse(
+            "\n".join(
+                f"{number}: {fake_classification(message)}"
+                for number, message in BATCH_MESSAGE_PATTERN.findall(prompt)
+            )
+        )
+
+
+def make_messages(num_messages):
+    return [
+        f"Customer {i} asked about the collection of vehicle {i % 97}"
+        for i in range(num_messages)
+    ]
+
+
+def _run(classify, model):
+    start = time.perf_counter()
+    classifications = classify()
+    return (
+        classifications,
+        time.perf_counter() - start,
+        model.requests,
+        model.prompt_chars,
+    )
+
+
+def main(num_messages=400, messages_per_prompt=10, max_workers=8, latency_seconds=0.05):
+    messages = make_messages(num_messages)
+    results = {}
+    for mode in ["single", "batched"]:
+        model = FakeClassifierModel(latency_seconds)
+        generator = TextGenerator(
+            "project",
+            "location",
+            "fake",
+            rate_limit=1000,
+            model=model,
+            max_workers=max_workers,
+        )
+        if mode == "single":
+
+            def classify():
+                return generator.generate_text_batch(
+                    [make_prompt(message) for message in messages]
+                )
+
+        else:
+
+            def classify():
+                return classify_batched(generator, messages, messages_per_prompt)
+
+        results[mode] = _run(classify, model)
+
+    assert results["single"][0] == results["batched"][0]
+    for mode, (_, seconds, requests, prompt_chars) in results.items():
+        logger.info(
+            f"{mode}: {num_messages} messages in {seconds:.2f}s, {requests} requests, "
+            f"~{prompt_chars // CHARS_PER_TOKEN} prompt tokens"
+        )
+    single, batched = results["single"], results["batched"]
+    logger.info(
+        f"{messages_per_prompt} messages per prompt: "
+        f"{single[1] / batched[1]:.1f}x faster, "
+        f"{single[3] / batched[3]:.1f}x fewer prompt tokens, classifications identical"
+    )
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Benchmark the per-conversation `groupby.apply(is_consecutive)` check against the
+vectorized `clean_conversation_ids`, and the joined-string `convert_to_jsonl` against
+the streaming `iter_training_records`, on synthetic Zendesk-style messages.
+
+Run with: python -m benchmarks.cx_support.benchmark_data_engineering
+"""
+
+import json
+import re
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from llm_experiments.cx_support.data_engineering import (
+    clean_conversation_ids,
+    is_consecutive,
+    iter_training_records,
+    write_jsonl,
+)
+
+
+def make_synthetic_messages(
+    num_rows, messages_per_conversation=10, broken_share=0.05, seed=0
+):
+    """Messages of `num_rows // messages_per_conversation` conversations, with
+    consecutive `id`s except in about `broken_share` of conversations, where two
+    neighbouring ids are swapped.
+    """
+    rng = np.random.default_rng(seed)
+    num_conversations = max(num_rows // messages_per_conversation, 1)
+    conversation_ids = np.repeat(
+        np.arange(num_conversations) + 1000, messages_per_conversation
+    )[:num_rows]
+    ids = np.arange(len(conversation_ids)) + 1
+
+    # swap the first two messages of some conversations
+    is_broken = rng.random(num_conversations) < broken_share
+    starts = np.flatnonzero(is_broken) * messages_per_conversation
+    starts = starts[starts + 1 < len(ids)]
+    ids[starts], ids[starts + 1] = ids[starts + 1], ids[starts].copy()
+
+    return pd.DataFrame(
+        {
+            "conversation_id": conversation_ids,
+            "id": ids,
+            "sender": np.where(np.arange(len(ids)) % 2, "Agent", "Customer"),
+            "content": [f"message {i}" for i in range(len(ids))],
+            "created_at": (
+                pd.Timestamp("2023-07-01")
+                + pd.to_timedelta(np.arange(len(ids)), unit="s")
+            ).strftime("%Y-%m-%d %H:%M:%S"),
+        }
+    )
+
+
+def clean_conversation_ids_per_group(df):
+    """The original implementation, calling `is_consecutive` once per conversation."""
+    consecutive_ids = df.groupby("conversation_id")["id"].apply(is_consecutive)
+    non_consecutive_ids = consecutive_ids[~consecutive_ids].index
+    return df[~df["conversation_id"].isin(non_consecutive_ids)]
+
+
+def convert_to_jsonl_joined(df):
+    """The original implementation: joins each conversation with '||', rebuilds every
+    prefix from scratch, then strips URLs and '<~~...~~>' from the whole JSONL string.
+    """
+    df_sorted = df.sort_values(["conversation_id", "id"], ascending=[True, False])
+    df_sorted[["sender", "content"]] = df_sorted[["sender", "content"]].fillna("")
+    grouped = df_sorted.groupby("conversation_id")[["sender", "content"]].apply(
+        lambda x: "||".join(x["sender"] + ": " + x["content"])
+    )
+    output = []
+    for conversation in grouped.values:
+        messages = conversation.split("||")[::-1]
+        if messages[0].startswith("Agent:"):
+            continue
+        current_conversation = []
+        for message in messages:
+            current_conversation.append(message)
+            if message.startswith("Agent:"):
+                output.append(
+                    {
+                        "input_text": " ".join(current_conversation[:-1]) + " Agent:",
+                        "output_text": current_conversation[-1].split(": ", 1)[1],
+                    }
+                )
+    jsonl_output = "\n".join(json.dumps(record) for record in output)
+    url_pattern = (
+        r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]"
+        r"|(?:%[0-9a-fA-F][0-9a-fA-F]))+"
+    )
+    jsonl_output = re.sub(url_pattern, "", jsonl_output)
+    return re.sub(r"<~~.*?~~>", "", jsonl_output)
+
+
+def main(num_rows=1000000):
+    df = make_synthetic_messages(num_rows)
+
+    start = time.perf_counter()
+    df_per_group = clean_conversation_ids_per_group(df)
+    per_group_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df_vectorized = clean_conversation_ids(df)
+    vectorized_seconds = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(df_per_group, df_vectorized)
+    logger.info(
+        f"{num_rows} rows: per conversation {per_group_seconds:.2f}s, "
+        f"vectorized {vectorized_seconds:.2f}s "
+        f"({per_group_seconds / vectorized_seconds:.0f}x speedup), frames identical"
+    )
+
+    df = df_vectorized.head(num_rows // 10)
+    start = time.perf_counter()
+    jsonl_joined = convert_to_jsonl_joined(df)
+    joined_seconds = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as output_folder:
+        output_path = Path(output_folder) / "fine_tuning_dataset.jsonl"
+        start = time.perf_counter()
+        write_jsonl(iter_training_records(df), output_path)
+        streaming_seconds = time.perf_counter() - start
+        assert output_path.read_text() == jsonl_joined + "\n"
+    logger.info(
+        f"{len(df)} rows to JSONL: joined {joined_seconds:.2f}s, "
+        f"streaming {streaming_seconds:.2f}s, outputs identical"
+    )
+    return per_group_seconds, vectorized_seconds, joined_seconds, streaming_seconds
+
+
+if __name__ == "__main__":
+    main()
@@ -7,68 +7,80 @@ from llm_experiments.utils import here
 
 DATA_PATH = here() / 'data'
 
-
-# Load the CSV data into a pandas DataFrame
-df = pd.read_csv(DATA_PATH / 'messages.csv')
-df.columns = ['datetime', 'sender', 'message']
-
-# Reorder the DataFrame based on date in ascending order
-df = df.sort_values('datetime')
-
-# Identify the sender name
-sender_name = "Sender"  # replace with the actual name
-
-# Initialize an empty list to hold the new rows
-new_rows = []
-
-# Initialize variables to hold the current grouped message and its sender
-current_message = str(df.iloc[0]['message'] if df.iloc[0]['message'] is not np.nan else '')
-current_sender = df.iloc[0]['sender']
-
-# Loop through the DataFrame starting from the second row
-for i in range(1, len(df)):
-    # If the sender is the same as the current sender, append the message to the current message
-    if df.iloc[i]['sender'] == current_sender:
-        current_message += ' ' + str(df.iloc[i]['message'] if df.iloc[i]['message'] is not np.nan else '')
-    else:
-        # If the sender is different, add the current row to the new_rows list
-        new_rows.append({
-            'datetime': df.iloc[i - 1]['datetime'],
-            'sender': current_sender,
-            'message': current_message
-        })
-        # Then start a new current message with the new sender
-        current_message = str(df.iloc[i]['message'] if df.iloc[i]['message'] is not np.nan else '')
-        current_sender = df.iloc[i]['sender']
-
-# Add the last current message to the new_rows list
-new_rows.append({
-    'datetime': df.iloc[-1]['datetime'],
-    'sender': current_sender,
-    'message': current_message
-})
-
-# Create a new DataFrame from the list of new rows
-grouped_df = pd.DataFrame(new_rows)
-
-# Initialize an empty list to hold our formatted data
-data = []
-
-# Loop through the grouped DataFrame with a step of 1
-for i in range(0, len(grouped_df) - 1):
-    # Only process if the current message is from the sender and the next one is from the recipient
-    if grouped_df.iloc[i]['sender'] == sender_name and grouped_df.iloc[i+1]['sender'] != sender_name:
-        # Add the sender and recipient messages to the data list in the required format
-        data.append({
-            'input_text': grouped_df.iloc[i]['message'] + ' context: This is a message from a boyfriend to his girlfriend. You are to respond to the message as the girlfriend. Some messages are grouped together.',
-            'output_text': grouped_df.iloc[i + 1]['message'],
-        })
-
-# Convert the list into JSON Lines format
-with open(DATA_PATH / 'messages.jsonl', 'w', encoding='utf-8') as f:
-    for entry in data:
-        json.dump(entry, f, ensure_ascii=False)
-        f.write('\n')
-
-# Load messages.jsonl file and read into pandas df
-df_jsonl = pd.read_json(DATA_PATH / 'messages.jsonl', lines=True)
+CONTEXT = (
+    ' context: This is a message from a boyfriend to his girlfriend. You are to respond'
+    ' to the message as the girlfriend. Some messages are grouped together.'
+)
+
+
+def group_consecutive_messages(df):
+    """
+    Joins runs of consecutive messages from the same sender into one message, separated
+    by spaces.
+
+    Each run keeps the 'datetime' of its last message. Missing messages count as empty
+    strings.
+    """
+    if df.empty:
+        return pd.DataFrame(columns=['datetime', 'sender', 'message'])
+
+    # A new run starts wherever the sender changes
+    is_start = (df['sender'] != df['sender'].shift()).to_numpy()
+    is_end = np.append(is_start[1:], True)
+
+    # Prefix every message but the first of each run with a space, then concatenate each
+    # run in one pass
+    messages = df['message'].fillna('').astype(str).to_numpy(dtype=object)
+    messages = np.where(is_start, messages, ' ' + messages)
+
+    return pd.DataFrame({
+        'datetime': df['datetime'].to_numpy()[is_end],
+        'sender': df['sender'].to_numpy()[is_start],
+        'message': np.add.reduceat(messages, np.flatnonzero(is_start)),
+    })
+
+
+def pair_turns(grouped_df, sender_name, context=CONTEXT):
+    """
+    Pairs each message from `sender_name` with the reply that follows it, as fine-tuning
+    records.
+    """
+    next_message = grouped_df['message'].shift(-1)
+    next_sender = grouped_df['sender'].shift(-1)
+    has_next = np.arange(len(grouped_df)) < len(grouped_df) - 1
+    is_pair = (
+        (grouped_df['sender'] == sender_name) & (next_sender != sender_name) & has_next
+    )
+    return [
+        {'input_text': input_text + context, 'output_text': output_text}
+        for input_text, output_text in zip(
+            grouped_df.loc[is_pair, 'message'], next_message[is_pair]
+        )
+    ]
+
+
+def write_messages_jsonl(data, output_path):
+    # Convert the list into JSON Lines format
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for entry in data:
+            json.dump(entry, f, ensure_ascii=False)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    # Load the CSV data into a pandas DataFrame
+    df = pd.read_csv(DATA_PATH / 'messages.csv')
+    df.columns = ['datetime', 'sender', 'message']
+
+    # Reorder the DataFrame based on date in ascending order
+    df = df.sort_values('datetime', kind='stable')
+
+    # Identify the sender name
+    sender_name = "Sender"  # replace with the actual name
+
+    grouped_df = group_consecutive_messages(df)
+    data = pair_turns(grouped_df, sender_name)
+    write_messages_jsonl(data, DATA_PATH / 'messages.jsonl')
+
+    # Load messages.jsonl file and read into pandas df
+    df_jsonl = pd.read_json(DATA_PATH / 'messages.jsonl', lines=True)
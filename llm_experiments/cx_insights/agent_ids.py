@@ -0,0 +1,93 @@
+"""Persistent, collision-safe mapping of agent names to the integer user ids of CCAI."""
+
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+
+from loguru import logger
+
+from llm_experiments.cache import LRUCache
+
+
+def short_hash_id(input_string):
+    """8 digit integer from the MD5 of a string. Not unique, see `AgentIdRegistry`."""
+    int_id = int(hashlib.md5(input_string.encode()).hexdigest(), 16)
+    return int(str(int_id)[:8])
+
+
+class AgentIdRegistry:
+    """Agent name -> integer id registry in SQLite, with an in-memory LRU in front.
+
+    A new name gets the same id `short_hash_id` would give it, so ids already sent to
+    CCAI stay stable. If that id belongs to a different name, the name is re-hashed with
+    a counter suffix until a free id is found and the collision is logged. The UNIQUE
+    constraint on `id` makes the guarantee hold across threads and processes sharing the
+    database file.
+    """
+
+    def __init__(self, db_path, cache_size=4096, max_attempts=100):
+        self.db_path = Path(db_path)
+        self.max_attempts = max_attempts
+        self.collisions = 0
+        self._cache = LRUCache(maxsize=cache_size)
+        self._lock = threading.Lock()
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS agent_ids ("
+            "name TEXT PRIMARY KEY, id INTEGER NOT NULL UNIQUE, md5 TEXT NOT NULL)"
+        )
+        self._connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM agent_ids"
+            ).fetchone()
+        return count
+
+    def get_id(self, name):
+        """Integer id for `name`, assigning and persisting a new one if needed."""
+        agent_id = self._cache.get(name)
+        if agent_id is not None:
+            return agent_id
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT id FROM agent_ids WHERE name = ?", (name,)
+            ).fetchone()
+            agent_id = row[0] if row else self._assign(name)
+
+        self._cache.put(name, agent_id)
+        return agent_id
+
+    def _assign(self, name):
+        md5 = hashlib.md5(name.encode()).hexdigest()
+        for attempt in range(self.max_attempts):
+            candidate = short_hash_id(name if attempt == 0 else f"{name}#{attempt}")
+            try:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT INTO agent_ids (name, id, md5) VALUES (?, ?, ?)",
+                        (name, candidate, md5),
+                    )
+                return candidate
+            except sqlite3.IntegrityError:
+                row = self._connection.execute(
+                    "SELECT id FROM agent_ids WHERE name = ?", (name,)
+                ).fetchone()
+                if row:  # another process registered this name first
+                    return row[0]
+                self.collisions += 1
+                logger.warning(
+                    f"Agent id {candidate} for {name!r} is already taken, re-hashing"
+                )
+        raise RuntimeError(
+            f"Could not find a free agent id for {name!r} "
+            f"after {self.max_attempts} attempts"
+        )
+
+    def close(self):
+        self._connection.close()
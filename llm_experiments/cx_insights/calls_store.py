@@ -0,0 +1,91 @@
+"""Parquet store for the joined Talkdesk calls shared by the insights pipeline.
+
+`all_calls` is written as a parquet dataset partitioned by interaction date, so
+reloading it skips CSV parsing and type inference and only reads the columns (and dates)
+that are asked for.
+"""
+
+import shutil
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+PARTITION_COLUMN = "interaction_date"
+
+
+def is_parquet_path(path):
+    """True for a `.parquet` file or a directory holding a parquet dataset."""
+    path = Path(path)
+    return path.suffix == ".parquet" or path.is_dir()
+
+
+def write_calls_dataset(df_calls, dataset_path, partition_by_date=True):
+    """Write calls as a parquet dataset partitioned by `interaction_date=YYYY-MM-DD/`.
+
+    The dataset is replaced as a whole: partitions for the dates in `df_calls` are
+    overwritten and partitions of other dates, left by an earlier write, are deleted.
+    Rows are grouped by interaction_id, keeping their order within each interaction, so
+    the dataset can be read back in chunks of complete interactions. With
+    `partition_by_date=False` a single parquet file is written.
+    """
+    dataset_path = Path(dataset_path)
+    df_calls = df_calls.sort_values("interaction_id", kind="stable")
+    # one schema for every partition, so a column all null on one date keeps its type
+    schema = pa.Schema.from_pandas(df_calls, preserve_index=False)
+
+    if not partition_by_date:
+        dataset_path.parent.mkdir(parents=True, exist_ok=True)
+        pq.write_table(
+            pa.Table.from_pandas(df_calls, schema=schema, preserve_index=False),
+            dataset_path,
+        )
+        return
+
+    dates = (
+        pd.to_datetime(df_calls["interaction_started"], errors="coerce")
+        .dt.strftime("%Y-%m-%d")
+        .fillna("unknown")
+    )
+    written = set()
+    for date, df_date in df_calls.groupby(dates, sort=True):
+        partition_path = dataset_path / f"{PARTITION_COLUMN}={date}"
+        partition_path.mkdir(parents=True, exist_ok=True)
+        pq.write_table(
+            pa.Table.from_pandas(df_date, schema=schema, preserve_index=False),
+            partition_path / "part-0.parquet",
+        )
+        written.add(partition_path.name)
+    for partition_path in dataset_path.glob(f"{PARTITION_COLUMN}=*"):
+        if partition_path.name not in written:
+            shutil.rmtree(partition_path)
+
+
+def _dataset(dataset_path):
+    return ds.dataset(str(dataset_path), format="parquet", partitioning="hive")
+
+
+def _available(dataset, columns):
+    if columns is None:
+        return None
+    return [column for column in columns if column in dataset.schema.names]
+
+
+def read_calls_dataset(dataset_path, columns=None, filter=None):
+    """Load calls from parquet, reading only `columns` and rows matching `filter`."""
+    dataset = _dataset(dataset_path)
+    return dataset.to_table(
+        columns=_available(dataset, columns), filter=filter
+    ).to_pandas()
+
+
+def iter_calls_batches(dataset_path, columns=None, batch_size=100000):
+    """Yield DataFrames of at most `batch_size` rows, in file order."""
+    dataset = _dataset(dataset_path)
+    for batch in dataset.to_batches(
+        columns=_available(dataset, columns), batch_size=batch_size
+    ):
+        if batch.num_rows:
+            yield batch.to_pandas()
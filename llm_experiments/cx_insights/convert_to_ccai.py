@@ -1,29 +1,66 @@
-import hashlib
 import json
 import os
-import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import requests
 
 from loguru import logger
+import numpy as np
 import pandas as pd
 from google.cloud import storage
 from pathlib import Path
+
+from llm_experiments.cx_insights import calls_store, credentials
+from llm_experiments.cx_insights.agent_ids import AgentIdRegistry, short_hash_id
+from llm_experiments.cx_insights.gcs_upload import ParallelGCSUploader
+from llm_experiments.cx_insights.ndjson_shards import ShardedConversationWriter
+from llm_experiments.rate_limit import TokenBucket
 from llm_experiments.utils import here
 
 
 class ConversationDataTransformer:
+    # columns the transform reads; parquet inputs load only these
+    CALL_COLUMNS = [
+        "interaction_id",
+        "enquiry_id",
+        "message_text",
+        "message_participant",
+        "message_agent_name",
+        "interaction_started",
+        "filename",
+    ]
+    # read_csv infers types per chunk, so an id column with a missing value in one chunk
+    # would come back as float there and int elsewhere; every reader pins these instead
+    CALL_DTYPES = {"interaction_id": str, "enquiry_id": "Int64"}
+
     def __init__(
-        self, input_csv_path, output_folder, gcs_bucket_name, gcs_directory_path
+        self,
+        input_csv_path,
+        output_folder,
+        gcs_bucket_name,
+        gcs_directory_path,
+        bucket=None,
+        agent_id_registry=None,
+        text_scrubber=None,
     ):
         self.input_csv_path = Path(input_csv_path)
         self.output_folder = Path(output_folder)
         self.gcs_bucket_name = gcs_bucket_name
         self.gcs_directory_path = gcs_directory_path
-
-        # Initialize GCS client and bucket here because you don't want to do it every method call
-        self.gcs_client = storage.Client()
-        self.bucket = self.gcs_client.get_bucket(gcs_bucket_name)
+        # optional AgentIdRegistry for collision-free agent ids, otherwise plain hashes
+        self.agent_id_registry = agent_id_registry
+        # optional llm_experiments.scrub.TextScrubber, to scrub PII from the messages
+        self.text_scrubber = text_scrubber
+
+        # Initialize GCS client and bucket here because you don't want to do it every
+        # method call. A bucket can be passed in directly (e.g. a local fake in tests)
+        # to skip the GCS client.
+        if bucket is None:
+            self.gcs_client = storage.Client()
+            bucket = self.gcs_client.get_bucket(gcs_bucket_name)
+        self.bucket = bucket
 
         # Ensure output folder exists
         if not self.output_folder.exists():
@@ -36,18 +73,23 @@ class ConversationDataTransformer:
 
     @staticmethod
     def string_to_int_id(input_string):
-        # Function to convert a string to an integer id
-        # Use SHA-256 hash function
-        hash_object = hashlib.md5(input_string.encode())
-        # Get hexadecimal digest
-        hex_dig = hash_object.hexdigest()
-        # Convert hexadecimal to integer
-        int_id = int(hex_dig, 16)  # 40 digit unique integer
-        return int(
-            str(int_id)[:8]
-        )  # reduce to 8 digit integer and hope for no hash collisions lol
+        # Function to convert a string to an 8 digit integer id from its MD5 hash.
+        # Collisions are possible, use an AgentIdRegistry to rule them out
+        return short_hash_id(input_string)
+
+    def agent_id(self, agent_name):
+        # CCAI needs integers for IDs not strings
+        if self.agent_id_registry is not None:
+            return self.agent_id_registry.get_id(agent_name)
+        return self.string_to_int_id(agent_name)
+
+    def scrub_messages(self, df_calls):
+        if self.text_scrubber is None:
+            return df_calls
+        return self.text_scrubber.scrub_columns(df_calls, ["message_text"])
 
     def transform_data(self, group: pd.DataFrame, interaction_id: str):
+        group = self.scrub_messages(group)
         conversation_data = {
             "conversation_info": {
                 "categories": [
@@ -68,10 +110,10 @@ class ConversationDataTransformer:
             user_id = (
                 row["enquiry_id"]
                 if row["message_participant"] == "CUSTOMER"
-                else self.string_to_int_id(
-                    row["message_agent_name"]
-                )  # CCAI needs integers for IDs not strings
+                else self.agent_id(row["message_agent_name"])
             )
+            if pd.isna(user_id):
+                user_id = None
             timestamp += 5000000  # increment by 5 seconds because all timestamps are the same in the data from Talkdesk
             entry = {
                 "text": row["message_text"],
@@ -83,6 +125,69 @@ class ConversationDataTransformer:
 
         return conversation_data
 
+    def transform_all_data(self, df_calls: pd.DataFrame):
+        """Columnar equivalent of calling `transform_data` on every interaction group.
+
+        user_id, role and the synthetic +5s timestamps are computed for the whole frame
+        at once, so each agent name is hashed once and each interaction start is parsed
+        once. Yields (interaction_id, conversation_data) in the same order as
+        `groupby("interaction_id")`.
+        """
+        df_calls = df_calls[df_calls["interaction_id"].notna()]
+        if df_calls.empty:
+            return
+        df_calls = self.scrub_messages(df_calls)
+        grouped = df_calls.groupby("interaction_id")
+        group_sizes = grouped.size()
+
+        # reorder rows so each interaction is contiguous, keeping the original message
+        # order within it
+        df = df_calls.iloc[np.argsort(grouped.ngroup().to_numpy(), kind="stable")]
+        group_starts = np.concatenate([[0], group_sizes.to_numpy().cumsum()[:-1]])
+        group_numbers = np.repeat(np.arange(len(group_sizes)), group_sizes.to_numpy())
+        message_numbers = df.groupby("interaction_id", sort=False).cumcount().to_numpy()
+
+        # the per-row path hashes every agent message; hash each agent name only once
+        is_customer = (df["message_participant"] == "CUSTOMER").to_numpy()
+        agent_names = df["message_agent_name"].to_numpy()[~is_customer]
+        agent_ids = {name: self.agent_id(name) for name in pd.unique(agent_names)}
+        enquiry_ids = df["enquiry_id"].astype(object)
+        user_ids = enquiry_ids.where(enquiry_ids.notna(), None).to_numpy()
+        user_ids[~is_customer] = pd.Series(agent_names).map(agent_ids).astype(object)
+
+        # same microsecond conversion as `to_microseconds`, but parsing every
+        # interaction start in one go
+        interaction_starts = pd.to_datetime(
+            pd.Series(df["interaction_started"].to_numpy()[group_starts])
+        )
+        start_usec = np.array(
+            [int(datetime.timestamp(start) * 1e6) for start in interaction_starts],
+            dtype="int64",
+        )
+        timestamps = start_usec[group_numbers] + 5000000 * (message_numbers + 1)
+
+        entries = pd.DataFrame(
+            {
+                "text": df["message_text"].to_numpy(),
+                "role": df["message_participant"].to_numpy(),
+                "user_id": user_ids,
+                "start_timestamp_usec": timestamps,
+            }
+        ).to_dict("records")
+
+        filenames = df["filename"].to_numpy()[group_starts]
+        for interaction_id, start, size, filename in zip(
+            group_sizes.index, group_starts, group_sizes, filenames
+        ):
+            yield interaction_id, {
+                "conversation_info": {
+                    "categories": [
+                        {"filename": filename, "interaction_id": interaction_id}
+                    ]
+                },
+                "entries": entries[start : start + size],
+            }
+
     def save_to_file(self, interaction_id, data):
         file_name = f"conversation_{interaction_id}.json"
         file_path = self.output_folder / file_name
@@ -94,31 +199,265 @@ class ConversationDataTransformer:
         blob = self.bucket.blob(str(gcs_file_name))
         blob.upload_from_filename(str(upload_file_path))
 
-    def process_conversations(self, save_to_gcs_flag=False):
-        df_calls = pd.read_csv(self.input_csv_path)
-        grouped = df_calls.groupby("interaction_id")
-        for interaction_id, group in grouped:
-            conversation_data = self.transform_data(group, interaction_id)
+    def read_calls(self):
+        """Load the joined calls, from parquet (only the columns needed) or from CSV."""
+        if calls_store.is_parquet_path(self.input_csv_path):
+            return self.with_call_dtypes(
+                calls_store.read_calls_dataset(
+                    self.input_csv_path, columns=self.CALL_COLUMNS
+                )
+            )
+        return pd.read_csv(self.input_csv_path, dtype=self.CALL_DTYPES)
+
+    @classmethod
+    def with_call_dtypes(cls, df_calls):
+        """Cast the id columns to `CALL_DTYPES`, keeping missing values missing."""
+        interaction_ids = df_calls["interaction_id"]
+        return df_calls.assign(
+            interaction_id=interaction_ids.where(
+                interaction_ids.isna(), interaction_ids.astype(str)
+            ),
+            enquiry_id=df_calls["enquiry_id"].astype(cls.CALL_DTYPES["enquiry_id"]),
+        )
+
+    def iter_interaction_chunks(self, chunksize):
+        """Read the call export `chunksize` rows at a time, yielding frames of complete
+        interactions only.
+
+        The trailing interaction of each chunk may continue in the next one, so it is
+        carried over rather than emitted. Peak memory is one chunk plus the largest
+        interaction. Rows of an interaction must be contiguous in the CSV (as written by
+        process_talkdesk_conversations); an interaction that reappears after it was
+        emitted raises a ValueError. The id columns are read as `CALL_DTYPES` whatever
+        the chunk boundaries.
+        """
+        if calls_store.is_parquet_path(self.input_csv_path):
+            chunks = map(
+                self.with_call_dtypes,
+                calls_store.iter_calls_batches(
+                    self.input_csv_path, columns=self.CALL_COLUMNS, batch_size=chunksize
+                ),
+            )
+        else:
+            chunks = pd.read_csv(
+                self.input_csv_path, chunksize=chunksize, dtype=self.CALL_DTYPES
+            )
+
+        carried = None
+        emitted_ids = set()
+        for chunk in chunks:
+            chunk = chunk[chunk["interaction_id"].notna()]
+            if carried is not None:
+                chunk = pd.concat([carried, chunk])
+            if chunk.empty:
+                continue
+
+            # split off the run of rows belonging to the last interaction in the chunk
+            interaction_ids = chunk["interaction_id"].to_numpy()
+            id_changes = np.flatnonzero(interaction_ids[1:] != interaction_ids[:-1])
+            split_at = id_changes[-1] + 1 if len(id_changes) else 0
+            complete, carried = chunk.iloc[:split_at], chunk.iloc[split_at:]
+
+            if not complete.empty:
+                yield self._check_not_emitted(complete, emitted_ids)
+        if carried is not None and not carried.empty:
+            yield self._check_not_emitted(carried, emitted_ids)
 
-            # save to local by default
-            output_file_path = self.save_to_file(interaction_id, conversation_data)
-            if save_to_gcs_flag:
-                self.upload_to_gcs(
+    @staticmethod
+    def _check_not_emitted(df_calls, emitted_ids):
+        interaction_ids = set(df_calls["interaction_id"].unique())
+        repeated = interaction_ids & emitted_ids
+        if repeated:
+            raise ValueError(
+                f"Rows for interaction(s) {sorted(repeated)[:5]} are not contiguous in "
+                "the CSV. Sort the export by interaction_id or process it without "
+                "chunksize."
+            )
+        emitted_ids.update(interaction_ids)
+        return df_calls
+
+    def iter_conversations(self, vectorized=False, chunksize=None):
+        """Yield (interaction_id, conversation_data) for every interaction in the input
+        CSV.
+
+        With `chunksize` the CSV is streamed via `iter_interaction_chunks` instead of
+        read whole.
+        """
+        if chunksize is None:
+            frames = [self.read_calls()]
+        else:
+            frames = self.iter_interaction_chunks(chunksize)
+
+        for df_calls in frames:
+            if vectorized:
+                yield from self.transform_all_data(df_calls)
+            else:
+                for interaction_id, group in df_calls.groupby("interaction_id"):
+                    yield interaction_id, self.transform_data(group, interaction_id)
+
+    def save_to_shards(self, conversations, shard_size=1000, compress=False):
+        """Write (interaction_id, conversation_data) pairs into compact NDJSON shards in
+        the output folder.
+
+        CCAI ingests one conversation per file, so shards are for local storage only:
+        use `ndjson_shards.split_shards` to get per-conversation JSON files for ingest.
+        """
+        with ShardedConversationWriter(
+            self.output_folder,
+            max_conversations_per_shard=shard_size,
+            compress=compress,
+        ) as writer:
+            for interaction_id, conversation_data in conversations:
+                writer.write(interaction_id, conversation_data)
+        return writer.shard_paths
+
+    def process_conversations(
+        self,
+        save_to_gcs_flag=False,
+        vectorized=False,
+        upload_workers=8,
+        chunksize=None,
+        output_format="json",
+        shard_size=1000,
+        compress=False,
+    ):
+        if save_to_gcs_flag and output_format == "ndjson":
+            raise ValueError(
+                "NDJSON shards can't be uploaded for CCAI ingest, which expects one "
+                "conversation per file. Use output_format='json' to upload, or run "
+                "ndjson_shards.split_shards on the shards first."
+            )
+        conversations = self.iter_conversations(
+            vectorized=vectorized, chunksize=chunksize
+        )
+
+        # uploads run on a thread pool while we keep transforming; the manifest lets
+        # re-runs skip conversations that are already in the bucket unchanged
+        uploader = None
+        if save_to_gcs_flag:
+            uploader = ParallelGCSUploader(
+                self.bucket,
+                max_workers=upload_workers,
+                manifest_path=self.output_folder
+                / f"upload_manifest_{self.gcs_bucket_name}.jsonl",
+            )
+
+        # save to local by default, either one pretty-printed file per conversation or
+        # NDJSON shards
+        if output_format == "json":
+            output_file_paths = (
+                self.save_to_file(interaction_id, conversation_data)
+                for interaction_id, conversation_data in conversations
+            )
+        elif output_format == "ndjson":
+            output_file_paths = self.save_to_shards(
+                conversations, shard_size=shard_size, compress=compress
+            )
+        else:
+            raise ValueError(
+                f"Unknown output_format {output_format!r}, expected 'json' or 'ndjson'"
+            )
+
+        for output_file_path in output_file_paths:
+            if uploader is not None:
+                uploader.submit(
                     output_file_path,
                     Path(self.gcs_directory_path) / Path(output_file_path).name,
                 )
 
+        if uploader is not None:
+            return uploader.close()
+
+
+class IngestStats:
+    """Thread-safe latency and outcome counters for CCAI ingest requests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+
+    def record(self, latency_seconds, success):
+        with self._lock:
+            self.latencies.append(latency_seconds)
+            if success:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def latency_percentile(self, percentile):
+        if not self.latencies:
+            return None
+        return float(np.percentile(self.latencies, percentile))
+
+    def __str__(self):
+        return (
+            f"succeeded={self.succeeded} failed={self.failed} retries={self.retries} "
+            f"p50={self.latency_percentile(50) or 0:.2f}s "
+            f"p95={self.latency_percentile(95) or 0:.2f}s"
+        )
+
 
 class IngestToCCAI:
-    """Class to ingest all files in a GCS directory to CCAI. Needs authentication with a bearer token."""
+    """Class to ingest all files in a GCS directory to CCAI. Needs authentication with a
+    bearer token.
+
+    Requests share one keep-alive session, can be rate limited with
+    `requests_per_second`, and are retried with exponential backoff on 429/5xx
+    responses, connection errors and timeouts. Each request times out after
+    `request_timeout` seconds, a (connect, read) tuple or a single number.
+    """
 
-    def __init__(self, gcs_bucket_name, gcs_directory_path):
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        gcs_bucket_name,
+        gcs_directory_path,
+        api_root="https://contactcenterinsights.googleapis.com/v1",
+        parent="projects/motorway-genai/locations/us-central1",
+        requests_per_second=None,
+        max_retries=5,
+        backoff_seconds=1.0,
+        pool_size=16,
+        poll_seconds=5.0,
+        token_provider=None,
+        request_timeout=(10, 60),
+    ):
         self.gcs_bucket_name = gcs_bucket_name
         self.gcs_directory_path = gcs_directory_path
+        self.api_root = api_root.rstrip("/")
+        self.parent = parent
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.poll_seconds = poll_seconds
+        self.request_timeout = request_timeout
+        self.rate_limiter = (
+            TokenBucket(requests_per_second) if requests_per_second else None
+        )
 
+        # one pooled keep-alive session for every request instead of a new connection
+        # each time
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # a static bearer token, or a CachedTokenProvider that refreshes itself before
+        # expiry
         self.bearer_token = None
+        self.token_provider = token_provider
         self.successful_conversations = []
         self.failed_conversations = []
+        self.stats = IngestStats()
 
     def _set_bearer_token(self, bearer_token):
         self.bearer_token = bearer_token
@@ -127,24 +466,20 @@ class IngestToCCAI:
         """Set the bearer token based on user input from the command line interface."""
         self.bearer_token = input("Please enter your bearer token: ").strip()
 
-    def _set_bearer_token_from_service_account_file(self, gcp_credentials_json):
-        """Get the bearer token from a service account json file for authentication to the CCAI endpoint."""
-        from google.oauth2 import service_account
-        import google.auth.transport.requests
-
-        # Expand the user's home directory (~ part in the path if applicable)
-        expanded_path = os.path.expanduser(gcp_credentials_json)
+    def _set_token_provider(self, token_provider):
+        """Use a (shared, thread-safe) token provider instead of a fixed bearer
+        token."""
+        self.token_provider = token_provider
 
-        # Load the service account credentials from the file
-        credentials = service_account.Credentials.from_service_account_file(
-            expanded_path,
-            scopes=["https://www.googleapis.com/auth/cloud-platform"],
+    def _set_bearer_token_from_service_account_file(self, gcp_credentials_json):
+        """Get the bearer token from a service account json file for authentication to
+        the CCAI endpoint. The token is cached and refreshed before it expires, so long
+        runs don't fail mid-way.
+        """
+        self._set_token_provider(
+            credentials.from_service_account_file(gcp_credentials_json)
         )
-
-        # Obtain the bearer token
-        request = google.auth.transport.requests.Request()
-        credentials.refresh(request)
-        self.bearer_token = credentials.token
+        self.bearer_token = self.token_provider.token()
 
     def _set_bearer_token_from_env_var(self):
         import dotenv
@@ -153,25 +488,95 @@ class IngestToCCAI:
         self.bearer_token = os.getenv("GCLOUD_BEARER_TOKEN")
 
     def _set_bearer_token_from_user_default(self):
-        # Run the gcloud command and capture the output
-        token = subprocess.check_output(
-            ["gcloud", "auth", "application-default", "print-access-token"], text=True
-        ).strip()
-        self.bearer_token = token
+        # Application default credentials, refreshed in-process rather than by running
+        # `gcloud auth application-default print-access-token` for every token
+        self._set_token_provider(credentials.from_application_default())
+        self.bearer_token = self.token_provider.token()
+
+    def _headers(self):
+        bearer_token = (
+            self.token_provider.token()
+            if self.token_provider is not None
+            else self.bearer_token
+        )
+        return {
+            "Authorization": f"Bearer {bearer_token}",
+            "Content-Type": "application/json; charset=utf-8",
+        }
 
-    def _make_request(self, bucket_uri: str):
+    def _send(self, method, url, **kwargs):
+        """Send a request through the shared session, retrying 429/5xx, connection
+        errors and timeouts with exponential backoff (honouring Retry-After when the
+        server sends it)."""
+        refreshed_token = False
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                response = self.session.request(
+                    method,
+                    url,
+                    headers=self._headers(),
+                    timeout=self.request_timeout,
+                    **kwargs,
+                )
+                if (
+                    response.status_code == 401
+                    and self.token_provider is not None
+                    and not refreshed_token
+                ):
+                    # token revoked or expired early: fetch a new one and retry straight
+                    # away, once; a second 401 is a permissions problem a new token
+                    # won't fix
+                    logger.warning("401 from CCAI, refreshing bearer token")
+                    self.token_provider.invalidate()
+                    refreshed_token = True
+                    self.stats.add_retry()
+                    continue
+                if response.status_code not in self.RETRY_STATUS_CODES:
+                    return response
+                retry_after = response.headers.get("Retry-After")
+                delay = (
+                    float(retry_after)
+                    if retry_after and retry_after.isdigit()
+                    else self.backoff_seconds * 2**attempt
+                )
+                logger.warning(
+                    f"{response.status_code} from CCAI, retrying in {delay:.1f}s"
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                response = None
+                delay = self.backoff_seconds * 2**attempt
+                logger.warning(f"Connection error {e}, retrying in {delay:.1f}s")
+            if attempt < self.max_retries:
+                self.stats.add_retry()
+                time.sleep(delay)
+        return response
+
+    def _poll_operation(self, operation_name, timeout_seconds=3600):
+        """Poll a long-running operation until it is done. Returns the final operation
+        json."""
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            response = self._send("GET", f"{self.api_root}/{operation_name}")
+            if response.status_code != 200:
+                return {"error": response.text}
+            operation = response.json()
+            if operation.get("done"):
+                return operation
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    f"Operation {operation_name} not done after {timeout_seconds}s"
+                )
+            time.sleep(self.poll_seconds)
+
+    def _make_request(self, bucket_uri: str, wait_for_operation=False):
         """Make request to the CCAI endpoint to take a GCS URI and ingest to Insights."""
 
         # The URL for the API endpoint
-        endpoint = "https://contactcenterinsights.googleapis.com/v1/projects/motorway-genai/locations/us-central1/conversations:ingest"
-
-        # The bearer token for authentication
-        bearer_token = self.bearer_token
-        # Headers for the request
-        headers = {
-            "Authorization": f"Bearer {bearer_token}",
-            "Content-Type": "application/json; charset=utf-8",
-        }
+        endpoint = f"{self.api_root}/{self.parent}/conversations:ingest"
 
         # The data payload for the POST request
         data = {
@@ -181,67 +586,78 @@ class IngestToCCAI:
         }
 
         # Make the POST request
-        response = requests.post(endpoint, headers=headers, data=json.dumps(data))
+        start = time.perf_counter()
+        try:
+            response = self._send("POST", endpoint, data=json.dumps(data))
+            success = response.status_code == 200
+            error = None if success else response.text
+            if success and wait_for_operation:
+                # ingest returns a long-running operation, optionally wait for the
+                # actual result
+                operation = self._poll_operation(response.json()["name"])
+                if "error" in operation or not operation.get("done"):
+                    success, error = False, json.dumps(
+                        operation.get("error", operation)
+                    )
+        except (requests.RequestException, KeyError, ValueError, TimeoutError) as e:
+            # a malformed response or an operation that never finishes fails this
+            # conversation only
+            success, error = False, f"{type(e).__name__}: {e}"
+        self.stats.record(time.perf_counter() - start, success)
 
         # Check if the request was successful
-        if response.status_code == 200:
+        if success:
             logger.info("Success!")
             self.successful_conversations.append(bucket_uri)
         else:
-            logger.error("An error occurred:" + response.text)
+            logger.error("An error occurred:" + error)
             self.failed_conversations.append(bucket_uri)
+        return success
+
+    def ingest_concurrently(self, gcs_uris, max_workers=8, wait_for_operations=False):
+        """Ingest each GCS URI with its own request, `max_workers` at a time."""
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(
+                executor.map(
+                    lambda gcs_uri: self._make_request(gcs_uri, wait_for_operations),
+                    gcs_uris,
+                )
+            )
+        logger.info(f"Ingestion complete. {self.stats}")
+        return self.stats
 
-    def ingest_all_files_to_ccai(self):
-        """Ingest all files in a GCS directory to CCAI."""
+    def _list_json_blobs(self):
         # Get the list of files in the GCS directory
         bucket = storage.Client().get_bucket(self.gcs_bucket_name)
-
-        # Get the blob for the folder only
-        folder_blob = bucket.blob(self.gcs_directory_path)
         all_blobs = list(
             bucket.list_blobs(prefix=self.gcs_directory_path)
         )  # this includes the folder and the files
 
         # find number of items in list that end in .json
         all_json_blobs = [blob for blob in all_blobs if blob.name.endswith(".json")]
-        num_files = len(all_json_blobs)
-        logger.info(f"Found {num_files} files to ingest.")
-
-        logger.info(f"Ingesting blobs to CCAI...")
-        # Make the request to CCAI in bulk for all items in the blob
-        gcs_uri = f"gs://{self.gcs_bucket_name}/{folder_blob.name}"
-        self._make_request(gcs_uri)
-
-    def ingest_one_by_one_to_ccai(self):
-        # Not used but exists for completeness. Untested.
+        logger.info(f"Found {len(all_json_blobs)} files to ingest.")
+        return all_json_blobs
 
-        # Get the list of files in the GCS directory
-        bucket = storage.Client().get_bucket(self.gcs_bucket_name)
+    def ingest_all_files_to_ccai(self, wait_for_operation=False):
+        """Ingest all files in a GCS directory to CCAI."""
+        self._list_json_blobs()
 
-        # Get the blob for the folder only
-        folder_blob = bucket.blob(self.gcs_directory_path)
-        all_blobs = list(
-            bucket.list_blobs(prefix=self.gcs_directory_path)
-        )  # this includes the folder and the files
+        logger.info("Ingesting blobs to CCAI...")
+        # Make the request to CCAI in bulk for all items in the blob
+        gcs_uri = f"gs://{self.gcs_bucket_name}/{self.gcs_directory_path}"
+        self._make_request(gcs_uri, wait_for_operation)
 
-        # find number of items in list that end in .json
-        all_json_blobs = [blob for blob in all_blobs if blob.name.endswith(".json")]
-        num_files = len(all_json_blobs)
-        logger.info(f"Found {num_files} files to ingest.")
-
-        i = 0  # add break clause for testing
-        # Iterate through the list of files
-        for blob in all_json_blobs:
-            # Get the GCS URI for the file
-            gcs_uri = f"gs://{self.gcs_bucket_name}/{blob.name}"
-            logger.info(f"Ingesting {gcs_uri} to CCAI...")
-            # Make the request to CCAI
-            self._make_request(gcs_uri)
-            logger.info(f"Ingested {gcs_uri} to CCAI.")
-
-            i += 1
-            if i == 5:
-                break
+    def ingest_one_by_one_to_ccai(
+        self, max_workers=8, wait_for_operations=False, limit=None
+    ):
+        """Ingest every json file in the GCS directory with its own request,
+        concurrently."""
+        all_json_blobs = self._list_json_blobs()[:limit]
+        self.ingest_concurrently(
+            [f"gs://{self.gcs_bucket_name}/{blob.name}" for blob in all_json_blobs],
+            max_workers=max_workers,
+            wait_for_operations=wait_for_operations,
+        )
 
         logger.info(
             f"Ingestion complete. "
@@ -253,7 +669,7 @@ class IngestToCCAI:
 
 if __name__ == "__main__":
     output_folder = here() / "data/insights/outs" / "conversations"
-    input_csv_path = here() / "data/insights/outs/all_calls.csv"
+    input_csv_path = here() / "data/insights/outs/all_calls.parquet"
     gcs_bucket_name = "gen-ai-test-playground"
     gcs_directory_path = "ccai-insights-json/all_conversations"
 
@@ -264,293 +680,16 @@ if __name__ == "__main__":
         output_folder,
         gcs_bucket_name,
         gcs_directory_path,
+        agent_id_registry=AgentIdRegistry(here() / "logs" / "agent_ids.sqlite3"),
     )
     transformer.process_conversations(save_to_gcs_flag=True)
 
-    class ConversationDataTransformer:
-        def __init__(
-            self, input_csv_path, output_folder, gcs_bucket_name, gcs_directory_path
-        ):
-            self.input_csv_path = Path(input_csv_path)
-            self.output_folder = Path(output_folder)
-            self.gcs_bucket_name = gcs_bucket_name
-            self.gcs_directory_path = gcs_directory_path
-
-            # Initialize GCS client and bucket here because you don't want to do it every method call
-            self.gcs_client = storage.Client()
-            self.bucket = self.gcs_client.get_bucket(gcs_bucket_name)
-
-            # Ensure output folder exists
-            if not self.output_folder.exists():
-                self.output_folder.mkdir(parents=True)
-
-        @staticmethod
-        def to_microseconds(timestamp):
-            # Function to convert datetime to microseconds since Unix epoch
-            return int(datetime.timestamp(pd.to_datetime(timestamp)) * 1e6)
-
-        @staticmethod
-        def string_to_int_id(input_string, log_to_file=False, file_path=None):
-            # Function to convert a string to an integer id
-            # Use SHA-256 hash function
-            hash_object = hashlib.md5(input_string.encode())
-            # Get hexadecimal digest
-            hex_dig = hash_object.hexdigest()
-            # Convert hexadecimal to integer
-            int_id = int(hex_dig, 16)  # 40 digit unique integer
-
-            # Reduce to 8 digit integer, hope for no hash collisions lol
-            short_int_id = int(str(int_id)[:8])
-
-            if log_to_file:
-                if not file_path:
-                    file_path = here() / "logs" / "string_to_int_id_log.txt"
-                    # use pathlib to check if parent folder exists and create if not
-                    file_path.parent.mkdir(parents=True, exist_ok=True)
-
-                with open(file_path, "a+") as file:
-                    file.seek(0)  # Go to the start of the file
-                    existing_hashes = file.read()
-                    # Check if the hash exists in the file
-                    if hex_dig not in existing_hashes:
-                        # Log the new hash
-                        file.write(f"{input_string}: {hex_dig}\n")
-
-            return short_int_id
-
-        def transform_data(self, group: pd.DataFrame, interaction_id: str):
-            conversation_data = {
-                "conversation_info": {
-                    "categories": [
-                        {
-                            "filename": group["filename"].iloc[0],
-                            "interaction_id": interaction_id,
-                        }
-                    ]
-                },
-                "entries": [],
-            }
-            # initialise the timestamp variable to increment each message (because we just get the same timestamp back
-            # from talkdesk for every message in an interaction)
-            timestamp = self.to_microseconds(group["interaction_started"].iloc[0])
-
-            for _, row in group.iterrows():
-                # set the user id based on the message participant.
-                # not all customers have enquiry ids. If not, hash their interaction id
-                user_id = (
-                    row["enquiry_id"]
-                    if row["message_participant"] == "CUSTOMER"
-                    else self.string_to_int_id(
-                        row["message_agent_name"]
-                    )  # CCAI needs integers for IDs not strings
-                )
-                timestamp += 5000000  # increment by 5 seconds because all timestamps are the same in the data from Talkdesk
-                entry = {
-                    "text": row["message_text"],
-                    "role": row["message_participant"],
-                    "user_id": user_id,
-                    "start_timestamp_usec": timestamp,
-                }
-                conversation_data["entries"].append(entry)
-
-            return conversation_data
-
-        def save_to_file(self, interaction_id, data):
-            file_name = f"conversation_{interaction_id}.json"
-            file_path = self.output_folder / file_name
-            with open(file_path, "w") as file:
-                json.dump(data, file, indent=2)
-            return file_path
-
-        def upload_to_gcs(self, upload_file_path, gcs_file_name):
-            blob = self.bucket.blob(str(gcs_file_name))
-            blob.upload_from_filename(str(upload_file_path))
-
-        def process_conversations(self, save_to_gcs_flag=False):
-            df_calls = pd.read_csv(self.input_csv_path)
-            grouped = df_calls.groupby("interaction_id")
-            for interaction_id, group in grouped:
-                conversation_data = self.transform_data(group, interaction_id)
-
-                # save to local by default
-                output_file_path = self.save_to_file(interaction_id, conversation_data)
-                if save_to_gcs_flag:
-                    self.upload_to_gcs(
-                        output_file_path,
-                        Path(self.gcs_directory_path) / Path(output_file_path).name,
-                    )
-
-    class IngestToCCAI:
-        """Class to ingest all files in a GCS directory to CCAI. Needs authentication with a bearer token."""
-
-        def __init__(self, gcs_bucket_name, gcs_directory_path):
-            self.gcs_bucket_name = gcs_bucket_name
-            self.gcs_directory_path = gcs_directory_path
-
-            self.bearer_token = None
-            self.successful_conversations = []
-            self.failed_conversations = []
-
-        def _set_bearer_token(self, bearer_token):
-            self.bearer_token = bearer_token
-
-        def _set_bearer_token_from_cli_input(self):
-            """Set the bearer token based on user input from the command line interface."""
-            self.bearer_token = input("Please enter your bearer token: ").strip()
-
-        def _set_bearer_token_from_service_account_file(self, gcp_credentials_json):
-            """Get the bearer token from a service account json file for authentication to the CCAI endpoint."""
-            from google.oauth2 import service_account
-            import google.auth.transport.requests
-
-            # Expand the user's home directory (~ part in the path if applicable)
-            expanded_path = os.path.expanduser(gcp_credentials_json)
-
-            # Load the service account credentials from the file
-            credentials = service_account.Credentials.from_service_account_file(
-                expanded_path,
-                scopes=["https://www.googleapis.com/auth/cloud-platform"],
-            )
-
-            # Obtain the bearer token
-            request = google.auth.transport.requests.Request()
-            credentials.refresh(request)
-            self.bearer_token = credentials.token
-
-        def _set_bearer_token_from_env_var(self):
-            import dotenv
-
-            dotenv.load_dotenv()
-            self.bearer_token = os.getenv("GCLOUD_BEARER_TOKEN")
-
-        def _set_bearer_token_from_user_default(self):
-            # Run the gcloud command and capture the output
-            token = subprocess.check_output(
-                ["gcloud", "auth", "application-default", "print-access-token"],
-                text=True,
-            ).strip()
-            self.bearer_token = token
-
-        def _make_request(self, bucket_uri: str):
-            """Make request to the CCAI endpoint to take a GCS URI and ingest to Insights."""
-
-            # The URL for the API endpoint
-            endpoint = "https://contactcenterinsights.googleapis.com/v1/projects/motorway-genai/locations/us-central1/conversations:ingest"
-
-            # The bearer token for authentication
-            bearer_token = self.bearer_token
-            # Headers for the request
-            headers = {
-                "Authorization": f"Bearer {bearer_token}",
-                "Content-Type": "application/json; charset=utf-8",
-            }
-
-            # The data payload for the POST request
-            data = {
-                "gcsSource": {
-                    "bucketUri": bucket_uri,
-                    "bucketObjectType": "TRANSCRIPT",
-                },
-                "transcriptObjectConfig": {"medium": "PHONE_CALL"},
-                "conversationConfig": {},
-            }
-
-            # Make the POST request
-            response = requests.post(endpoint, headers=headers, data=json.dumps(data))
-
-            # Check if the request was successful
-            if response.status_code == 200:
-                logger.info("Success!")
-                self.successful_conversations.append(bucket_uri)
-            else:
-                logger.error("An error occurred:" + response.text)
-                self.failed_conversations.append(bucket_uri)
-
-        def ingest_all_files_to_ccai(self):
-            """Ingest all files in a GCS directory to CCAI."""
-            # Get the list of files in the GCS directory
-            bucket = storage.Client().get_bucket(self.gcs_bucket_name)
-
-            # Get the blob for the folder only
-            folder_blob = bucket.blob(self.gcs_directory_path)
-            all_blobs = list(
-                bucket.list_blobs(prefix=self.gcs_directory_path)
-            )  # this includes the folder and the files
-
-            # find number of items in list that end in .json
-            all_json_blobs = [blob for blob in all_blobs if blob.name.endswith(".json")]
-            num_files = len(all_json_blobs)
-            logger.info(f"Found {num_files} files to ingest.")
-
-            logger.info(f"Ingesting blobs to CCAI...")
-            # Make the request to CCAI in bulk for all items in the blob
-            gcs_uri = f"gs://{self.gcs_bucket_name}/{folder_blob.name}"
-            self._make_request(gcs_uri)
-
-        def ingest_one_by_one_to_ccai(self):
-            # Not used but exists for completeness. Untested.
-
-            # Get the list of files in the GCS directory
-            bucket = storage.Client().get_bucket(self.gcs_bucket_name)
-
-            # Get the blob for the folder only
-            folder_blob = bucket.blob(self.gcs_directory_path)
-            all_blobs = list(
-                bucket.list_blobs(prefix=self.gcs_directory_path)
-            )  # this includes the folder and the files
-
-            # find number of items in list that end in .json
-            all_json_blobs = [blob for blob in all_blobs if blob.name.endswith(".json")]
-            num_files = len(all_json_blobs)
-            logger.info(f"Found {num_files} files to ingest.")
-
-            i = 0  # add break clause for testing
-            # Iterate through the list of files
-            for blob in all_json_blobs:
-                # Get the GCS URI for the file
-                gcs_uri = f"gs://{self.gcs_bucket_name}/{blob.name}"
-                logger.info(f"Ingesting {gcs_uri} to CCAI...")
-                # Make the request to CCAI
-                self._make_request(gcs_uri)
-                logger.info(f"Ingested {gcs_uri} to CCAI.")
-
-                # i += 1
-                # if i == 5:
-                #     break
-
-            logger.info(
-                f"Ingestion complete. "
-                f"Num successful completions: {len(self.successful_conversations)}. "
-                f"Num failed completions: {len(self.failed_conversations)}."
-            )
-            logger.debug(f"Failed completions: {self.failed_conversations}")
-
-    if __name__ == "__main__":
-        output_folder = here() / "data/insights/outs" / "conversations"
-        input_csv_path = here() / "data/insights/outs/all_calls.csv"
-        gcs_bucket_name = "gen-ai-test-playground"
-        gcs_directory_path = "ccai-insights-json/all_conversations"
-
-        # Process conversations and upload to GCS
-        # Note: shell running this file must be authenticated to GCP first. Run `gcloud auth application-default login` in terminal
-        transformer = ConversationDataTransformer(
-            input_csv_path,
-            output_folder,
-            gcs_bucket_name,
-            gcs_directory_path,
-        )
-        transformer.process_conversations(save_to_gcs_flag=True)
-
-        # Ingest all conversations to CCAI
-        # This one handles authentication because it requires particular permissions, just pick your method
-        # TODO: handle auth in the ConversationDataTransformer class too
-        ingestor = IngestToCCAI(gcs_bucket_name, gcs_directory_path)
-        ingestor._set_bearer_token_from_env_var()
-        ingestor.ingest_all_files_to_ccai()
-
-    # Ingest all conversations to CCAI
-    # This one handles authentication because it requires particular permissions, just pick your method
+    # Ingest all conversations to CCAI, one request per conversation, concurrently
+    # This one handles authentication because it requires particular permissions, just
+    # pick your method.
+    # Application default credentials are refreshed before they expire, so long runs
+    # don't fail mid-way
     # TODO: handle auth in the ConversationDataTransformer class too
     ingestor = IngestToCCAI(gcs_bucket_name, gcs_directory_path)
-    ingestor._set_bearer_token_from_env_var()
-    ingestor.ingest_all_files_to_ccai()
+    ingestor._set_bearer_token_from_user_default()
+    ingestor.ingest_one_by_one_to_ccai(max_workers=8)
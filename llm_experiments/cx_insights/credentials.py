@@ -0,0 +1,167 @@
+"""Cached bearer tokens for the Google APIs, refreshed before they expire.
+
+A `CachedTokenProvider` wraps a fetch function returning `(token, expires_at)` where
+`expires_at` is a unix timestamp (or None for tokens that never expire). `token()` is a
+lock-free read on the hot path; a daemon thread refreshes the token
+`refresh_margin_seconds` before expiry (at most half way through the lifetime of
+short-lived tokens), and a caller that still finds it stale refreshes it synchronously.
+One provider can be shared by every thread.
+"""
+
+import os
+import subprocess
+import threading
+import time
+from datetime import timezone
+
+from loguru import logger
+
+CLOUD_PLATFORM_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+# lifetime assumed for tokens that don't report their expiry (gcloud tokens last 1h)
+DEFAULT_TOKEN_LIFETIME_SECONDS = 3600
+
+
+class CachedTokenProvider:
+    def __init__(
+        self,
+        fetch_token,
+        refresh_margin_seconds=300,
+        background_refresh=True,
+        clock=time.time,
+    ):
+        self.fetch_token = fetch_token
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.background_refresh = background_refresh
+        self.clock = clock
+        self.refresh_count = 0
+
+        # (token, refresh_at) replaced as a whole, so a lock-free reader never sees a
+        # token from one refresh with the deadline of another, or a dropped token
+        self._cached = None
+        self._expires_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _fresh_token(self):
+        """The cached token, or None if there is none or it is due for a refresh."""
+        cached = self._cached
+        if cached is None:
+            return None
+        token, refresh_at = cached
+        if refresh_at is not None and self.clock() >= refresh_at:
+            return None
+        return token
+
+    def token(self):
+        """Current bearer token, fetching a new one if it is missing or stale."""
+        token = self._fresh_token()
+        if token is not None:
+            return token
+        with self._lock:
+            # another thread may have refreshed while we waited for the lock
+            token = self._fresh_token()
+            if token is None:
+                token = self._refresh()
+            return token
+
+    def invalidate(self):
+        """Drop the cached token, e.g. after a 401, so the next call fetches one."""
+        with self._lock:
+            self._cached = None
+
+    def _refresh(self):
+        token, self._expires_at = self.fetch_token()
+        refresh_at = None
+        if self._expires_at is not None:
+            # a margin longer than the token's lifetime would refresh it on every call
+            lifetime = self._expires_at - self.clock()
+            margin = min(self.refresh_margin_seconds, lifetime / 2)
+            refresh_at = self._expires_at - margin
+        self._cached = (token, refresh_at)
+        self.refresh_count += 1
+        logger.debug(f"Refreshed bearer token, expires at {self._expires_at}")
+        if (
+            self.background_refresh
+            and self._expires_at is not None
+            and self._thread is None
+        ):
+            self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+            self._thread.start()
+        return token
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            cached = self._cached
+            if cached is not None and cached[1] is None:
+                return  # the token never expires
+            # an invalidated token is fetched again straight away
+            wait = cached[1] - self.clock() if cached is not None else 0
+            if wait > 0 and self._stop.wait(wait):
+                return
+            try:
+                with self._lock:
+                    if self._fresh_token() is None:
+                        self._refresh()
+            except Exception as e:
+                # callers will retry synchronously on their next token() call
+                logger.warning(f"Background token refresh failed: {e}")
+                if self._stop.wait(min(30, self.refresh_margin_seconds)):
+                    return
+
+    def stop(self):
+        """Stop the background refresh thread."""
+        self._stop.set()
+
+
+def _google_credentials_fetcher(credentials):
+    import google.auth.transport.requests
+
+    def fetch_token():
+        credentials.refresh(google.auth.transport.requests.Request())
+        expiry = credentials.expiry  # naive UTC datetime
+        expires_at = expiry.replace(tzinfo=timezone.utc).timestamp() if expiry else None
+        return credentials.token, expires_at
+
+    return fetch_token
+
+
+def from_service_account_file(gcp_credentials_json, **kwargs):
+    """Provider for a service account json file."""
+    from google.oauth2 import service_account
+
+    credentials = service_account.Credentials.from_service_account_file(
+        os.path.expanduser(gcp_credentials_json), scopes=CLOUD_PLATFORM_SCOPES
+    )
+    return CachedTokenProvider(_google_credentials_fetcher(credentials), **kwargs)
+
+
+def from_application_default(**kwargs):
+    """Provider for application default credentials, refreshed via google.auth.
+
+    Falls back to `gcloud auth application-default print-access-token` only if
+    google.auth can't find credentials itself.
+    """
+    import google.auth
+    from google.auth.exceptions import DefaultCredentialsError
+
+    try:
+        credentials, _ = google.auth.default(scopes=CLOUD_PLATFORM_SCOPES)
+    except DefaultCredentialsError:
+        logger.warning("No application default credentials found, using gcloud CLI")
+        return from_gcloud_cli(**kwargs)
+    return CachedTokenProvider(_google_credentials_fetcher(credentials), **kwargs)
+
+
+def from_gcloud_cli(**kwargs):
+    """Provider shelling out to gcloud, at most once per token lifetime."""
+
+    def fetch_token():
+        token = subprocess.check_output(
+            ["gcloud", "auth", "application-default", "print-access-token"],
+            text=True,
+        ).strip()
+        return token, time.time() + DEFAULT_TOKEN_LIFETIME_SECONDS
+
+    return CachedTokenProvider(fetch_token, **kwargs)
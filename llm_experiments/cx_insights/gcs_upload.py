@@ -0,0 +1,163 @@
+"""Bounded, resumable parallel upload of local files to a GCS bucket.
+
+Uploads run on a thread pool so network latency overlaps with whatever is producing the
+files. An append-only manifest of uploaded object names and MD5s lets re-runs skip
+unchanged files.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from loguru import logger
+
+
+def file_md5(file_path):
+    """Hex MD5 of a file's contents."""
+    hash_object = hashlib.md5()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            hash_object.update(block)
+    return hash_object.hexdigest()
+
+
+class UploadManifest:
+    """Append-only JSONL record of uploads, as `{"name": object_name, "md5": hex_md5}`.
+
+    Each upload appends one line, so a crashed run loses at most the uploads in flight.
+    The latest line for a name wins when the manifest is loaded.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = Path(manifest_path)
+        self._lock = threading.Lock()
+        self._md5s = {}
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as file:
+                for line in file:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._md5s[record["name"]] = record["md5"]
+
+    def __len__(self):
+        return len(self._md5s)
+
+    def is_uploaded(self, object_name, md5):
+        return self._md5s.get(object_name) == md5
+
+    def record(self, object_name, md5):
+        with self._lock:
+            self._md5s[object_name] = md5
+            self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.manifest_path, "a") as file:
+                file.write(json.dumps({"name": object_name, "md5": md5}) + "\n")
+
+
+class UploadStats:
+    """Thread-safe progress and throughput counters for an upload run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.perf_counter()
+        self.uploaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes_uploaded = 0
+
+    def add(self, uploaded=0, skipped=0, failed=0, num_bytes=0):
+        with self._lock:
+            self.uploaded += uploaded
+            self.skipped += skipped
+            self.failed += failed
+            self.bytes_uploaded += num_bytes
+
+    @property
+    def completed(self):
+        return self.uploaded + self.skipped + self.failed
+
+    @property
+    def elapsed_seconds(self):
+        return time.perf_counter() - self.started_at
+
+    @property
+    def files_per_second(self):
+        return self.uploaded / max(self.elapsed_seconds, 1e-9)
+
+    def __str__(self):
+        return (
+            f"uploaded={self.uploaded} skipped={self.skipped} failed={self.failed} "
+            f"bytes={self.bytes_uploaded} in {self.elapsed_seconds:.1f}s "
+            f"({self.files_per_second:.1f} files/s, "
+            f"{self.bytes_uploaded / max(self.elapsed_seconds, 1e-9) / 1e6:.2f} MB/s)"
+        )
+
+
+class ParallelGCSUploader:
+    """Upload files to a bucket on a bounded thread pool.
+
+    `bucket` only needs a `blob(name)` method returning an object with
+    `upload_from_filename(path)`, so a `google.cloud.storage.Bucket` or a local fake
+    both work. `submit` blocks once `max_pending` uploads are queued, which keeps memory
+    bounded when the producer is faster than the network.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        max_workers=8,
+        manifest_path=None,
+        max_pending=None,
+        log_every=500,
+    ):
+        self.bucket = bucket
+        self.manifest = UploadManifest(manifest_path) if manifest_path else None
+        self.stats = UploadStats()
+        self.failed_uploads = []
+        self.log_every = log_every
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = threading.BoundedSemaphore(max_pending or max_workers * 4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, local_file_path, object_name):
+        """Queue `local_file_path` for upload as `object_name`."""
+        self._pending.acquire()
+        future = self._executor.submit(
+            self._upload, Path(local_file_path), str(object_name)
+        )
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def _upload(self, local_file_path, object_name):
+        try:
+            md5 = file_md5(local_file_path)
+            if self.manifest is not None and self.manifest.is_uploaded(
+                object_name, md5
+            ):
+                self.stats.add(skipped=1)
+                return
+            self.bucket.blob(object_name).upload_from_filename(str(local_file_path))
+            if self.manifest is not None:
+                self.manifest.record(object_name, md5)
+            self.stats.add(uploaded=1, num_bytes=local_file_path.stat().st_size)
+        except Exception as e:
+            logger.error(f"Failed to upload {local_file_path} to {object_name}: {e}")
+            self.failed_uploads.append(object_name)
+            self.stats.add(failed=1)
+        finally:
+            if self.log_every and self.stats.completed % self.log_every == 0:
+                logger.info(f"Upload progress: {self.stats}")
+
+    def close(self):
+        """Wait for all queued uploads to finish."""
+        self._executor.shutdown(wait=True)
+        logger.info(f"Upload complete: {self.stats}")
+        return self.stats
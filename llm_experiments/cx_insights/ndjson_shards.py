@@ -0,0 +1,133 @@
+"""Compact NDJSON shards for CCAI conversations.
+
+Instead of one pretty-printed JSON file per interaction, conversations are written one
+per line as `{"interaction_id": ..., "conversation": {...}}` into size-capped shards,
+optionally gzipped. `split_shards` turns shards back into the per-conversation files
+CCAI ingests.
+"""
+
+import gzip
+import json
+from pathlib import Path
+
+NDJSON_SEPARATORS = (",", ":")
+
+
+def _open_shard(shard_path, mode):
+    if str(shard_path).endswith(".gz"):
+        return gzip.open(shard_path, mode)
+    return open(shard_path, mode)
+
+
+class ShardedConversationWriter:
+    """Write conversations into `<prefix>-00000.ndjson[.gz]` shards.
+
+    A shard is closed once it holds `max_conversations_per_shard` conversations or
+    writing the next one would take it past `max_bytes_per_shard` (uncompressed). Lines
+    are buffered and written `buffer_bytes` at a time so file I/O is batched.
+    """
+
+    def __init__(
+        self,
+        output_folder,
+        max_conversations_per_shard=1000,
+        max_bytes_per_shard=64 * 1024 * 1024,
+        compress=False,
+        prefix="conversations",
+        buffer_bytes=1024 * 1024,
+    ):
+        self.output_folder = Path(output_folder)
+        self.max_conversations_per_shard = max_conversations_per_shard
+        self.max_bytes_per_shard = max_bytes_per_shard
+        self.compress = compress
+        self.prefix = prefix
+        self.buffer_bytes = buffer_bytes
+
+        self.shard_paths = []
+        self._file = None
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._shard_conversations = 0
+        self._shard_bytes = 0
+
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, interaction_id, conversation_data):
+        line = (
+            json.dumps(
+                {"interaction_id": interaction_id, "conversation": conversation_data},
+                separators=NDJSON_SEPARATORS,
+            )
+            + "\n"
+        ).encode("utf-8")
+
+        if self._file is not None and (
+            self._shard_conversations >= self.max_conversations_per_shard
+            or self._shard_bytes + len(line) > self.max_bytes_per_shard
+        ):
+            self._close_shard()
+        if self._file is None:
+            self._open_next_shard()
+
+        self._buffer.append(line)
+        self._buffered_bytes += len(line)
+        self._shard_conversations += 1
+        self._shard_bytes += len(line)
+        if self._buffered_bytes >= self.buffer_bytes:
+            self._flush()
+
+    def _open_next_shard(self):
+        suffix = ".ndjson.gz" if self.compress else ".ndjson"
+        shard_path = (
+            self.output_folder / f"{self.prefix}-{len(self.shard_paths):05d}{suffix}"
+        )
+        self._file = _open_shard(shard_path, "wb")
+        self.shard_paths.append(shard_path)
+        self._shard_conversations = 0
+        self._shard_bytes = 0
+
+    def _flush(self):
+        if self._buffer:
+            self._file.write(b"".join(self._buffer))
+            self._buffer = []
+            self._buffered_bytes = 0
+
+    def _close_shard(self):
+        self._flush()
+        self._file.close()
+        self._file = None
+
+    def close(self):
+        """Flush and close the current shard. Returns the paths of all shards."""
+        if self._file is not None:
+            self._close_shard()
+        return self.shard_paths
+
+
+def iter_shard_conversations(shard_paths):
+    """Yield (interaction_id, conversation_data) from NDJSON shards, in shard order."""
+    for shard_path in shard_paths:
+        with _open_shard(shard_path, "rt") as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record["interaction_id"], record["conversation"]
+
+
+def split_shards(shard_paths, output_folder):
+    """Write one `conversation_<interaction_id>.json` per conversation for CCAI."""
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    file_paths = []
+    for interaction_id, conversation_data in iter_shard_conversations(shard_paths):
+        file_path = output_folder / f"conversation_{interaction_id}.json"
+        with open(file_path, "w") as file:
+            json.dump(conversation_data, file, indent=2)
+        file_paths.append(file_path)
+    return file_paths
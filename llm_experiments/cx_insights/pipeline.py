@@ -0,0 +1,394 @@
+"""Incremental Talkdesk -> CCAI pipeline: unzip, join ids, transform, upload, ingest.
+
+Progress is checkpointed in a local SQLite state store: which zip files have been read,
+which stages each interaction has completed and which calls file holds its rows. A daily
+run only reads new zip files and only pushes new interactions, and interactions that got
+new rows, through the later stages, and a crashed run picks up where it stopped.
+
+Note: the shell running this must be authenticated to GCP to upload and ingest.
+"""
+
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pandas as pd
+import pyarrow.dataset as ds
+from loguru import logger
+
+from llm_experiments.cx_insights import credentials
+from llm_experiments.cx_insights.agent_ids import AgentIdRegistry
+from llm_experiments.cx_insights.calls_store import (
+    read_calls_dataset,
+    write_calls_dataset,
+)
+from llm_experiments.cx_insights.convert_to_ccai import (
+    ConversationDataTransformer,
+    IngestToCCAI,
+)
+from llm_experiments.cx_insights.gcs_upload import ParallelGCSUploader
+from llm_experiments.cx_insights.process_talkdesk_conversations import (
+    IDS_PATH,
+    OUTPUT_FOLDER,
+    TRANSCRIPTION_FOLDER,
+    list_zip_files,
+    read_and_join_with_ids,
+)
+
+STAGES = ("unzip", "join", "transform", "upload", "ingest")
+
+
+class PipelineState:
+    """SQLite record of processed zip files, per-interaction stage completion and the
+    calls file holding each interaction's rows."""
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS zip_files ("
+                "name TEXT PRIMARY KEY, completed_at TEXT NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS interaction_stages ("
+                "interaction_id TEXT NOT NULL, stage TEXT NOT NULL, "
+                "completed_at TEXT NOT NULL, "
+                "PRIMARY KEY (interaction_id, stage))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS interaction_calls_files ("
+                "interaction_id TEXT PRIMARY KEY, calls_file TEXT NOT NULL)"
+            )
+
+    def processed_zip_files(self):
+        with self._lock:
+            rows = self._connection.execute("SELECT name FROM zip_files").fetchall()
+        return {name for (name,) in rows}
+
+    def completed(self, stage):
+        """Ids of the interactions that have completed `stage`."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT interaction_id FROM interaction_stages WHERE stage = ?",
+                (stage,),
+            ).fetchall()
+        return {interaction_id for (interaction_id,) in rows}
+
+    def pending(self, stage, previous_stage):
+        """Ids that completed `previous_stage` but not yet `stage`."""
+        return self.completed(previous_stage) - self.completed(stage)
+
+    def mark_completed(self, stage, interaction_ids):
+        with self._lock, self._connection:
+            self._insert_completed(stage, interaction_ids)
+
+    def _insert_completed(self, stage, interaction_ids):
+        now = datetime.now(timezone.utc).isoformat()
+        self._connection.executemany(
+            "INSERT OR IGNORE INTO interaction_stages "
+            "(interaction_id, stage, completed_at) "
+            "VALUES (?, ?, ?)",
+            [(str(interaction_id), stage, now) for interaction_id in interaction_ids],
+        )
+
+    def calls_files(self):
+        """Name of the calls file holding the rows of each interaction."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT interaction_id, calls_file FROM interaction_calls_files"
+            ).fetchall()
+        return dict(rows)
+
+    def record_join(self, calls_file, interaction_ids, updated_ids, zip_file_names):
+        """Record a join in one transaction: `calls_file` now holds the rows of
+        `interaction_ids`, the later stages of `updated_ids` have to run again and the
+        zip files are done. A crash part way leaves none of it recorded."""
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO interaction_calls_files "
+                "(interaction_id, calls_file) "
+                "VALUES (?, ?)",
+                [
+                    (str(interaction_id), calls_file)
+                    for interaction_id in interaction_ids
+                ],
+            )
+            self._connection.executemany(
+                "DELETE FROM interaction_stages WHERE interaction_id = ? AND stage = ?",
+                [
+                    (str(interaction_id), stage)
+                    for interaction_id in updated_ids
+                    for stage in ("transform", "upload", "ingest")
+                ],
+            )
+            self._insert_completed("join", interaction_ids)
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO zip_files (name, completed_at) VALUES (?, ?)",
+                [(name, now) for name in zip_file_names],
+            )
+
+    def close(self):
+        self._connection.close()
+
+
+class TalkdeskToCCAIPipeline:
+    """Single entry point for the Talkdesk -> CCAI insights pipeline.
+
+    Each run writes the calls it joined to its own calls file,
+    `<work_folder>/calls/calls_<first zip>.parquet`, sorted by interaction_id so the
+    transform stage can stream it in chunks. Re-running after a crash overwrites that
+    file rather than appending duplicate rows. When new zip files hold rows of
+    interactions joined in an earlier run, their earlier rows are copied into the new
+    file with the new ones and they go through the later stages again.
+    """
+
+    def __init__(
+        self,
+        gcs_bucket_name,
+        gcs_directory_path,
+        transcription_folder=TRANSCRIPTION_FOLDER,
+        ids_path=IDS_PATH,
+        work_folder=OUTPUT_FOLDER,
+        state_path=None,
+        bucket=None,
+        ingestor=None,
+        chunksize=100000,
+        upload_workers=8,
+        ingest_workers=8,
+        scrub_text=False,
+        agent_id_registry=None,
+    ):
+        self.gcs_bucket_name = gcs_bucket_name
+        self.gcs_directory_path = gcs_directory_path
+        self.transcription_folder = Path(transcription_folder)
+        self.ids_path = Path(ids_path)
+        self.work_folder = Path(work_folder)
+        self.calls_folder = self.work_folder / "calls"
+        self.conversations_folder = self.work_folder / "conversations"
+        state_path = Path(state_path or self.work_folder / "pipeline_state.sqlite3")
+        self.state = PipelineState(state_path)
+        self.chunksize = chunksize
+        self.upload_workers = upload_workers
+        self.ingest_workers = ingest_workers
+        # scrub PII from message text while joining, so the calls files never hold it
+        self.scrub_text = scrub_text
+
+        # agent ids stay collision-free and stable across runs, next to the run state
+        if agent_id_registry is None:
+            agent_id_registry = AgentIdRegistry(state_path.parent / "agent_ids.sqlite3")
+        self.transformer = ConversationDataTransformer(
+            self.calls_folder,
+            self.conversations_folder,
+            gcs_bucket_name,
+            gcs_directory_path,
+            bucket=bucket,
+            agent_id_registry=agent_id_registry,
+        )
+        self.ingestor = ingestor
+
+    def run(self, stages=STAGES):
+        for stage in stages:
+            if stage not in STAGES:
+                raise ValueError(f"Unknown stage {stage!r}, expected one of {STAGES}")
+        # unzip and join run together: raw transcripts are only in memory between them
+        if "unzip" in stages or "join" in stages:
+            self.unzip_and_join()
+        if "transform" in stages:
+            self.transform()
+        if "upload" in stages:
+            self.upload()
+        if "ingest" in stages:
+            self.ingest()
+
+    def unzip_and_join(self):
+        """Read zip files not seen before, writing their matched calls to a new file."""
+        processed = self.state.processed_zip_files()
+        new_zip_files = [
+            zip_file_path
+            for zip_file_path in list_zip_files(self.transcription_folder)
+            if Path(zip_file_path).name not in processed
+        ]
+        logger.info(f"unzip: {len(new_zip_files)} new zip files")
+        if not new_zip_files:
+            return
+
+        df_ids = pd.read_csv(self.ids_path)
+        df_calls, _ = read_and_join_with_ids(
+            new_zip_files, df_ids, scrub_text=self.scrub_text
+        )
+        df_calls = df_calls[df_calls["interaction_id"].notna()]
+
+        # interactions can show up again in a later export, with or without new rows
+        already_joined = self.state.completed("join")
+        is_new = ~df_calls["interaction_id"].astype(str).isin(already_joined)
+        df_updated, updated_ids = self._merge_with_earlier_rows(df_calls[~is_new])
+        num_new = df_calls.loc[is_new, "interaction_id"].nunique()
+        logger.info(
+            f"join: {num_new} new interactions, "
+            f"{len(updated_ids)} joined in earlier runs with new rows"
+        )
+        df_calls = pd.concat([df_calls[is_new], df_updated]).sort_values(
+            "interaction_id", kind="stable"
+        )
+
+        calls_path = self.calls_folder / f"calls_{Path(new_zip_files[0]).stem}.parquet"
+        self.calls_folder.mkdir(parents=True, exist_ok=True)
+        write_calls_dataset(df_calls, calls_path, partition_by_date=False)
+
+        self.state.record_join(
+            calls_path.name,
+            df_calls["interaction_id"].unique(),
+            updated_ids,
+            [Path(zip_file_path).name for zip_file_path in new_zip_files],
+        )
+
+        # export ids without a transcript in any run so far
+        joined = self.state.completed("join")
+        df_ids[~df_ids["interaction_id"].astype(str).isin(joined)].to_csv(
+            self.work_folder / "missing_ids.csv"
+        )
+
+    def _merge_with_earlier_rows(self, df_calls):
+        """Rows of interactions joined in earlier runs, plus their rows in calls files.
+
+        Rows delivered again (equal in every column but the source file name) are
+        dropped. Returns the merged rows of the interactions that got new rows, and
+        their ids.
+        """
+        if df_calls.empty:
+            return df_calls, []
+        interaction_ids = df_calls["interaction_id"].unique()
+        current_files = self.state.calls_files()
+        earlier_dfs = []
+        for calls_path in sorted(self.calls_folder.glob("calls_*.parquet")):
+            # only the file written last for an interaction holds all of its rows
+            ids_in_file = [
+                interaction_id
+                for interaction_id in interaction_ids
+                if current_files.get(str(interaction_id), calls_path.name)
+                == calls_path.name
+            ]
+            if ids_in_file:
+                earlier_dfs.append(
+                    read_calls_dataset(
+                        calls_path, filter=ds.field("interaction_id").isin(ids_in_file)
+                    )
+                )
+        df_earlier = pd.concat(earlier_dfs) if earlier_dfs else df_calls.iloc[:0]
+
+        df_merged = pd.concat([df_earlier, df_calls])
+        df_merged = df_merged.drop_duplicates(
+            subset=[column for column in df_merged.columns if column != "filename"]
+        )
+        merged_rows = df_merged["interaction_id"].value_counts()
+        earlier_rows = df_earlier["interaction_id"].value_counts()
+        updated_ids = merged_rows.index[
+            merged_rows > earlier_rows.reindex(merged_rows.index, fill_value=0)
+        ].tolist()
+        return df_merged[df_merged["interaction_id"].isin(updated_ids)], updated_ids
+
+    def transform(self):
+        """Write conversation JSON for joined interactions not transformed yet."""
+        pending = self.state.pending("transform", "join")
+        logger.info(f"transform: {len(pending)} pending interactions")
+        if not pending:
+            return
+        current_files = self.state.calls_files()
+        for calls_path in sorted(self.calls_folder.glob("calls_*.parquet")):
+            self.transformer.input_csv_path = calls_path
+            for df_calls in self.transformer.iter_interaction_chunks(self.chunksize):
+                interaction_ids = df_calls["interaction_id"].astype(str)
+                # an interaction updated by a later run has stale rows in earlier files
+                in_current_file = (
+                    interaction_ids.map(current_files).fillna(calls_path.name)
+                    == calls_path.name
+                )
+                df_calls = df_calls[interaction_ids.isin(pending) & in_current_file]
+                if df_calls.empty:
+                    continue
+                done = []
+                for (
+                    interaction_id,
+                    conversation_data,
+                ) in self.transformer.transform_all_data(df_calls):
+                    self.transformer.save_to_file(interaction_id, conversation_data)
+                    done.append(interaction_id)
+                # checkpoint after every chunk
+                self.state.mark_completed("transform", done)
+
+    def _object_name(self, interaction_id):
+        return str(
+            Path(self.gcs_directory_path) / f"conversation_{interaction_id}.json"
+        )
+
+    def upload(self):
+        """Upload transformed conversations that are not in the bucket yet."""
+        pending = sorted(self.state.pending("upload", "transform"))
+        logger.info(f"upload: {len(pending)} pending interactions")
+        if not pending:
+            return
+        with ParallelGCSUploader(
+            self.transformer.bucket,
+            max_workers=self.upload_workers,
+            manifest_path=self.work_folder
+            / f"upload_manifest_{self.gcs_bucket_name}.jsonl",
+        ) as uploader:
+            for interaction_id in pending:
+                uploader.submit(
+                    self.conversations_folder / f"conversation_{interaction_id}.json",
+                    self._object_name(interaction_id),
+                )
+        failed = set(uploader.failed_uploads)
+        self.state.mark_completed(
+            "upload",
+            [
+                interaction_id
+                for interaction_id in pending
+                if self._object_name(interaction_id) not in failed
+            ],
+        )
+
+    def ingest(self):
+        """Ingest uploaded conversations into CCAI, one request per conversation."""
+        pending = sorted(self.state.pending("ingest", "upload"))
+        logger.info(f"ingest: {len(pending)} pending interactions")
+        if not pending:
+            return
+        if self.ingestor is None:
+            # a token refreshed before it expires, so long ingests don't fail part way
+            self.ingestor = IngestToCCAI(
+                self.gcs_bucket_name,
+                self.gcs_directory_path,
+                token_provider=credentials.from_application_default(),
+            )
+
+        uri_to_id = {
+            f"gs://{self.gcs_bucket_name}/{self._object_name(interaction_id)}": (
+                interaction_id
+            )
+            for interaction_id in pending
+        }
+        self.ingestor.ingest_concurrently(
+            list(uri_to_id), max_workers=self.ingest_workers
+        )
+        self.state.mark_completed(
+            "ingest",
+            [
+                uri_to_id[uri]
+                for uri in self.ingestor.successful_conversations
+                if uri in uri_to_id
+            ],
+        )
+
+
+if __name__ == "__main__":
+    pipeline = TalkdeskToCCAIPipeline(
+        gcs_bucket_name="gen-ai-test-playground",
+        gcs_directory_path="ccai-insights-json/all_conversations",
+    )
+    pipeline.run()
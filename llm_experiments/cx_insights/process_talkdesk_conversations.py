@@ -1,5 +1,5 @@
-""" Process Talkdesk conversations from individual zip files and join them with the interaction ids supplied
-by Hannah in the Talkdesk Export file.
+"""Process Talkdesk conversations from individual zip files and join them with the
+interaction ids supplied by Hannah in the Talkdesk Export file.
 Outputs a CSV file with the following columns:
 id,time,call_id,contact_id,interaction_id,enquiry_id,message_id,message_text,message_participant,message_agent_name,interaction_started,filename,_merge,intent_value,sentiment_label
 """
@@ -7,21 +7,24 @@ id,time,call_id,contact_id,interaction_id,enquiry_id,message_id,message_text,mes
 import io
 import os
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 from loguru import logger
 
+from llm_experiments.cx_insights.calls_store import write_calls_dataset
 from llm_experiments.utils import here
 
 # get the file that contains the ids that we're looking for in the transcripts
 IDS_PATH = (
     here() / "data/insights/Talkdesk Export '2023-11-08' - results-20231108-090222.csv"
 )
-df_ids = pd.read_csv(IDS_PATH)
 
 # get the folder that contains the transcripts
 TRANSCRIPTION_FOLDER = here() / "data/insights/transcriptions"
 
+OUTPUT_FOLDER = here() / "data/insights/outs"
+
 
 # Function to unzip a file into memory
 def unzip_to_memory(zip_file_path):
@@ -38,50 +41,200 @@ def unzip_to_memory(zip_file_path):
     return data_dict
 
 
-# Directory where your zip files are located
-zip_files_dir = TRANSCRIPTION_FOLDER
+def list_zip_files(zip_files_dir):
+    """Paths of all zip files in a directory, sorted by name."""
+    return sorted(
+        os.path.join(zip_files_dir, file_name)
+        for file_name in os.listdir(zip_files_dir)
+        if file_name.endswith(".zip")
+    )
 
-# Now, all_data contains the unzipped content of all your zip files
-all_dfs = []
 
-# Iterate over each file in the zip file, check which are in the ids file and join them
-# List all the files in the directory
-for file_name in os.listdir(zip_files_dir):
-    if file_name.endswith(".zip"):
-        zip_file_path = os.path.join(zip_files_dir, file_name)
+def read_transcripts(zip_file_paths):
+    """Read every transcript CSV inside the zip files into one DataFrame, tagged with
+    its filename."""
+    all_dfs = []
+    for zip_file_path in zip_file_paths:
         # Unzip the file and store the content
         for filename, dataio in unzip_to_memory(zip_file_path).items():
             logger.info(f"{filename=}")
             df = pd.read_csv(dataio)
             df["filename"] = filename
-            # df_crossover = df_ids.merge(
-            #     df,
-            #     left_on="interaction_id",
-            #     right_on="interaction_id",
-            #     how="left",
-            #     indicator=True,
-            # )
-            # logger.info(f"found {len(df_crossover)} crossover rows")
-            # all_dfs.append(df_crossover)
             all_dfs.append(df)
+    # Combine all dfs into one
+    return pd.concat(all_dfs)
+
+
+def _list_zip_members(zip_file_paths):
+    members = []
+    for zip_file_path in zip_file_paths:
+        with zipfile.ZipFile(zip_file_path, "r") as zip_ref:
+            members.extend(
+                (zip_file_path, member)
+                for member in zip_ref.namelist()
+                if not member.endswith("/")
+            )
+    logger.info(
+        f"Parsing {len(members)} transcript files from {len(zip_file_paths)} zips"
+    )
+    return members
+
+
+def _read_zip_member(zip_file_path, member):
+    # parse straight from the (decompressing) zip stream, no in-memory copy of the file
+    with zipfile.ZipFile(zip_file_path, "r") as zip_ref, zip_ref.open(member) as f:
+        df = pd.read_csv(f)
+    df["filename"] = member
+    return df
+
+
+def read_transcripts_parallel(zip_file_paths, max_workers=None):
+    """Same result as `read_transcripts`, with each zip member parsed in a process pool.
+
+    Results come back in zip/member order and are concatenated once.
+    """
+    members = _list_zip_members(zip_file_paths)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        all_dfs = list(
+            executor.map(
+                _read_zip_member,
+                [zip_file_path for zip_file_path, _ in members],
+                [member for _, member in members],
+            )
+        )
+    return pd.concat(all_dfs)
+
+
+# index of wanted interaction ids, set once per worker process by
+# `read_matched_transcripts` so it isn't pickled again for every file, and the scrubber
+# for `message_text` if scrubbing
+_wanted_ids = None
+_text_scrubber = None
+
+
+def _init_matching_worker(wanted_ids, scrub_text=False):
+    global _wanted_ids, _text_scrubber
+    _wanted_ids = pd.Index(wanted_ids)
+    if scrub_text:
+        from llm_experiments.scrub import ScrubCache, TextScrubber
+
+        _text_scrubber = TextScrubber(cache=ScrubCache())
+
+
+def _read_matched_zip_member(zip_file_path, member, chunksize):
+    matched = []
+    with zipfile.ZipFile(zip_file_path, "r") as zip_ref, zip_ref.open(member) as f:
+        for chunk in pd.read_csv(f, chunksize=chunksize):
+            is_matched = chunk["interaction_id"].isin(_wanted_ids)
+            if "_merge" in chunk.columns:
+                # like `join_with_ids`, rows present on only one side of the export
+                # are dropped
+                is_matched &= chunk["_merge"] == "both"
+            matched.append(chunk[is_matched])
+    df = pd.concat(matched)
+    if _text_scrubber is not None:
+        df = _text_scrubber.scrub_columns(df, ["message_text"])
+    df["filename"] = member
+    return df
+
+
+def read_matched_transcripts(
+    zip_file_paths, wanted_ids, max_workers=None, chunksize=100000, scrub_text=False
+):
+    """Read only the transcript rows whose interaction_id is in `wanted_ids`.
+
+    Each file is filtered chunk by chunk as it is parsed, so memory is proportional to
+    the matched rows rather than to every row of every call. With `scrub_text` PII is
+    scrubbed from `message_text` (see `llm_experiments.scrub`) in the same worker,
+    before the rows leave it.
+    """
+    members = _list_zip_members(zip_file_paths)
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_matching_worker,
+        initargs=(list(wanted_ids), scrub_text),
+    ) as executor:
+        matched_dfs = list(
+            executor.map(
+                _read_matched_zip_member,
+                [zip_file_path for zip_file_path, _ in members],
+                [member for _, member in members],
+                [chunksize] * len(members),
+            )
+        )
+    return pd.concat(matched_dfs)
+
+
+def read_and_join_with_ids(
+    zip_file_paths, df_ids, max_workers=None, chunksize=100000, scrub_text=False
+):
+    """Filter transcripts against the Talkdesk export ids while parsing them.
+
+    Rows are kept if their interaction_id is in `df_ids` and, as in `join_with_ids`,
+    their `_merge` column (when there is one) is "both". Other rows are dropped before
+    they are concatenated.
+    Returns (df_calls, missing_ids).
+    """
+    df_calls = read_matched_transcripts(
+        zip_file_paths,
+        df_ids["interaction_id"].dropna().unique(),
+        max_workers=max_workers,
+        chunksize=chunksize,
+        scrub_text=scrub_text,
+    )
+    missing_ids = df_ids[
+        ~df_ids["interaction_id"].isin(df_calls["interaction_id"].unique())
+    ]
+    return df_calls, missing_ids
+
+
+def join_with_ids(df_all, df_ids):
+    """Split transcripts into the calls matched in the Talkdesk export and the export
+    ids with no transcript.
+
+    Returns (df_calls, missing_ids).
+    """
+    # Step 1: Extract interaction_ids that are in 'both'
+    both_ids = df_all[df_all["_merge"] == "both"]["interaction_id"].unique()
+
+    # Step 2: Find interaction_ids in df_ids that are not in both_ids
+    missing_ids = df_ids[~df_ids["interaction_id"].isin(both_ids)]
+
+    df_calls = df_all[df_all["_merge"] == "both"]
+    return df_calls, missing_ids
+
 
+def main(
+    ids_path=IDS_PATH,
+    zip_files_dir=TRANSCRIPTION_FOLDER,
+    output_folder=OUTPUT_FOLDER,
+    export_csv=False,
+    scrub_text=False,
+):
+    df_ids = pd.read_csv(ids_path)
 
-# Step 0: Combine all dfs into one
-df_all = pd.concat(all_dfs)
-print(df_all["interaction_id"].drop_duplicates().shape)
+    # Parse each file in the zip files, keeping only the rows of interactions in the ids
+    # file (and scrubbing their message text on the way if asked)
+    df_calls, missing_ids = read_and_join_with_ids(
+        list_zip_files(zip_files_dir), df_ids, scrub_text=scrub_text
+    )
+    # an interaction can be spread over several files; keep its rows together so the
+    # export can be converted in chunks (see
+    # ConversationDataTransformer.iter_interaction_chunks)
+    df_calls = df_calls.sort_values("interaction_id", kind="stable")
+    print(df_calls["interaction_id"].drop_duplicates().shape)
 
-# Step 1: Extract interaction_ids that are in 'both'
-both_ids = df_all[df_all["_merge"] == "both"]["interaction_id"].unique()
+    # Step 3: Save missing_ids to csv
+    missing_ids.to_csv(output_folder / "missing_ids.csv")
 
-# Step 2: Find interaction_ids in df_ids that are not in both_ids
-missing_ids = df_ids[~df_ids["interaction_id"].isin(both_ids)]
+    # Step 4: Save df_all as a parquet dataset partitioned by interaction date
+    write_calls_dataset(df_calls, output_folder / "all_calls.parquet")
+    if export_csv:
+        df_calls.to_csv(output_folder / "all_calls.csv")
 
-# Step 3: Save missing_ids to csv
-missing_ids.to_csv(here() / "data/insights/outs/missing_ids.csv")
 
-# Step 4: Save df_all to csv
-df_calls = df_all[df_all["_merge"] == "both"]
-df_calls.to_csv(here() / "data/insights/outs/all_calls.csv")
+if __name__ == "__main__":
+    main()
 
 
 #### Analysis / Bug fixing
@@ -11,19 +11,28 @@ from langchain.llms import VertexAI
 from pydantic import BaseModel
 from vertexai.language_models import TextGenerationModel
 
+from llm_experiments.prompt_cache import default_prompt_cache
 from llm_experiments.utils import here
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = str(here() / 'motorway-genai-ccebd34bd403.json')
 
 # LLM model
-llm = VertexAI(
-    model_name="text-bison@001",
-    max_output_tokens=1024,
-    temperature=0.3,
-    top_p=0.8,
-    top_k=40,
-    verbose=True,
-)
+MODEL_NAME = "text-bison@001"
+LLM_PARAMETERS = {
+    "max_output_tokens": 1024,
+    "temperature": 0.3,
+    "top_p": 0.8,
+    "top_k": 40,
+}
+llm = VertexAI(model_name=MODEL_NAME, verbose=True, **LLM_PARAMETERS)
+
+
+# Drafts are sampled at a non-zero temperature, but are still cached so the same
+# email always gets the same draft, and validation sees the draft on screen
+def cached_llm(prompt):
+    return default_prompt_cache(cache_nonzero_temperature=True).get_or_compute(
+        MODEL_NAME, LLM_PARAMETERS, prompt, lambda: llm(prompt)
+    )
 
 
 def form_assistant_prompt(seller_email):
@@ -109,9 +118,12 @@ There was 3 men who cam to collect it and it felt really intimidating and pressu
 if 'result' not in st.session_state:
     st.session_state['result'] = None
 
-if st.button('Generate Response') or st.session_state.result is not None:
-    st.session_state.result = llm(form_assistant_prompt(seller_email))
+# the model is only called when the button is pressed; other reruns show the stored
+# draft, which is what Validate Response checks against
+if st.button('Generate Response'):
+    st.session_state.result = cached_llm(form_assistant_prompt(seller_email))
 
+if st.session_state.result is not None:
     sections = st.session_state.result.split('****')
     for section in sections[1:]:
         title, _, rest = section.partition(':')
@@ -124,8 +136,11 @@ st.subheader('Check Response:')
 draft_response = st.text_area('Draft your response here')
 
 if st.button('Validate Response'):
+    if st.session_state.result is None:
+        st.warning('Generate a response before validating a draft')
+        st.stop()
     summary_and_context, _, _ = st.session_state.result.rpartition('****')
-    response = llm(form_validation_prompt(summary_and_context, draft_response))
+    response = cached_llm(form_validation_prompt(summary_and_context, draft_response))
     title, _, rest = response.partition(':')
     st.subheader(title)
     st.text_area('', rest)
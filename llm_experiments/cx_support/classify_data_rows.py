@@ -1,23 +1,77 @@
+import json
 import os
+import random
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import pandas as pd
-import vertexai
-from vertexai.language_models import TextGenerationModel
+from loguru import logger
 
+from llm_experiments.prompt_cache import default_prompt_cache
+from llm_experiments.rate_limit import TokenBucket
 from llm_experiments.utils import here
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = str(here() / 'motorway-genai-ccebd34bd403.json')
 
+# rough prompt size in tokens for the tokens-per-minute quota, PaLM averages about 4
+# characters per token
+CHARS_PER_TOKEN = 4
+
+
+def is_rate_limited(error):
+    """True for a quota error: google.api_core's ResourceExhausted, or anything else
+    reporting a 429."""
+    return (
+        getattr(error, 'code', None) == 429
+        or getattr(error, 'status_code', None) == 429
+    )
+
+
 class TextGenerator:
-    def __init__(self, project, location, model_name, rate_limit):
+    """Runs prompts through a Vertex AI text model.
+
+    `generate_text_for_dataframe` sends up to `max_workers` requests at once, kept under
+    `requests_per_minute` and `tokens_per_minute` by token buckets (by default
+    `rate_limit` requests per second), retries 429s with jittered exponential backoff,
+    and returns results in row order. Pass `model` to use any object with a
+    vertexai-style `predict(prompt, **parameters)`, and `cache` (a `PromptCache`) to
+    reuse completions of prompts seen before.
+    """
+
+    def __init__(
+        self,
+        project,
+        location,
+        model_name,
+        rate_limit,
+        model=None,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        max_workers=8,
+        max_retries=5,
+        backoff_seconds=1.0,
+        sleep=time.sleep,
+        cache=None,
+    ):
         self.project = project
         self.location = location
         self.model_name = model_name
         self.rate_limit = rate_limit
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self._sleep = sleep
+        self.cache = cache
+
+        if model is None:
+            import vertexai
+            from vertexai.language_models import TextGenerationModel
 
-        vertexai.init(project=self.project, location=self.location)
-        self.model = TextGenerationModel.from_pretrained(self.model_name)
+            vertexai.init(project=self.project, location=self.location)
+            model = TextGenerationModel.from_pretrained(self.model_name)
+        self.model = model
 
         self.parameters = {
             "temperature": 0.2,
@@ -26,25 +80,85 @@ class TextGenerator:
             "top_k": 40
         }
 
-    def generate_text(self, prompt):
-        response = self.model.predict(prompt, **self.parameters)
-        return response.text
-
-    def generate_text_for_dataframe(self, df):
-        results = []
-        for index, row in df.iterrows():
-            prompt = row['prompt']
-            generated_text = self.generate_text(prompt)
-            results.append(generated_text)
+        self.request_bucket = TokenBucket.per_minute(
+            requests_per_minute or rate_limit * 60
+        )
+        self.token_bucket = (
+            TokenBucket.per_minute(tokens_per_minute) if tokens_per_minute else None
+        )
+        self.retries = 0
+        self.deduplicated = 0
 
-            if index % self.rate_limit == 0 and index != 0:
-                time.sleep(1)
+    def estimate_tokens(self, prompt):
+        return len(prompt) // CHARS_PER_TOKEN + self.parameters["max_output_tokens"]
 
-        return results
+    def _predict(self, prompt):
+        response = self.model.predict(prompt, **self.parameters)
+        return response.text
 
+    def generate_text(self, prompt):
+        """Completion for `prompt`, from the cache if there is one, otherwise from the
+        model within the rate limits (cache hits don't use up any of the quota)."""
+        if self.cache is None:
+            return self._predict_with_retries(prompt)
+        return self.cache.get_or_compute(
+            self.model_name,
+            self.parameters,
+            prompt,
+            lambda: self._predict_with_retries(prompt),
+        )
+
+    def _predict_with_retries(self, prompt):
+        for attempt in range(self.max_retries + 1):
+            self.request_bucket.acquire()
+            if self.token_bucket is not None:
+                self.token_bucket.acquire(
+                    min(self.estimate_tokens(prompt), self.token_bucket.capacity)
+                )
+            try:
+                return self._predict(prompt)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                # full jitter, so workers throttled together don't retry together
+                wait = random.uniform(0, self.backoff_seconds * 2 ** attempt)
+                logger.warning(
+                    f'Rate limited, retrying in {wait:.1f}s '
+                    f'(attempt {attempt + 1}/{self.max_retries})'
+                )
+                self._sleep(wait)
+
+    def generate_text_batch(self, prompts):
+        """Generate text for every prompt concurrently, returning results in the order
+        of `prompts`.
+
+        Identical prompts are only sent once.
+        """
+        unique_prompts = list(dict.fromkeys(prompts))
+        self.deduplicated += len(prompts) - len(unique_prompts)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = dict(
+                zip(unique_prompts, executor.map(self.generate_text, unique_prompts))
+            )
+        return [results[prompt] for prompt in prompts]
 
-def make_prompt(example):
-    return f"""You will classify messages between customer service agents for a company called Motorway, and their customers, and internal communications. Given the following pieces of text, classify them as either 'Customer Related - From Customer', 'Customer Related - From Agent', or 'Internal'. 'Customer Related - From Customer' indicates the message is from a customer to an agent. 'Customer Related - From Agent' indicates the message is from the agent to the customer. 'Internal' refers to messages such as notes, subject lines, and other internal communications from Agent to Agent that do not involve the customer.
+    def generate_text_for_dataframe(self, df):
+        return self.generate_text_batch(df['prompt'].tolist())
+
+
+# the fixed few-shot instructions every classification prompt starts with, built once
+PROMPT_INSTRUCTIONS = (
+    'You will classify messages between customer service agents for a company called '
+    'Motorway, and their customers, and internal communications. Given the following '
+    "pieces of text, classify them as either 'Customer Related - From Customer', "
+    "'Customer Related - From Agent', or 'Internal'. "
+    "'Customer Related - From Customer' indicates the message is from a customer to an "
+    "agent. 'Customer Related - From Agent' indicates the message is from the agent to "
+    "the customer. 'Internal' refers to messages such as notes, subject lines, and "
+    'other internal communications from Agent to Agent that do not involve the '
+    'customer.'
+    """
 
     Examples:
 
@@ -62,7 +176,11 @@ def make_prompt(example):
 
     Note: Make your classifications based on the content and context of the message, not on the specific format or wording. If a message is primarily about an internal matter but happens to mention a customer, classify it as 'Internal'. If a message is primarily addressing a customer or a customer's needs, classify it as 'Customer Related'.
 
-    The real message will be separated from the prompt with the delimiter: ####
+    """
+)
+PROMPT_PREAMBLE = (
+    PROMPT_INSTRUCTIONS
+    + """The real message will be separated from the prompt with the delimiter: ####
 
     Respond only with the classification: "Customer Related - From Customer", "Internal", or "Customer Related - From Agent"
 
@@ -70,7 +188,9 @@ def make_prompt(example):
 
     ####
 
-    {example}
+    """
+)
+PROMPT_SUFFIX = """
 
     ####
 
@@ -78,27 +198,311 @@ def make_prompt(example):
     """
 
 
-##
+def make_prompt(example):
+    return f"{PROMPT_PREAMBLE}{example}{PROMPT_SUFFIX}"
+
+
+CLASSIFICATIONS = (
+    "Customer Related - From Customer",
+    "Customer Related - From Agent",
+    "Internal",
+)
 
+BATCH_PROMPT_PREAMBLE = PROMPT_INSTRUCTIONS + (
+    'Each real message is numbered and separated from the prompt and the other '
+    'messages with the delimiter: ####\n'
+    '\n'
+    '    Respond with one line per message, in the form "<number>: <classification>", '
+    'where the classification is "Customer Related - From Customer", "Internal", or '
+    '"Customer Related - From Agent"\n'
+    '\n'
+    '    Messages to classify:\n'
+    '\n'
+    '    '
+)
+BATCH_PROMPT_SUFFIX = """####
 
-# df = pd.read_csv('prompts.csv')
+    Classifications:
+    """
 
-generator = TextGenerator(
-    project="motorway-genai",
-    location="us-central1",
-    model_name="text-bison@001",
-    rate_limit=100
+# "1: Internal", "2. **Internal**", "- 3) Classification: 'Internal'" ...
+BATCH_LINE_PATTERN = re.compile(
+    r'^[\s*#"\'-]*(\d+)[\s*]*[:.)-]\s*(?:classification:\s*)?["\'*]*(.+?)["\'*.\s]*$',
+    re.IGNORECASE | re.MULTILINE,
 )
 
-##
-df = pd.read_csv('data/bq-results-20230728-135043-1690552255754.csv')
 
-df = df.head(10)
-df['prompt'] = df['body'].apply(make_prompt)
-# filter out where the df column channel is = side_conversation
-df = df[df['channel'] != 'side_conversation']
+def make_batch_prompt(examples):
+    """One prompt classifying all `examples`, numbered from 1."""
+    messages = ''.join(
+        f'####\n\n    {number}: {example}\n\n    '
+        for number, example in enumerate(examples, 1)
+    )
+    return f"{BATCH_PROMPT_PREAMBLE}{messages}{BATCH_PROMPT_SUFFIX}"
+
+
+def _normalise_label(label):
+    return re.sub(r'[^a-z]+', ' ', label.lower()).strip()
 
 
-print('calling llm')
-results = generator.generate_text_for_dataframe(df)
+_LABELS = {_normalise_label(label): label for label in CLASSIFICATIONS}
 
+
+def parse_batch_classifications(text, count):
+    """Classifications for messages 1..`count` from a response to `make_batch_prompt`.
+
+    Returns None unless every message got exactly one recognised classification.
+    """
+    classifications = {}
+    for match in BATCH_LINE_PATTERN.finditer(text):
+        number = int(match.group(1))
+        label = _LABELS.get(_normalise_label(match.group(2)))
+        if label is None or not 1 <= number <= count or number in classifications:
+            return None
+        classifications[number] = label
+    if len(classifications) != count:
+        return None
+    return [classifications[number] for number in range(1, count + 1)]
+
+
+def classify_batched(generator, examples, messages_per_prompt=10):
+    """Classify `examples` with `messages_per_prompt` messages per request, in order.
+
+    Groups whose response can't be parsed are re-classified one message per request.
+    Keep `messages_per_prompt` small enough for the answers to fit in
+    `max_output_tokens`.
+    """
+    groups = [
+        examples[start : start + messages_per_prompt]
+        for start in range(0, len(examples), messages_per_prompt)
+    ]
+    responses = generator.generate_text_batch(
+        [make_batch_prompt(group) for group in groups]
+    )
+
+    classifications = []
+    fallback_positions = []
+    for group, response in zip(groups, responses):
+        parsed = parse_batch_classifications(response, len(group))
+        if parsed is None:
+            logger.warning(
+                f'Could not parse a batch of {len(group)} classifications, '
+                'classifying them one by one'
+            )
+            fallback_positions.extend(
+                range(len(classifications), len(classifications) + len(group))
+            )
+            parsed = [None] * len(group)
+        classifications.extend(parsed)
+
+    if fallback_positions:
+        fallback_results = generator.generate_text_batch(
+            [make_prompt(examples[i]) for i in fallback_positions]
+        )
+        for position, classification in zip(fallback_positions, fallback_results):
+            classifications[position] = classification
+    return classifications
+
+
+class PromptSizeStats:
+    """Counts rows and characters sent for a classification run.
+
+    Prompts are split into the fixed template (preamble and suffix) and the message
+    payload, so the cost of the template and the savings from deduplication can be
+    reported per run.
+    """
+
+    def __init__(self, template_chars, sent_template_chars=None):
+        self.template_chars = template_chars
+        # template chars per message actually sent, lower when several messages share
+        # a prompt
+        self.sent_template_chars = (
+            template_chars if sent_template_chars is None else sent_template_chars
+        )
+        self.rows = 0
+        self.sent = 0
+        self.payload_chars = 0
+        self.sent_payload_chars = 0
+
+    def add(self, payload_lengths, sent_payload_lengths):
+        self.rows += len(payload_lengths)
+        self.payload_chars += sum(payload_lengths)
+        self.sent += len(sent_payload_lengths)
+        self.sent_payload_chars += sum(sent_payload_lengths)
+
+    @property
+    def naive_chars(self):
+        """Characters that one prompt per row would have sent."""
+        return self.rows * self.template_chars + self.payload_chars
+
+    @property
+    def sent_chars(self):
+        return round(self.sent * self.sent_template_chars) + self.sent_payload_chars
+
+    def summary(self):
+        saved = 1 - self.sent_chars / self.naive_chars if self.naive_chars else 0.0
+        template_share = (
+            self.sent * self.sent_template_chars / self.sent_chars
+            if self.sent_chars
+            else 0.0
+        )
+        return (
+            f'{self.rows} rows, {self.sent} prompts sent '
+            f'({self.rows - self.sent} duplicates), '
+            f'{self.sent_chars} of {self.naive_chars} chars sent ({saved:.0%} saved), '
+            f'template is {template_share:.0%} of the chars sent'
+        )
+
+
+class ClassificationResults:
+    """Append-only JSONL of `{"key": row_key, "classification": text}`, one line per
+    classified row.
+
+    Results are flushed after every batch, so a crashed run only loses the batch in
+    flight, and a restarted run skips the keys already in the file.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = Path(output_path)
+        self.classifications = {}
+        if self.output_path.exists():
+            with open(self.output_path) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a line cut short by a crash mid-write, that row is
+                        # classified again
+                        continue
+                    self.classifications[record['key']] = record['classification']
+
+    def __len__(self):
+        return len(self.classifications)
+
+    def __contains__(self, key):
+        return key in self.classifications
+
+    def append(self, keys, classifications):
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.output_path, 'a') as file:
+            for key, classification in zip(keys, classifications):
+                file.write(
+                    json.dumps({'key': key, 'classification': classification}) + '\n'
+                )
+                self.classifications[key] = classification
+
+
+def classify_csv(
+    generator,
+    input_csv_path,
+    output_path,
+    text_column='body',
+    key_column=None,
+    row_filter=None,
+    batch_size=500,
+    prompt_fn=make_prompt,
+    stats=None,
+    messages_per_prompt=1,
+):
+    """Classify the `text_column` of a CSV in batches, resumably, returning the
+    `ClassificationResults`.
+
+    Rows are keyed by `key_column`, or by their position in the CSV if it's None, so
+    re-running with the same input and `output_path` only classifies rows missing from
+    the output. `row_filter` optionally takes a chunk DataFrame and returns the rows to
+    classify.
+
+    Each distinct message is only sent once per run (Zendesk macros repeat a lot), and
+    prompt sizes are tallied in `stats`, a `PromptSizeStats`. With
+    `messages_per_prompt` > 1 messages are packed into numbered prompts by
+    `classify_batched`, and `prompt_fn` is not used.
+    """
+    results = ClassificationResults(output_path)
+    total_rows = len(pd.read_csv(input_csv_path, usecols=[key_column or text_column]))
+    logger.info(
+        f'{len(results)} rows already classified in {output_path}, '
+        f'{total_rows} rows in {input_csv_path}'
+    )
+    if messages_per_prompt > 1:
+        def classify(texts):
+            return classify_batched(generator, texts, messages_per_prompt)
+        sent_template_chars = (
+            len(make_batch_prompt([''] * messages_per_prompt)) / messages_per_prompt
+        )
+    else:
+        def classify(texts):
+            return generator.generate_text_batch([prompt_fn(text) for text in texts])
+        sent_template_chars = None
+    if stats is None:
+        stats = PromptSizeStats(len(prompt_fn('')), sent_template_chars)
+
+    start = time.perf_counter()
+    rows_seen = 0
+    classified = 0
+    classifications_by_text = {}
+    for chunk in pd.read_csv(input_csv_path, chunksize=batch_size):
+        if key_column is None:
+            keys = pd.Series(
+                range(rows_seen, rows_seen + len(chunk)), index=chunk.index
+            )
+        else:
+            keys = chunk[key_column].astype(str)
+        rows_seen += len(chunk)
+
+        chunk = chunk[~keys.isin(results.classifications.keys())]
+        if row_filter is not None:
+            chunk = row_filter(chunk)
+        if chunk.empty:
+            continue
+
+        texts = chunk[text_column].map(str).tolist()
+        new_texts = [
+            text
+            for text in dict.fromkeys(texts)
+            if text not in classifications_by_text
+        ]
+        classifications_by_text.update(
+            zip(new_texts, classify(new_texts))
+        )
+        results.append(
+            keys[chunk.index].tolist(),
+            [classifications_by_text[text] for text in texts],
+        )
+        stats.add([len(text) for text in texts], [len(text) for text in new_texts])
+        classified += len(chunk)
+
+        elapsed = time.perf_counter() - start
+        rows_per_second = classified / elapsed
+        eta_seconds = (total_rows - rows_seen) / rows_per_second
+        logger.info(
+            f'{rows_seen}/{total_rows} rows, classified {classified} this run at '
+            f'{rows_per_second:.1f} rows/s, ETA {eta_seconds / 60:.1f} min'
+        )
+    logger.info(stats.summary())
+    return results
+
+
+if __name__ == "__main__":
+    ##
+
+    # df = pd.read_csv('prompts.csv')
+
+    generator = TextGenerator(
+        project="motorway-genai",
+        location="us-central1",
+        model_name="text-bison@001",
+        rate_limit=100,
+        # classification is near-deterministic at temperature 0.2, so reruns reuse
+        # earlier labels
+        cache=default_prompt_cache(cache_nonzero_temperature=True),
+    )
+
+    ##
+    print('calling llm')
+    # filter out where the df column channel is = side_conversation
+    results = classify_csv(
+        generator,
+        'data/bq-results-20230728-135043-1690552255754.csv',
+        'data/bq-results-20230728-135043-1690552255754_classified.jsonl',
+        row_filter=lambda df: df[df['channel'] != 'side_conversation'],
+    )
@@ -1,6 +1,14 @@
+import heapq
 import json
+import os
 import re
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
 
@@ -9,7 +17,7 @@ def clean_data(df):
     df = df.sort_values(['conversation_id', 'created_at'])
 
     # Replace non-finite 'conversation_id' values with 0
-    df['conversation_id'].fillna(0, inplace=True)
+    df['conversation_id'] = df['conversation_id'].fillna(0)
 
     # Convert the 'conversation_id' column to integer type
     df['conversation_id'] = df['conversation_id'].astype(int)
@@ -20,73 +28,140 @@ def clean_data(df):
     # Filter the DataFrame to keep only the rows where 'sender' is not equal to 'prev_sender'
     df = df[df['sender'] != df['prev_sender']]
 
-    df = df.sort_values('conversation_id')
+    # stable, so rows keep their 'created_at' order within each conversation
+    df = df.sort_values('conversation_id', kind='stable')
 
     return df
 
 def is_consecutive(s):
     # Define a function to check if a sequence is consecutive
-    return (s == range(s.min(), s.max() + 1)).all()
-def clean_conversation_ids(df):
+    return len(s) == s.max() - s.min() + 1 and (s == range(s.min(), s.max() + 1)).all()
+
+
+def non_consecutive_conversation_ids(df):
+    # A conversation's 'id's are consecutive (min, min + 1, ..., max in row order)
+    # exactly when every step between neighbouring rows of the conversation is 1, so
+    # check that in one vectorized pass rather than calling is_consecutive per
+    # conversation
+    conversations = df.groupby('conversation_id', sort=False)
+    step = conversations['id'].diff()
+    is_first = conversations.cumcount() == 0
+    broken = ~is_first & (step != 1) & df['conversation_id'].notna()
+    return df.loc[broken, 'conversation_id'].unique()
+
 
-    # Group the DataFrame by 'conversation_id' and check if 'id' is consecutive in each group
-    consecutive_ids = df.groupby('conversation_id')['id'].apply(is_consecutive)
+def clean_conversation_ids(df):
 
     # Get the 'conversation_id' values where 'id' is not consecutive
-    non_consecutive_ids = consecutive_ids[~consecutive_ids].index
+    non_consecutive_ids = non_consecutive_conversation_ids(df)
+    is_dropped = df['conversation_id'].isin(non_consecutive_ids)
 
     # Calculate the number of rows to be dropped
-    rows_to_drop = df[df['conversation_id'].isin(non_consecutive_ids)].shape[0]
+    rows_to_drop = int(is_dropped.sum())
 
     # Print the number of rows to be dropped and the percentage
     print(f'Number of rows to be dropped: {rows_to_drop} ({(rows_to_drop / df.shape[0]) * 100:.2f}%)')
 
     # Remove the rows where 'conversation_id' is in 'non_consecutive_ids'
-    df = df[~df['conversation_id'].isin(non_consecutive_ids)]
+    df = df[~is_dropped]
 
     return df
 
 
-def convert_to_jsonl(df_greater_than_2):
-    # Rerun the above cell with 'Agent: ' appended to the end of each 'input_text'
-
-    # 1. Sort the DataFrame by 'conversation_id' and 'id' in descending order
-    df_sorted = df_greater_than_2.sort_values(['conversation_id', 'id'], ascending=[True, False])
-
-    # Replace NaN in 'sender' and 'content' columns with empty strings
-    df_sorted[['sender', 'content']] = df_sorted[['sender', 'content']].fillna('')
-
-    # 2. Group the DataFrame by 'conversation_id' and concatenate the 'content' strings within each group
-    grouped = df_sorted.groupby('conversation_id')[['sender', 'content']].apply(
-        lambda x: '||'.join(x['sender'] + ": " + x['content']))
-
-    # Initialize an empty list to store the output
-    output = []
-
-    # Iterate over each group
-    for conversation_id, conversation in zip(grouped.index, grouped.values):
-        # Split the conversation into messages and reverse the order
-        messages = conversation.split('||')[::-1]
-        # Skip if the first message is from an agent
-        if messages[0].startswith('Agent:'):
+# URLs and Zendesk '<~~...~~>' placeholders, stripped from the fine-tuning text
+URL_PATTERN = re.compile(
+    r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
+)
+ANGLE_BRACKET_PATTERN = re.compile(r'<~~.*?~~>', re.DOTALL)
+
+
+def strip_unwanted_text(text):
+    return ANGLE_BRACKET_PATTERN.sub('', URL_PATTERN.sub('', text))
+
+
+def iter_training_records(
+    df, max_context_messages=None, strip=True, text_scrubber=None
+):
+    """
+    Yields a {'input_text', 'output_text'} record for every agent message, conversation
+    by conversation.
+
+    'input_text' is the conversation so far followed by ' Agent:', and 'output_text' is
+    the agent's reply. Conversations starting with an agent message are skipped. With
+    `max_context_messages` only that many preceding messages are kept in 'input_text',
+    so building the prefixes is linear in the conversation length rather than
+    quadratic. With `strip` URLs and '<~~...~~>' are removed from each record. With a
+    `text_scrubber` (an llm_experiments.scrub.TextScrubber) PII is scrubbed from the
+    message content first.
+    """
+    for _, record in _iter_conversation_records(
+        df, max_context_messages, strip, text_scrubber
+    ):
+        yield record
+
+
+def _iter_conversation_records(
+    df, max_context_messages=None, strip=True, text_scrubber=None
+):
+    # (conversation_id, record) pairs in 'conversation_id' order
+    df_sorted = df[df['conversation_id'].notna()].sort_values(
+        ['conversation_id', 'id'], kind='stable'
+    )
+    if text_scrubber is not None:
+        if strip:
+            # strip first, otherwise the scrubber turns URLs into placeholders that are
+            # no longer stripped
+            df_sorted = df_sorted.assign(
+                content=df_sorted['content'].map(
+                    strip_unwanted_text, na_action='ignore'
+                )
+            )
+        df_sorted = text_scrubber.scrub_columns(df_sorted, ['content'])
+    messages = (
+        df_sorted['sender'].fillna('') + ': ' + df_sorted['content'].fillna('')
+    ).to_numpy()
+    conversation_ids = df_sorted['conversation_id'].to_numpy()
+    boundaries = np.flatnonzero(conversation_ids[1:] != conversation_ids[:-1]) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(messages)]])
+
+    for start, end in zip(starts, ends):
+        if end == start or messages[start].startswith('Agent:'):
             continue
-
-        # Initialize an empty list to store the current conversation
-        current_conversation = []
-        for message in messages:
-            # Add the message to the current conversation
-            current_conversation.append(message)
+        context = deque(maxlen=max_context_messages)
+        for message in messages[start:end]:
             if message.startswith('Agent:'):
-                # If the current message is from an agent, add a record to the output
                 record = {
-                    'input_text': ' '.join(current_conversation[:-1]) + ' Agent:',
-                    # All messages before the last one and 'Agent:'
-                    'output_text': current_conversation[-1].split(": ", 1)[1]  # The last message, without the sender
+                    'input_text': ' '.join(context) + ' Agent:',
+                    'output_text': message.split(': ', 1)[1],
                 }
-                output.append(record)
-
-    # Serialize the list of dictionaries into the jsonl format
-    jsonl_output = '\n'.join(json.dumps(record) for record in output)
+                if strip:
+                    record = {
+                        key: strip_unwanted_text(value) for key, value in record.items()
+                    }
+                yield conversation_ids[start], record
+            context.append(message)
+
+
+def write_jsonl(records, output_path):
+    """Writes records to `output_path` one JSON line at a time, returning the number
+    written."""
+    count = 0
+    with open(output_path, 'w') as file:
+        for record in records:
+            file.write(json.dumps(record) + '\n')
+            count += 1
+    return count
+
+
+def convert_to_jsonl(df_greater_than_2, text_scrubber=None):
+    # Rerun the above cell with 'Agent: ' appended to the end of each 'input_text'
+    # Builds the whole output in memory, use
+    # write_jsonl(iter_training_records(df), path) for large exports
+    records = iter_training_records(
+        df_greater_than_2, strip=False, text_scrubber=text_scrubber
+    )
+    jsonl_output = '\n'.join(json.dumps(record) for record in records)
 
     # Print the first 500 characters of the output to check
     print(jsonl_output[:500])
@@ -94,6 +169,137 @@ def convert_to_jsonl(df_greater_than_2):
     return jsonl_output
 
 
+def clean_for_training(df):
+    # clean -> drop conversations with missing messages -> keep conversations with more
+    # than one message
+    df = clean_data(df)
+    df = clean_conversation_ids(df)
+    return df[df.groupby('conversation_id')['conversation_id'].transform('size') > 1]
+
+
+def shard_of(conversation_ids, num_shards):
+    # Conversations without an id are cleaned into conversation 0, so they hash with it
+    conversation_ids = conversation_ids.fillna(0).astype('int64').to_numpy()
+    return pd.util.hash_array(conversation_ids) % num_shards
+
+
+def split_into_shards(input_csv_path, shard_folder, num_shards, chunksize=1000000):
+    # Stream the export once, writing each chunk's rows to the parquet folder of their
+    # conversation's shard
+    shard_folders = [
+        Path(shard_folder) / f'shard-{shard:05d}' for shard in range(num_shards)
+    ]
+    for folder in shard_folders:
+        folder.mkdir(parents=True, exist_ok=True)
+    for chunk_number, chunk in enumerate(
+        pd.read_csv(input_csv_path, chunksize=chunksize)
+    ):
+        for shard, df_shard in chunk.groupby(
+            shard_of(chunk['conversation_id'], num_shards)
+        ):
+            df_shard.to_parquet(
+                shard_folders[shard] / f'chunk-{chunk_number:05d}.parquet', index=False
+            )
+    return shard_folders
+
+
+def _build_shard(shard_folder, output_path, max_context_messages, scrub_text=False):
+    # Runs in a worker process: writes 'conversation_id<TAB>record' lines so shards can
+    # be merged in order
+    chunk_paths = sorted(Path(shard_folder).glob('*.parquet'))
+    if not chunk_paths:
+        Path(output_path).touch()
+        return
+    df = clean_for_training(
+        pd.concat([pd.read_parquet(path) for path in chunk_paths], ignore_index=True)
+    )
+    text_scrubber = None
+    if scrub_text:
+        from llm_experiments.scrub import ScrubCache, TextScrubber
+
+        text_scrubber = TextScrubber(cache=ScrubCache())
+    with open(output_path, 'w') as file:
+        for conversation_id, record in _iter_conversation_records(
+            df, max_context_messages, text_scrubber=text_scrubber
+        ):
+            file.write(f'{conversation_id}\t{json.dumps(record)}\n')
+
+
+def _read_shard_output(output_path):
+    with open(output_path) as file:
+        for line in file:
+            conversation_id, record = line.split('\t', 1)
+            yield int(conversation_id), record
+
+
+def merge_shard_outputs(shard_output_paths, output_path):
+    # Merge by conversation_id, giving the same file as a single-process build whatever
+    # the shard count
+    count = 0
+    with open(output_path, 'w') as file:
+        for _, record in heapq.merge(
+            *map(_read_shard_output, shard_output_paths), key=lambda item: item[0]
+        ):
+            file.write(record)
+            count += 1
+    return count
+
+
+def build_dataset_sharded(
+    input_csv_path,
+    output_path,
+    num_shards=None,
+    max_workers=None,
+    work_folder=None,
+    chunksize=1000000,
+    max_context_messages=None,
+    scrub_text=False,
+):
+    """
+    Builds the fine-tuning JSONL for a large export on all cores.
+
+    Rows are partitioned into `num_shards` shards by a hash of 'conversation_id', so
+    every conversation is in exactly one shard. Each shard is cleaned and converted to
+    records in a worker process, and the shard outputs are merged by 'conversation_id'
+    into `output_path`. With `scrub_text` PII is scrubbed from the messages in the same
+    workers. Intermediate files go to `work_folder`, by default a temporary folder that
+    is deleted afterwards; a folder passed in is kept. Returns the number of records
+    written.
+    """
+    max_workers = max_workers or os.cpu_count()
+    num_shards = num_shards or 4 * max_workers
+    created_work_folder = work_folder is None
+    work_folder = Path(
+        work_folder or tempfile.mkdtemp(prefix='data_engineering_shards_')
+    )
+    input_folder = work_folder / 'input'
+    shard_output_paths = [
+        work_folder / f'shard-{shard:05d}.jsonl' for shard in range(num_shards)
+    ]
+    try:
+        shard_folders = split_into_shards(
+            input_csv_path, input_folder, num_shards, chunksize
+        )
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(
+                executor.map(
+                    _build_shard,
+                    shard_folders,
+                    shard_output_paths,
+                    [max_context_messages] * num_shards,
+                    [scrub_text] * num_shards,
+                )
+            )
+        return merge_shard_outputs(shard_output_paths, output_path)
+    finally:
+        if created_work_folder:
+            shutil.rmtree(work_folder, ignore_errors=True)
+        else:
+            shutil.rmtree(input_folder, ignore_errors=True)
+            for shard_output_path in shard_output_paths:
+                shard_output_path.unlink(missing_ok=True)
+
+
 def test_is_consequtive(df=None):
     # Test the function
     if df is None:  # noqa
@@ -134,11 +340,11 @@ if __name__ == '__main__':
     df_greater_than_2 = df.merge(df.value_counts('conversation_id')[df.value_counts('conversation_id') > 1],
                                  how='right', left_on='conversation_id', right_index=True)
 
-    jsonl_output = convert_to_jsonl(df_greater_than_2)
-
-    # strip urls
-    url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-    pattern_within_angle_brackets = r'<~~.*?~~>'
-    jsonl_output1 = re.sub(url_pattern, '', jsonl_output)
-    jsonl_output2 = re.sub(pattern_within_angle_brackets, '', jsonl_output1)
+    # strip urls and write one record per agent message
+    write_jsonl(
+        iter_training_records(df_greater_than_2), 'data/fine_tuning_dataset.jsonl'
+    )
 
+    # or, for multi-GB exports, the same dataset built shard by shard on every core
+    # build_dataset_sharded('/Users/benjaminjones/Downloads/bquxjob_5fb08910_189997c7634.csv',
+    #                       'data/fine_tuning_dataset.jsonl')
@@ -3,6 +3,19 @@ import re
 
 import pandas as pd
 
+from llm_experiments.cx_support.data_engineering import (
+    URL_PATTERN,
+    iter_training_records,
+    non_consecutive_conversation_ids,
+    write_jsonl,
+)
+
+# data_engineering.ANGLE_BRACKET_PATTERN matches across newlines, which is right for a
+# single message but not for a whole JSONL string: a stray '<~~' in one record and
+# '~~>' in a later one would delete every record in between. JSON escapes newlines,
+# so without re.DOTALL a match stays within one record.
+JSONL_ANGLE_BRACKET_PATTERN = re.compile(r'<~~.*?~~>')
+
 
 def clean_data(df):
     """
@@ -20,43 +33,35 @@ def clean_data(df):
 
 def is_consecutive(s):
     """Checks if a sequence is consecutive"""
-    return (s == range(s.min(), s.max() + 1)).all()
+    return len(s) == s.max() - s.min() + 1 and (s == range(s.min(), s.max() + 1)).all()
 
 def clean_conversation_ids(df):
     """
     Checks whether the 'id' within each conversation (grouped by 'conversation_id') are consecutive.
     Drops the rows where 'id' is not consecutive and prints the number of rows that were dropped.
+    Vectorized: a conversation is consecutive when every step between its neighbouring
+    'id's is 1.
     """
-    consecutive_ids = df.groupby('conversation_id')['id'].apply(is_consecutive)
-    non_consecutive_ids = consecutive_ids[~consecutive_ids].index
-    rows_to_drop = df[df['conversation_id'].isin(non_consecutive_ids)].shape[0]
+    non_consecutive_ids = non_consecutive_conversation_ids(df)
+    is_dropped = df['conversation_id'].isin(non_consecutive_ids)
+    rows_to_drop = int(is_dropped.sum())
     print(f'Number of rows to be dropped: {rows_to_drop} ({(rows_to_drop / df.shape[0]) * 100:.2f}%)')
-    df = df[~df['conversation_id'].isin(non_consecutive_ids)]
+    df = df[~is_dropped]
     return df
 
-def convert_to_jsonl(df_greater_than_2):
+
+def convert_to_jsonl(df_greater_than_2, text_scrubber=None):
     """
     Converts the DataFrame into a JSONL format where each JSON object represents a conversation.
+    Builds the whole output in memory, use
+    `write_jsonl(iter_training_records(df), path)` for large exports. With a
+    `text_scrubber` (an llm_experiments.scrub.TextScrubber) PII is scrubbed from the
+    messages.
     """
-    df_sorted = df_greater_than_2.sort_values(['conversation_id', 'id'], ascending=[True, False])
-    df_sorted[['sender', 'content']] = df_sorted[['sender', 'content']].fillna('')
-    grouped = df_sorted.groupby('conversation_id')[['sender', 'content']].apply(
-        lambda x: '||'.join(x['sender'] + ": " + x['content']))
-    output = []
-    for conversation_id, conversation in zip(grouped.index, grouped.values):
-        messages = conversation.split('||')[::-1]
-        if messages[0].startswith('Agent:'):
-            continue
-        current_conversation = []
-        for message in messages:
-            current_conversation.append(message)
-            if message.startswith('Agent:'):
-                record = {
-                    'input_text': ' '.join(current_conversation[:-1]) + ' Agent:',
-                    'output_text': current_conversation[-1].split(": ", 1)[1]
-                }
-                output.append(record)
-    jsonl_output = '\n'.join(json.dumps(record) for record in output)
+    records = iter_training_records(
+        df_greater_than_2, strip=False, text_scrubber=text_scrubber
+    )
+    jsonl_output = '\n'.join(json.dumps(record) for record in records)
     print(jsonl_output[:500])
     return jsonl_output
 
@@ -64,11 +69,7 @@ def strip_unwanted_text(jsonl_output):
     """
     Removes URLs and contents within angle brackets from the JSONL string.
     """
-    url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-    pattern_within_angle_brackets = r'<~~.*?~~>'
-    jsonl_output1 = re.sub(url_pattern, '', jsonl_output)
-    jsonl_output2 = re.sub(pattern_within_angle_brackets, '', jsonl_output1)
-    return jsonl_output2
+    return JSONL_ANGLE_BRACKET_PATTERN.sub('', URL_PATTERN.sub('', jsonl_output))
 
 
 if __name__ == '__main__':
@@ -88,7 +89,8 @@ if __name__ == '__main__':
 
     df_greater_than_2 = df.merge(df_greater_than_2_counts, how='right', on='conversation_id')
 
-    jsonl_output = convert_to_jsonl(df_greater_than_2)
-    jsonl_output_cleaned = strip_unwanted_text(jsonl_output)
-
-    print(jsonl_output_cleaned[:500])
+    # Stream one cleaned record per agent message straight to disk
+    count = write_jsonl(
+        iter_training_records(df_greater_than_2), 'data/fine_tuning_dataset.jsonl'
+    )
+    print(f'Wrote {count} records')
@@ -5,6 +5,7 @@ import pandas as pd
 import bigframes.pandas as bpd
 import bigframes.ml.llm as llm
 
+from llm_experiments.prompt_cache import default_prompt_cache
 from llm_experiments.utils import here
 
 
@@ -12,6 +13,10 @@ from llm_experiments.utils import here
 bpd.options.bigquery.project = "motorway-genai"
 bpd.options.bigquery.location = "europe-west2"
 
+MODEL_NAME = "text-bison"
+RESULT_COLUMN = "ml_generate_text_llm_result"
+
+
 # # Create a DataFrame from a BigQuery table
 # query_or_table = "motorway-dl.llm_customers_comments.nps_comments_classified"
 # df_bq = bpd.read_gbq(query_or_table)
@@ -19,9 +24,47 @@ bpd.options.bigquery.location = "europe-west2"
 # df = df_bq.head(30).to_pandas()
 
 
+def predict_with_cache(prompts, cache=None, **parameters):
+    """
+    Runs a Series of prompts through PaLM2TextGenerator, only sending prompts that
+    aren't cached in `cache`. By default that is the shared prompt cache, which here
+    also keeps completions sampled at a non-zero temperature: the app reruns these
+    calls on every reload and should show the same results each time.
+
+    Returns a pandas DataFrame indexed like `prompts` with 'prompt' and
+    'ml_generate_text_llm_result' columns.
+    """
+    if cache is None:
+        cache = default_prompt_cache(cache_nonzero_temperature=True)
+    model_key = f"bigframes/{MODEL_NAME}"
+    df = pd.DataFrame({"prompt": prompts})
+    if cache.bypasses(parameters):
+        cache.bypassed += len(df)
+        results = pd.Series(None, index=df.index, dtype=object)
+    else:
+        results = df["prompt"].map(
+            lambda prompt: cache.get(model_key, parameters, prompt)
+        )
+
+    missing_prompts = df.loc[results.isna(), "prompt"].drop_duplicates()
+    if len(missing_prompts):
+        model = llm.PaLM2TextGenerator(model_name=MODEL_NAME)
+        df_pred = model.predict(
+            bpd.read_pandas(missing_prompts.to_frame()), **parameters
+        ).to_pandas()
+        completions = dict(zip(df_pred["prompt"], df_pred[RESULT_COLUMN]))
+        if not cache.bypasses(parameters):
+            for prompt, completion in completions.items():
+                cache.put(model_key, parameters, prompt, completion)
+        results = results.fillna(df["prompt"].map(completions))
+    logger.debug(f"prompt cache: {cache.stats()}")
+
+    df[RESULT_COLUMN] = results
+    return df
+
+
 def generate_sentiment_score(series, temperature):
     df = pd.DataFrame(series, columns=["comment"])
-    model = llm.PaLM2TextGenerator(model_name="text-bison")
     prefix_prompt = f"""
     Classify whether or not this feedback is: 1: very negative, 2: slightly negative, 3: neutral, 4: slightly positive, or 5: very positive.
     Respond with only the corresponding number.    
@@ -33,10 +76,10 @@ def generate_sentiment_score(series, temperature):
     suffix_prompt = f"\n    Response: "
     df["prompt"] = prefix_prompt + df["comment"] + suffix_prompt
 
-    df_pred = model.predict(bpd.read_pandas(df[["prompt"]]), 
-                            max_output_tokens=40,
-                            temperature=temperature,
-                            )
+    df_pred = predict_with_cache(df["prompt"],
+                                 max_output_tokens=40,
+                                 temperature=temperature,
+                                 )
     
     categories = {
         "1": 'very negative',
@@ -56,8 +99,7 @@ def get_example_category_taxonomy(series, num_comments=200, num_categories=15):
     logger.debug(f"series: {series}")
     concatenated_comments = " ".join(series.head(num_comments).tolist())
     
-    # Set up the model and the prompt
-    model = llm.PaLM2TextGenerator(model_name="text-bison")
+    # Set up the prompt
     prompt = f"The following will be a text dump of comments. " \
              f"List the {num_categories} most common categories as a valid comma separated list " \
              f"in valid python syntax, using \" as the speech mark, where each category identified is its own element. " \
@@ -65,9 +107,9 @@ def get_example_category_taxonomy(series, num_comments=200, num_categories=15):
              f"Comments:      {concatenated_comments}"
     
     # Make a prediction using the model
-    df_pred = model.predict(bpd.read_pandas(pd.DataFrame([prompt], columns=["prompt"])), 
-                               max_output_tokens=512,
-                               temperature=0.3)
+    df_pred = predict_with_cache(pd.Series([prompt]),
+                                 max_output_tokens=512,
+                                 temperature=0.3)
     
     # Return the predicted sentiment categories as a Series
     return df_pred
@@ -84,14 +126,10 @@ def categorise_comments(series, categories: list):
     suffix_prompt = f"\n    Response: "
     df['prompt'] = prefix_prompt + df['comment'] + suffix_prompt
     
-    # Set up the model
-    model = llm.PaLM2TextGenerator(model_name="text-bison")
-    
-    # Make a batch prediction using the model
-    df_preds = model.predict(bpd.read_pandas(df[['prompt']]), 
-                                max_output_tokens=256,
-                                temperature=0.3)
-    df_preds = df_preds.to_pandas()
+    # Make a batch prediction using the model, for comments not seen before
+    df_preds = predict_with_cache(df['prompt'],
+                                  max_output_tokens=256,
+                                  temperature=0.3)
     
 
     def validate_categories(returned_str, valid_categories):
@@ -3,6 +3,9 @@
 import os
 import openai
 from dotenv import load_dotenv, find_dotenv
+
+from llm_experiments.prompt_cache import default_prompt_cache
+
 _ = load_dotenv(find_dotenv())  # read local .env file
 
 openai.api_key = os.environ['OPENAI_API_KEY']
@@ -11,13 +14,22 @@ openai.api_key = os.environ['OPENAI_API_KEY']
 def get_completion_from_messages(messages,
                                  model="gpt-3.5-turbo",
                                  temperature=0,
-                                 max_tokens=500):
-    response = openai.ChatCompletion.create(
-        model=model,
-        messages=messages,
-        temperature=temperature,
-        max_tokens=max_tokens,
-    )
-    return response.choices[0].message["content"]
+                                 max_tokens=500,
+                                 cache=None):
+    """Chat completion, served from `cache` (the shared prompt cache by default) when
+    seen before."""
+    def complete():
+        response = openai.ChatCompletion.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+        return response.choices[0].message["content"]
+
+    if cache is None:
+        cache = default_prompt_cache()
+    parameters = {"temperature": temperature, "max_tokens": max_tokens}
+    return cache.get_or_compute(model, parameters, messages, complete)
 
 
@@ -0,0 +1,222 @@
+"""Persistent prompt -> completion cache shared by the LLM call sites.
+
+Completions are keyed by a hash of (model, parameters, prompt) and stored in SQLite,
+with an in-memory LRU in front. Entries expire after `ttl_seconds` and the least
+recently used are evicted beyond `max_entries`. Hits, including those served from
+memory, update the entry's access time on disk in batches, written with the next `put`
+or on `close`. Calls with a non-zero temperature bypass the cache unless
+`cache_nonzero_temperature` is set, since their output is meant to vary.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from llm_experiments.cache import LRUCache
+from llm_experiments.utils import here
+
+DEFAULT_CACHE_PATH = here() / ".cache" / "prompt_cache.sqlite3"
+
+# set to "0" to turn the shared cache off, e.g. when comparing fresh completions
+CACHE_ENV_VAR = "LLM_PROMPT_CACHE"
+
+
+class PromptCache:
+    def __init__(
+        self,
+        db_path=DEFAULT_CACHE_PATH,
+        ttl_seconds=30 * 24 * 3600,
+        max_entries=100000,
+        memory_size=1024,
+        cache_nonzero_temperature=False,
+        enabled=True,
+        clock=time.time,
+    ):
+        self.db_path = Path(db_path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.cache_nonzero_temperature = cache_nonzero_temperature
+        self.enabled = enabled
+        self.clock = clock
+
+        self.memory = LRUCache(memory_size)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # key -> access time of hits not yet written to disk
+        self._accessed = {}
+        self._connection = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS prompt_cache ("
+                "key TEXT PRIMARY KEY, model TEXT NOT NULL, completion TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS prompt_cache_accessed_at "
+                "ON prompt_cache (accessed_at)"
+            )
+        # entries on disk, counted once here and kept up to date by this instance; rows
+        # written by other processes sharing the file are only counted when it is
+        # reopened
+        self._entries = len(self)
+
+    @staticmethod
+    def key(model, parameters, prompt):
+        """Stable hash of a request; `prompt` is a string or JSON-able messages."""
+        payload = json.dumps(
+            {"model": model, "parameters": parameters, "prompt": prompt},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def bypasses(self, parameters):
+        """True if a call with these parameters should go straight to the model."""
+        if not self.enabled:
+            return True
+        return not self.cache_nonzero_temperature and bool(
+            (parameters or {}).get("temperature", 0)
+        )
+
+    def _expired(self, created_at):
+        return (
+            self.ttl_seconds is not None
+            and self.clock() - created_at > self.ttl_seconds
+        )
+
+    def get(self, model, parameters, prompt, default=None):
+        key = self.key(model, parameters, prompt)
+        entry = self.memory.get(key)
+        if entry is not None and not self._expired(entry[1]):
+            with self._lock:
+                self._accessed[key] = self.clock()
+            self.memory_hits += 1
+            return entry[0]
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT completion, created_at FROM prompt_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self._expired(row[1]):
+                with self._connection:
+                    self._connection.execute(
+                        "DELETE FROM prompt_cache WHERE key = ?", (key,)
+                    )
+                self._entries -= 1
+                self._accessed.pop(key, None)
+                row = None
+            if row is None:
+                self.misses += 1
+                return default
+            self._accessed[key] = self.clock()
+            self.disk_hits += 1
+
+        completion = json.loads(row[0])
+        self.memory.put(key, (completion, row[1]))
+        return completion
+
+    def put(self, model, parameters, prompt, completion):
+        key = self.key(model, parameters, prompt)
+        now = self.clock()
+        self.memory.put(key, (completion, now))
+        with self._lock, self._connection:
+            self._write_accessed()
+            exists = self._connection.execute(
+                "SELECT 1 FROM prompt_cache WHERE key = ?", (key,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO prompt_cache "
+                "(key, model, completion, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, model, json.dumps(completion), now, now),
+            )
+            self._entries += exists is None
+            if self._entries > self.max_entries:
+                # evict the least recently used entries past the limit, via the index
+                self._connection.execute(
+                    "DELETE FROM prompt_cache WHERE key IN ("
+                    "SELECT key FROM prompt_cache ORDER BY accessed_at LIMIT ?)",
+                    (self._entries - self.max_entries,),
+                )
+                self._entries = self.max_entries
+
+    def _write_accessed(self):
+        """Writes the access times of hits since the last write; needs the lock held."""
+        if self._accessed:
+            self._connection.executemany(
+                "UPDATE prompt_cache SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._accessed.items()],
+            )
+            self._accessed.clear()
+
+    def get_or_compute(self, model, parameters, prompt, compute):
+        """Cached completion for the request, storing `compute()` on a miss."""
+        if self.bypasses(parameters):
+            self.bypassed += 1
+            return compute()
+        completion = self.get(model, parameters, prompt)
+        if completion is None:
+            completion = compute()
+            self.put(model, parameters, prompt, completion)
+        return completion
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM prompt_cache"
+            ).fetchone()[0]
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": self.hit_rate,
+        }
+
+    def close(self):
+        with self._lock:
+            with self._connection:
+                self._write_accessed()
+            self._connection.close()
+
+
+# cache_nonzero_temperature -> process-wide cache, both sharing the one SQLite file
+_default_caches = {}
+_default_cache_lock = threading.Lock()
+
+
+def default_prompt_cache(cache_nonzero_temperature=False):
+    """Process-wide cache at `DEFAULT_CACHE_PATH`, disabled when LLM_PROMPT_CACHE=0.
+
+    Call sites that want completions reused even when sampled at a non-zero
+    temperature, e.g. so an app rerun shows the same answer, pass
+    `cache_nonzero_temperature=True` and get their own instance over the same file.
+    """
+    with _default_cache_lock:
+        if cache_nonzero_temperature not in _default_caches:
+            _default_caches[cache_nonzero_temperature] = PromptCache(
+                DEFAULT_CACHE_PATH,
+                cache_nonzero_temperature=cache_nonzero_temperature,
+                enabled=os.environ.get(CACHE_ENV_VAR, "1") != "0",
+            )
+        return _default_caches[cache_nonzero_temperature]
@@ -0,0 +1,54 @@
+"""Token-bucket rate limiting shared by the API clients."""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket.
+
+    Holds up to `capacity` tokens and refills at `rate` tokens per second. `acquire`
+    blocks until the requested number of tokens is available, so callers are smoothed to
+    the configured rate while still allowing bursts up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, amount, burst=None):
+        """Bucket allowing `amount` per minute, e.g. a requests per minute quota."""
+        return cls(rate=amount / 60, capacity=burst if burst is not None else amount)
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` are available and take them. Returns seconds waited."""
+        if tokens > self.capacity:
+            raise ValueError(
+                f"Cannot acquire {tokens} tokens "
+                f"from a bucket of capacity {self.capacity}"
+            )
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            self._sleep(wait)
+            waited += wait
@@ -1,5 +1,18 @@
 """Takes audio files from interviews, converts them to single channel audio and then runs through Google's
-Transcription API."""
+Transcription API.
+
+`TranscriptionRunner` pipelines a folder of interviews: audio is converted in a process
+pool, uploaded on a thread pool and transcribed by concurrent long running operations,
+so the folder takes roughly as long as its longest interview rather than the sum of all
+of them."""
+
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 
 from google.cloud import speech
 from pydub import AudioSegment
@@ -9,7 +22,9 @@ from loguru import logger
 from llm_experiments.utils import here
 
 
-def split_and_convert_audio(file_path, output_format="wav", sample_width=2):
+def split_and_convert_audio(
+    file_path, output_format="wav", sample_width=2, frame_rate=None
+):
     """
     Splits a stereo audio file into mono and converts it to specified format and bit depth.
 
@@ -17,6 +32,8 @@ def split_and_convert_audio(file_path, output_format="wav", sample_width=2):
         file_path (Path): Path to the input audio file.
         output_format (str): The desired output format (default is 'wav').
         sample_width (int): The desired sample width in bytes (default is 2 for 16-bit).
+        frame_rate (int): Sample rate to resample to in Hz (default is to keep the
+            input's).
 
     Returns:
         Path: Path to the converted audio file.
@@ -28,19 +45,23 @@ def split_and_convert_audio(file_path, output_format="wav", sample_width=2):
         here() / f"{file_path.parent / file_path.stem}_isolated_channel.{output_format}"
     )
     # Export the first channel and set to 16-bit
-    channels[0].set_sample_width(sample_width).export(output_path, format=output_format)
+    channel = channels[0].set_sample_width(sample_width)
+    if frame_rate is not None:
+        channel = channel.set_frame_rate(frame_rate)
+    channel.export(output_path, format=output_format)
     return output_path
 
 
-def upload_to_gcs(local_file_path, gcs_uri):
+def upload_to_gcs(local_file_path, gcs_uri, storage_client=None):
     """
     Uploads a file to Google Cloud Storage.
 
     Args:
     local_file_path (str): The path to the local file to be uploaded.
     gcs_uri (str): The GCS URI where the file will be uploaded, in the format 'gs://bucket_name/path/to/object'.
+    storage_client (storage.Client): Client to upload with (default is a new one).
     """
-    storage_client = storage.Client()
+    storage_client = storage_client or storage.Client()
     bucket_name, object_name = gcs_uri.replace("gs://", "").split("/", 1)
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(object_name)
@@ -48,20 +69,20 @@ def upload_to_gcs(local_file_path, gcs_uri):
     logger.info(f"File {local_file_path} uploaded to {gcs_uri}.")
 
 
-def transcribe_gcs(gcs_uri: str) -> str:
-    """
-    Asynchronously transcribes the audio file specified by the gcs_uri.
-    """
-    client = speech.SpeechClient()
+def start_transcription(client, gcs_uri):
+    """Submits a long running recognize operation for the audio at `gcs_uri`, without
+    waiting for it."""
     audio = speech.RecognitionAudio(uri=gcs_uri)
     config = speech.RecognitionConfig(
         encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
         language_code="en-UK",
     )
-    operation = client.long_running_recognize(config=config, audio=audio)
-    logger.info("Waiting for operation to complete...")
-    response = operation.result(timeout=6000)
+    return client.long_running_recognize(config=config, audio=audio)
+
 
+def format_transcript(response):
+    """The (complete transcript, transcript with confidences) of a recognize
+    response."""
     confidence_transcript = "\n".join(
         [
             f"Transcript: {result.alternatives[0].transcript}\nConfidence: {result.alternatives[0].confidence}"
@@ -76,38 +97,164 @@ def transcribe_gcs(gcs_uri: str) -> str:
     return complete_transcript, confidence_transcript
 
 
+def transcribe_gcs(gcs_uri: str) -> str:
+    """
+    Asynchronously transcribes the audio file specified by the gcs_uri.
+    """
+    client = speech.SpeechClient()
+    operation = start_transcription(client, gcs_uri)
+    logger.info("Waiting for operation to complete...")
+    return format_transcript(operation.result(timeout=6000))
+
+
+def transcript_path(audio_path, output_folder):
+    return Path(output_folder) / (audio_path.stem + "_transcript.txt")
+
+
+class TranscriptionRunner:
+    """Converts, uploads and transcribes a batch of audio files as a pipeline.
+
+    Each file is split to mono (and optionally resampled) in a process pool, uploaded on
+    a thread pool as soon as it is converted, and its long running recognize operation
+    is submitted as soon as the upload finishes. All operations are polled together
+    every `poll_interval` seconds and each transcript is written to `output_folder` when
+    its operation is done. A file that fails at any stage is logged and listed in
+    `failed` without stopping the others.
+
+    `speech_client` only needs `long_running_recognize(config=..., audio=...)` returning
+    an operation with `done()` and `result()`, and `storage_client` only needs
+    `bucket(name).blob(name)` with `upload_from_filename(path)`, so local fakes work as
+    well as the Google clients.
+    """
+
+    def __init__(
+        self,
+        gcs_folder_uri,
+        output_folder,
+        speech_client=None,
+        storage_client=None,
+        convert_workers=None,
+        upload_workers=8,
+        frame_rate=None,
+        poll_interval=10,
+        timeout=6000,
+        sleep=time.sleep,
+        clock=time.monotonic,
+    ):
+        self.gcs_folder_uri = gcs_folder_uri.rstrip("/")
+        self.output_folder = Path(output_folder)
+        self.speech_client = speech_client or speech.SpeechClient()
+        self.storage_client = storage_client or storage.Client()
+        self.convert_workers = convert_workers
+        self.upload_workers = upload_workers
+        self.frame_rate = frame_rate
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.sleep = sleep
+        self.clock = clock
+        self.failed = {}
+
+    def _fail(self, audio_path, stage, error):
+        logger.error(f"Failed to {stage} {audio_path}: {error}")
+        self.failed[audio_path] = error
+
+    def _start(self, audio_path, gcs_uri, operations):
+        try:
+            operation = start_transcription(self.speech_client, gcs_uri)
+        except Exception as e:
+            self._fail(audio_path, "transcribe", e)
+            return
+        logger.info(f"Started transcription of {gcs_uri}")
+        operations[audio_path] = (operation, self.clock())
+
+    def _poll(self, operations, transcripts):
+        for audio_path, (operation, started) in list(operations.items()):
+            try:
+                if not operation.done():
+                    if self.clock() - started > self.timeout:
+                        raise TimeoutError(
+                            f"transcription not done after {self.timeout}s"
+                        )
+                    continue
+                transcript, _ = format_transcript(operation.result())
+            except Exception as e:
+                self._fail(audio_path, "transcribe", e)
+            else:
+                output_path = transcript_path(audio_path, self.output_folder)
+                output_path.write_text(transcript)
+                logger.info(
+                    f"Transcribed {audio_path} ({len(transcript.split())} words) "
+                    f"to {output_path}"
+                )
+                transcripts[audio_path] = transcript
+            del operations[audio_path]
+
+    def run(self, audio_paths):
+        """Transcribes `audio_paths`, returning {audio_path: transcript} for the files
+        that succeeded."""
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+        transcripts = {}
+        operations = {}
+        with ProcessPoolExecutor(
+            max_workers=self.convert_workers
+        ) as convert_pool, ThreadPoolExecutor(
+            max_workers=self.upload_workers
+        ) as upload_pool:
+            stages = {
+                convert_pool.submit(
+                    split_and_convert_audio, audio_path, frame_rate=self.frame_rate
+                ): ("convert", audio_path, None)
+                for audio_path in audio_paths
+            }
+            while stages or operations:
+                if stages:
+                    # wake up for the next conversion or upload, or in time to poll the
+                    # operations
+                    done, _ = wait(
+                        stages,
+                        timeout=self.poll_interval if operations else None,
+                        return_when=FIRST_COMPLETED,
+                    )
+                else:
+                    done = set()
+                    self.sleep(self.poll_interval)
+
+                for future in done:
+                    stage, audio_path, gcs_uri = stages.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        self._fail(audio_path, stage, e)
+                        continue
+                    if stage == "convert":
+                        gcs_uri = f"{self.gcs_folder_uri}/{result.name}"
+                        upload = upload_pool.submit(
+                            upload_to_gcs, result, gcs_uri, self.storage_client
+                        )
+                        stages[upload] = ("upload", audio_path, gcs_uri)
+                    else:
+                        self._start(audio_path, gcs_uri, operations)
+
+                self._poll(operations, transcripts)
+
+        logger.info(
+            f"Transcribed {len(transcripts)} of {len(audio_paths)} files, "
+            f"{len(self.failed)} failed"
+        )
+        return transcripts
+
+
 # Main script
 if __name__ == "__main__":
     # read all files in file_path
-    # for each file, split into mono and convert to 16-bit wav
-    for audio_path in here().glob("data/audio/files_to_read/*.wav"):
-        logger.info(f"Starting {audio_path=}")
-        converted_audio_path = split_and_convert_audio(audio_path)
-        logger.info(f"Converted to mono at {converted_audio_path=}")
-
-        gcs_out_uri = f"gs://gen-ai-test-playground/audio-files-marketing/{converted_audio_path.name}"
-        logger.info(f"Beginning upload to {gcs_out_uri=}")
-        upload_to_gcs(converted_audio_path, gcs_out_uri)
-        logger.info(f"Uploaded to {gcs_out_uri=}")
-
-        logger.info(f"Beginning transcription of {gcs_out_uri}")
-        transcript, _ = transcribe_gcs(gcs_out_uri)
-        logger.info(f"Transcription complete {transcript[:500]=} {transcript[500:]=}")
-        logger.info(f"Words: {len(transcript.split())=}")
-
-        out_path = (
-            here()
-            / audio_path.parent.parent
-            / "outs"
-            / (audio_path.stem + "_transcript.txt")
-        )
-        logger.info(f"Writing to outpath: {out_path=}")
-        with open(
-            out_path,
-            "w",
-        ) as f:
-            f.write(transcript)
-            f.close()
+    # for each file, split into mono and convert to 16-bit wav, upload it and transcribe
+    # it, with every file in flight at once
+    audio_paths = sorted(here().glob("data/audio/files_to_read/*.wav"))
+    runner = TranscriptionRunner(
+        "gs://gen-ai-test-playground/audio-files-marketing",
+        here() / "data/audio/outs",
+    )
+    runner.run(audio_paths)
     #
     # audio_path = here() / "data/audio/S6T01.wav"
     # converted_audio_path = split_and_convert_audio(audio_path)
@@ -0,0 +1,56 @@
+"""Fakes shared by the test modules."""
+
+import threading
+
+import pytest
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def upload_from_filename(self, filename):
+        if self.name in self.bucket.fail_names:
+            raise ConnectionError("simulated network failure")
+        with self.bucket.lock:
+            self.bucket.in_flight += 1
+            self.bucket.max_in_flight = max(
+                self.bucket.max_in_flight, self.bucket.in_flight
+            )
+        try:
+            if self.bucket.upload_barrier is not None:
+                self.bucket.upload_barrier.wait(timeout=10)
+            with open(filename, "rb") as file:
+                data = file.read()
+            with self.bucket.lock:
+                self.bucket.objects[self.name] = data
+                self.bucket.upload_count += 1
+        finally:
+            with self.bucket.lock:
+                self.bucket.in_flight -= 1
+
+
+class FakeBucket:
+    """Local stand-in for `google.cloud.storage.Bucket`; `fail_names` fail to upload.
+
+    `max_in_flight` is the most uploads that ran at once. Set `upload_barrier` to a
+    `threading.Barrier` to hold every upload until that many are in flight.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.upload_count = 0
+        self.fail_names = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.upload_barrier = None
+        self.lock = threading.Lock()
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+
+@pytest.fixture
+def fake_bucket():
+    return FakeBucket()
@@ -0,0 +1,63 @@
+"""Tests for `llm_experiments.chatbot`."""
+
+import json
+
+import numpy as np
+import pandas as pd
+from assertpy import assert_that
+
+from benchmarks.benchmark_chatbot import make_chat_log, pair_messages_row_by_row
+from llm_experiments.chatbot import (
+    CONTEXT,
+    group_consecutive_messages,
+    pair_turns,
+    write_messages_jsonl,
+)
+
+
+def test_group_and_pair_messages():
+    df = pd.DataFrame(
+        {
+            "datetime": ["09:00", "09:01", "09:02", "09:03", "09:04", "09:05"],
+            "sender": ["Sender", "Sender", "Recipient", "Sender", np.nan, "Recipient"],
+            "message": ["hi", np.nan, "hey", "how are you?", "?", "good"],
+        }
+    )
+
+    grouped_df = group_consecutive_messages(df)
+    data = pair_turns(grouped_df, "Sender")
+
+    assert_that(grouped_df["message"].tolist()).is_equal_to(
+        ["hi ", "hey", "how are you?", "?", "good"]
+    )
+    assert_that(grouped_df["datetime"].tolist()).is_equal_to(
+        ["09:01", "09:02", "09:03", "09:04", "09:05"]
+    )
+    assert_that(data).is_equal_to(
+        [
+            {"input_text": "hi " + CONTEXT, "output_text": "hey"},
+            {"input_text": "how are you?" + CONTEXT, "output_text": "?"},
+        ]
+    )
+
+
+def test_vectorized_pairing_matches_row_by_row(tmp_path):
+    df = make_chat_log(3000, seed=1)
+
+    grouped_df = group_consecutive_messages(df)
+    data = pair_turns(grouped_df, "Sender")
+
+    grouped_legacy, data_legacy = pair_messages_row_by_row(df, "Sender")
+    pd.testing.assert_frame_equal(grouped_df, grouped_legacy)
+    assert_that(data).is_equal_to(data_legacy)
+
+    write_messages_jsonl(data, tmp_path / "messages.jsonl")
+    lines = (tmp_path / "messages.jsonl").read_text(encoding="utf-8").splitlines()
+    assert_that([json.loads(line) for line in lines]).is_equal_to(data_legacy)
+
+
+def test_group_consecutive_messages_empty():
+    df = pd.DataFrame(columns=["datetime", "sender", "message"])
+
+    assert_that(group_consecutive_messages(df)).is_length(0)
+    assert_that(pair_turns(group_consecutive_messages(df), "Sender")).is_empty()
@@ -0,0 +1,319 @@
+"""Tests for `llm_experiments.cx_support.classify_data_rows`."""
+
+import threading
+import time
+
+import pandas as pd
+import pytest
+from assertpy import assert_that
+
+from benchmarks.cx_support.benchmark_classify import (
+    FakeClassifierModel,
+    fake_classification,
+    make_messages,
+)
+from llm_experiments.cx_support.classify_data_rows import (
+    PROMPT_PREAMBLE,
+    PROMPT_SUFFIX,
+    ClassificationResults,
+    PromptSizeStats,
+    TextGenerator,
+    classify_batched,
+    classify_csv,
+    make_batch_prompt,
+    make_prompt,
+    parse_batch_classifications,
+)
+from llm_experiments.prompt_cache import PromptCache
+from llm_experiments.rate_limit import TokenBucket
+
+
+class RateLimited(Exception):
+    code = 429
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """Stand-in for `TextGenerationModel`: sleeps `latency` per call and 429s the first
+    `failures_per_prompt` calls for each prompt."""
+
+    def __init__(self, latency=0.01, failures_per_prompt=0):
+        self.latency = latency
+        self.failures_per_prompt = failures_per_prompt
+        self.calls = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def predict(self, prompt, **parameters):
+        with self.lock:
+            self.calls[prompt] = self.calls.get(prompt, 0) + 1
+            attempt = self.calls[prompt]
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            if attempt <= self.failures_per_prompt:
+                raise RateLimited("quota exceeded")
+            return FakeResponse(f"classified: {prompt}")
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def make_generator(model, **kwargs):
+    return TextGenerator(
+        "project",
+        "location",
+        "text-bison@001",
+        rate_limit=1000,
+        model=model,
+        sleep=lambda seconds: None,
+        **kwargs,
+    )
+
+
+def test_generate_text_for_dataframe_is_concurrent_ordered_and_retries():
+    model = FakeModel(failures_per_prompt=2)
+    generator = make_generator(model, max_workers=4)
+    df = pd.DataFrame({"prompt": [f"message {i}" for i in range(20)]})
+
+    results = generator.generate_text_for_dataframe(df)
+
+    assert_that(results).is_equal_to([f"classified: message {i}" for i in range(20)])
+    assert_that(generator.retries).is_equal_to(40)
+    assert_that(model.max_in_flight).is_greater_than(1).is_less_than_or_equal_to(4)
+
+
+def test_generate_text_gives_up_after_max_retries():
+    generator = make_generator(FakeModel(failures_per_prompt=10), max_retries=2)
+
+    with pytest.raises(RateLimited):
+        generator.generate_text_batch(["message"])
+    assert_that(generator.retries).is_equal_to(2)
+
+
+def test_generate_text_waits_for_request_bucket():
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    generator = make_generator(FakeModel(latency=0), max_workers=1)
+    generator.request_bucket = TokenBucket(
+        rate=10, capacity=2, clock=lambda: clock[0], sleep=sleep
+    )
+
+    generator.generate_text_batch([f"message {i}" for i in range(6)])
+
+    # 2 requests from the burst, then 4 more at 10 per second
+    assert_that(clock[0]).is_close_to(0.4, 1e-9)
+
+
+def test_generate_text_reuses_cached_completions(tmp_path):
+    model = FakeModel(latency=0)
+    cache = PromptCache(
+        tmp_path / "prompt_cache.sqlite3", cache_nonzero_temperature=True
+    )
+    generator = make_generator(model, cache=cache)
+
+    first = generator.generate_text_batch(["a", "b"])
+    second = generator.generate_text_batch(["a", "b", "a"])
+
+    assert_that(first + second).is_equal_to(
+        [
+            "classified: a",
+            "classified: b",
+            "classified: a",
+            "classified: b",
+            "classified: a",
+        ]
+    )
+    assert_that(model.calls).is_equal_to({"a": 1, "b": 1})
+    # the repeated "a" in the second batch is deduplicated before the cache is asked
+    assert_that(cache.hits).is_equal_to(2)
+    assert_that(generator.deduplicated).is_equal_to(1)
+
+
+def test_generate_text_only_takes_rate_limit_tokens_for_cache_misses(tmp_path):
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    cache = PromptCache(tmp_path / "prompt_cache.sqlite3")
+    generator = make_generator(FakeModel(latency=0), max_workers=1, cache=cache)
+    generator.parameters["temperature"] = 0
+    generator.request_bucket = TokenBucket(
+        rate=10, capacity=2, clock=lambda: clock[0], sleep=sleep
+    )
+    prompts = [f"message {i}" for i in range(4)]
+    generator.generate_text_batch(prompts)
+    waited = clock[0]
+
+    generator.generate_text_batch(prompts)
+
+    # 2 requests from the burst and 2 at 10 per second, then only cache hits
+    assert_that(waited).is_close_to(0.2, 1e-9)
+    assert_that(clock[0]).is_equal_to(waited)
+    assert_that(cache.hits).is_equal_to(4)
+
+
+class CrashingModel(FakeModel):
+    def __init__(self, crash_on):
+        super().__init__(latency=0)
+        self.crash_on = crash_on
+
+    def predict(self, prompt, **parameters):
+        if self.crash_on in prompt:
+            raise ConnectionError("simulated crash")
+        return super().predict(prompt, **parameters)
+
+
+def test_classify_csv_resumes_after_crash(tmp_path):
+    input_csv_path = tmp_path / "tickets.csv"
+    output_path = tmp_path / "classified.jsonl"
+    pd.DataFrame(
+        {
+            "body": [f"ticket {i}" for i in range(10)],
+            "channel": ["email", "side_conversation"] * 5,
+        }
+    ).to_csv(input_csv_path, index=False)
+
+    def keep_email(df):
+        return df[df["channel"] == "email"]
+
+    with pytest.raises(ConnectionError):
+        classify_csv(
+            make_generator(CrashingModel(crash_on="ticket 6")),
+            input_csv_path,
+            output_path,
+            row_filter=keep_email,
+            batch_size=3,
+            prompt_fn=str,
+        )
+    # the batches before the one with ticket 6 were saved
+    assert_that(len(ClassificationResults(output_path))).is_equal_to(3)
+
+    model = FakeModel(latency=0)
+    results = classify_csv(
+        make_generator(model),
+        input_csv_path,
+        output_path,
+        row_filter=keep_email,
+        batch_size=3,
+        prompt_fn=str,
+    )
+
+    assert_that(results.classifications).is_equal_to(
+        {i: f"classified: ticket {i}" for i in range(0, 10, 2)}
+    )
+    assert_that(sorted(model.calls)).is_equal_to(["ticket 6", "ticket 8"])
+
+
+def test_classify_csv_sends_each_distinct_message_once(tmp_path):
+    input_csv_path = tmp_path / "tickets.csv"
+    bodies = ["Historical canx macro sent", "hello", "Historical canx macro sent"] * 3
+    pd.DataFrame({"body": bodies}).to_csv(input_csv_path, index=False)
+    model = FakeModel(latency=0)
+    stats = PromptSizeStats(template_chars=len(make_prompt("")))
+
+    results = classify_csv(
+        make_generator(model),
+        input_csv_path,
+        tmp_path / "classified.jsonl",
+        batch_size=4,
+        stats=stats,
+    )
+
+    assert_that([results.classifications[i] for i in range(9)]).is_equal_to(
+        [f"classified: {make_prompt(body)}" for body in bodies]
+    )
+    assert_that(sum(model.calls.values())).is_equal_to(2)
+    assert_that(stats.rows).is_equal_to(9)
+    assert_that(stats.sent).is_equal_to(2)
+    assert_that(stats.sent_chars).is_equal_to(
+        len(make_prompt("Historical canx macro sent")) + len(make_prompt("hello"))
+    )
+    assert_that(stats.naive_chars).is_equal_to(
+        sum(len(make_prompt(body)) for body in bodies)
+    )
+
+
+def test_make_prompt_wraps_message_in_template():
+    prompt = make_prompt("Historical canx macro sent")
+
+    assert_that(prompt).starts_with(PROMPT_PREAMBLE).ends_with(PROMPT_SUFFIX)
+    assert_that(prompt).contains("####\n\n    Historical canx macro sent\n\n    ####")
+
+
+@pytest.mark.parametrize(
+    "response, expected",
+    [
+        (
+            "1: Internal\n2. **Customer Related - From Agent**\n"
+            "- 3) Classification: 'internal'",
+            ["Internal", "Customer Related - From Agent", "Internal"],
+        ),
+        ("Classifications:\n3: Internal\n1: Internal\n2: Internal", ["Internal"] * 3),
+        ("1: Internal\n3: Internal", None),
+        ("1: Internal\n2: Internal\n3: Spam", None),
+        ("1: Internal\n1: Internal\n2: Internal\n3: Internal", None),
+    ],
+)
+def test_parse_batch_classifications(response, expected):
+    assert_that(parse_batch_classifications(response, 3)).is_equal_to(expected)
+
+
+class GarblingModel(FakeClassifierModel):
+    """Answers batches containing `garble` with text that can't be parsed."""
+
+    def __init__(self, garble):
+        super().__init__(latency_seconds=0)
+        self.garble = garble
+
+    def predict(self, prompt, **parameters):
+        response = super().predict(prompt, **parameters)
+        if "Messages to classify" in prompt and self.garble in prompt:
+            return FakeResponse("I'm sorry, I can't help with that.")
+        return response
+
+
+def test_classify_batched_matches_single_and_falls_back_on_parse_failure():
+    messages = make_messages(25)
+    model = GarblingModel(garble=messages[12])
+    generator = make_generator(model)
+
+    classifications = classify_batched(generator, messages, messages_per_prompt=10)
+
+    assert_that(classifications).is_equal_to(
+        [fake_classification(message) for message in messages]
+    )
+    # 3 batch prompts, then the 10 messages of the garbled batch one at a time
+    assert_that(model.requests).is_equal_to(13)
+
+
+def test_classify_csv_packs_messages_into_batches(tmp_path):
+    input_csv_path = tmp_path / "tickets.csv"
+    messages = make_messages(20)
+    pd.DataFrame({"body": messages}).to_csv(input_csv_path, index=False)
+    model = FakeClassifierModel(latency_seconds=0)
+    stats = PromptSizeStats(len(make_prompt("")), len(make_batch_prompt([""] * 5)) / 5)
+
+    results = classify_csv(
+        make_generator(model),
+        input_csv_path,
+        tmp_path / "classified.jsonl",
+        messages_per_prompt=5,
+        stats=stats,
+    )
+
+    assert_that(results.classifications).is_equal_to(
+        {i: fake_classification(message) for i, message in enumerate(messages)}
+    )
+    assert_that(model.requests).is_equal_to(4)
+    assert_that(stats.sent_chars).is_less_than(stats.naive_chars / 3)
@@ -0,0 +1,589 @@
+"""Tests for `llm_experiments.cx_insights.convert_to_ccai`."""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+from assertpy import assert_that
+
+from benchmarks.cx_insights.benchmark_transform import (
+    make_synthetic_calls,
+    run_per_row,
+    run_vectorized,
+)
+from llm_experiments.cx_insights import agent_ids
+from llm_experiments.cx_insights.agent_ids import AgentIdRegistry
+from llm_experiments.cx_insights.calls_store import (
+    read_calls_dataset,
+    write_calls_dataset,
+)
+from llm_experiments.cx_insights.convert_to_ccai import (
+    ConversationDataTransformer,
+    IngestToCCAI,
+)
+from llm_experiments.cx_insights.credentials import CachedTokenProvider
+from llm_experiments.cx_insights.gcs_upload import ParallelGCSUploader
+from llm_experiments.cx_insights.ndjson_shards import (
+    ShardedConversationWriter,
+    iter_shard_conversations,
+    split_shards,
+)
+from llm_experiments.scrub import TextScrubber
+
+
+@pytest.fixture
+def transformer(tmp_path):
+    return ConversationDataTransformer(
+        tmp_path / "all_calls.csv",
+        tmp_path / "conversations",
+        "test-bucket",
+        "ccai-insights-json/all_conversations",
+        bucket=object(),
+    )
+
+
+def test_transform_all_data_matches_per_row(transformer):
+    df_calls = make_synthetic_calls(num_interactions=25, messages_per_interaction=7)
+
+    assert_that(json.dumps(run_vectorized(transformer, df_calls))).is_equal_to(
+        json.dumps(run_per_row(transformer, df_calls))
+    )
+
+
+def test_transform_all_data_handles_integer_enquiry_ids(transformer):
+    df_calls = make_synthetic_calls(num_interactions=5, messages_per_interaction=3)
+    df_calls["enquiry_id"] = df_calls["enquiry_id"].astype(int)
+
+    assert_that(json.dumps(run_vectorized(transformer, df_calls))).is_equal_to(
+        json.dumps(run_per_row(transformer, df_calls))
+    )
+
+
+def test_transform_scrubs_message_text(tmp_path):
+    transformer = ConversationDataTransformer(
+        tmp_path / "all_calls.csv",
+        tmp_path / "conversations",
+        "test-bucket",
+        "ccai-insights-json/all_conversations",
+        bucket=object(),
+        text_scrubber=TextScrubber(),
+    )
+    df_calls = make_synthetic_calls(num_interactions=5, messages_per_interaction=3)
+    df_calls.loc[::4, "message_text"] = "my email is jo@example.com"
+
+    conversations = run_vectorized(transformer, df_calls)
+
+    assert_that(json.dumps(conversations)).is_equal_to(
+        json.dumps(run_per_row(transformer, df_calls))
+    ).does_not_contain("jo@example.com").contains("my email is {{EMAIL}}")
+
+
+def test_transform_all_data_empty(transformer):
+    df_calls = make_synthetic_calls(num_interactions=1).iloc[:0]
+
+    assert_that(run_vectorized(transformer, df_calls)).is_empty()
+
+
+def test_process_conversations_uploads_in_parallel_and_resumes(tmp_path, fake_bucket):
+    input_csv_path = tmp_path / "all_calls.csv"
+    make_synthetic_calls(num_interactions=12, messages_per_interaction=3).to_csv(
+        input_csv_path, index=False
+    )
+    bucket = fake_bucket
+    transformer = ConversationDataTransformer(
+        input_csv_path, tmp_path / "conversations", "test-bucket", "ccai", bucket=bucket
+    )
+
+    stats = transformer.process_conversations(save_to_gcs_flag=True, vectorized=True)
+    assert_that(stats.uploaded).is_equal_to(12)
+    assert_that(bucket.objects).contains_key("ccai/conversation_int-00000000.json")
+
+    # a re-run with unchanged output skips every upload
+    stats = transformer.process_conversations(save_to_gcs_flag=True, vectorized=True)
+    assert_that(stats.uploaded).is_equal_to(0)
+    assert_that(stats.skipped).is_equal_to(12)
+    assert_that(bucket.upload_count).is_equal_to(12)
+
+
+def test_parallel_uploader_reuploads_changed_files_and_counts_failures(
+    tmp_path, fake_bucket
+):
+    bucket = fake_bucket
+    bucket.fail_names.add("broken.json")
+    manifest_path = tmp_path / "manifest.jsonl"
+    changed = tmp_path / "changed.json"
+    changed.write_text("{}")
+    (tmp_path / "broken.json").write_text("{}")
+
+    with ParallelGCSUploader(bucket, manifest_path=manifest_path) as uploader:
+        uploader.submit(changed, "changed.json")
+    changed.write_text('{"a": 1}')
+
+    with ParallelGCSUploader(
+        bucket, max_workers=2, manifest_path=manifest_path
+    ) as uploader:
+        uploader.submit(changed, "changed.json")
+        uploader.submit(tmp_path / "broken.json", "broken.json")
+
+    assert_that(uploader.stats.uploaded).is_equal_to(1)
+    assert_that(uploader.stats.failed).is_equal_to(1)
+    assert_that(uploader.failed_uploads).is_equal_to(["broken.json"])
+    assert_that(bucket.objects["changed.json"]).is_equal_to(b'{"a": 1}')
+
+
+@pytest.mark.parametrize("chunksize", [1, 4, 1000])
+def test_iter_conversations_streams_chunks(tmp_path, chunksize):
+    input_csv_path = tmp_path / "all_calls.csv"
+    df_calls = make_synthetic_calls(num_interactions=6, messages_per_interaction=3)
+    df_calls.sort_values("interaction_id", kind="stable").to_csv(
+        input_csv_path, index=False
+    )
+    transformer = ConversationDataTransformer(
+        input_csv_path,
+        tmp_path / "conversations",
+        "test-bucket",
+        "ccai",
+        bucket=object(),
+    )
+
+    streamed = list(transformer.iter_conversations(chunksize=chunksize))
+
+    assert_that(json.dumps(streamed)).is_equal_to(
+        json.dumps(list(transformer.iter_conversations()))
+    )
+
+
+@pytest.mark.parametrize("vectorized", [False, True])
+def test_iter_conversations_chunks_keep_id_types(tmp_path, vectorized):
+    input_csv_path = tmp_path / "all_calls.csv"
+    df_calls = make_synthetic_calls(
+        num_interactions=6, messages_per_interaction=3
+    ).sort_values("interaction_id", kind="stable")
+    df_calls["enquiry_id"] = df_calls["enquiry_id"].astype(int).astype(object)
+    # only the last chunk has a missing enquiry_id
+    df_calls.iloc[-1, df_calls.columns.get_loc("enquiry_id")] = None
+    df_calls.to_csv(input_csv_path, index=False)
+    transformer = ConversationDataTransformer(
+        input_csv_path,
+        tmp_path / "conversations",
+        "test-bucket",
+        "ccai",
+        bucket=object(),
+    )
+
+    streamed = list(transformer.iter_conversations(vectorized, chunksize=4))
+    whole = list(transformer.iter_conversations(vectorized))
+
+    assert_that(json.dumps(streamed)).is_equal_to(json.dumps(whole))
+    customer_ids = [
+        entry["user_id"]
+        for _, conversation in whole
+        for entry in conversation["entries"]
+        if entry["role"] == "CUSTOMER"
+    ]
+    assert_that(customer_ids).contains(None)
+    assert_that({type(user_id) for user_id in customer_ids}).is_equal_to(
+        {int, type(None)}
+    )
+
+
+def test_iter_conversations_rejects_non_contiguous_interactions(tmp_path):
+    input_csv_path = tmp_path / "all_calls.csv"
+    make_synthetic_calls(num_interactions=6, messages_per_interaction=3).to_csv(
+        input_csv_path, index=False
+    )
+    transformer = ConversationDataTransformer(
+        input_csv_path,
+        tmp_path / "conversations",
+        "test-bucket",
+        "ccai",
+        bucket=object(),
+    )
+
+    with pytest.raises(ValueError, match="not contiguous"):
+        list(transformer.iter_conversations(vectorized=True, chunksize=2))
+
+
+@pytest.mark.parametrize("chunksize", [None, 4])
+def test_parquet_calls_dataset_matches_csv(tmp_path, chunksize):
+    df_calls = make_synthetic_calls(
+        num_interactions=12, messages_per_interaction=3
+    ).sort_values("interaction_id", kind="stable")
+    df_calls.to_csv(tmp_path / "all_calls.csv", index=False)
+    write_calls_dataset(df_calls, tmp_path / "all_calls.parquet")
+
+    conversations = {}
+    for input_path in ["all_calls.csv", "all_calls.parquet"]:
+        transformer = ConversationDataTransformer(
+            tmp_path / input_path,
+            tmp_path / "conversations",
+            "test-bucket",
+            "ccai",
+            bucket=object(),
+        )
+        conversations[input_path] = sorted(
+            transformer.iter_conversations(vectorized=True, chunksize=chunksize)
+        )
+
+    # one partition per interaction date
+    assert_that(
+        len(list((tmp_path / "all_calls.parquet").glob("interaction_date=*")))
+    ).is_equal_to(pd.to_datetime(df_calls["interaction_started"]).dt.date.nunique())
+    assert_that(json.dumps(conversations["all_calls.parquet"])).is_equal_to(
+        json.dumps(conversations["all_calls.csv"])
+    )
+
+
+def test_process_conversations_refuses_to_upload_ndjson_shards(tmp_path, fake_bucket):
+    input_csv_path = tmp_path / "all_calls.csv"
+    make_synthetic_calls(num_interactions=3, messages_per_interaction=2).to_csv(
+        input_csv_path, index=False
+    )
+    transformer = ConversationDataTransformer(
+        input_csv_path,
+        tmp_path / "conversations",
+        "test-bucket",
+        "ccai",
+        bucket=fake_bucket,
+    )
+
+    with pytest.raises(ValueError, match="split_shards"):
+        transformer.process_conversations(save_to_gcs_flag=True, output_format="ndjson")
+    assert_that(fake_bucket.objects).is_empty()
+    assert_that(list((tmp_path / "conversations").iterdir())).is_empty()
+
+
+def test_write_calls_dataset_drops_stale_partitions(tmp_path):
+    df_calls = make_synthetic_calls(num_interactions=12, messages_per_interaction=3)
+    dataset_path = tmp_path / "all_calls.parquet"
+    write_calls_dataset(df_calls, dataset_path)
+    dates = pd.to_datetime(df_calls["interaction_started"]).dt.date
+    df_latest = df_calls[dates == dates.max()]
+
+    write_calls_dataset(df_latest, dataset_path)
+
+    assert_that(list(dataset_path.glob("interaction_date=*"))).is_length(1)
+    assert_that(
+        sorted(read_calls_dataset(dataset_path)["interaction_id"].unique())
+    ).is_equal_to(sorted(df_latest["interaction_id"].unique()))
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_ndjson_shards_round_trip(transformer, tmp_path, compress):
+    df_calls = make_synthetic_calls(num_interactions=10, messages_per_interaction=3)
+    conversations = list(transformer.transform_all_data(df_calls))
+
+    shard_paths = transformer.save_to_shards(
+        conversations, shard_size=4, compress=compress
+    )
+
+    assert_that(shard_paths).is_length(3)
+    assert_that(json.dumps(list(iter_shard_conversations(shard_paths)))).is_equal_to(
+        json.dumps(conversations)
+    )
+    file_paths = split_shards(shard_paths, tmp_path / "split")
+    assert_that(json.loads(file_paths[0].read_text())).is_equal_to(
+        json.loads(json.dumps(conversations[0][1]))
+    )
+
+
+def test_sharded_writer_caps_shard_bytes(tmp_path):
+    with ShardedConversationWriter(
+        tmp_path, max_bytes_per_shard=100, buffer_bytes=1
+    ) as writer:
+        for interaction_id in range(5):
+            writer.write(interaction_id, {"entries": ["x" * 40]})
+
+    assert_that(writer.shard_paths).is_length(5)
+
+
+def test_agent_id_registry_keeps_legacy_ids_and_persists(tmp_path):
+    registry = AgentIdRegistry(tmp_path / "agent_ids.sqlite3")
+
+    assert_that(registry.get_id("Agent 1")).is_equal_to(
+        ConversationDataTransformer.string_to_int_id("Agent 1")
+    )
+    registry.get_id("Agent 2")
+    registry.close()
+
+    reopened = AgentIdRegistry(tmp_path / "agent_ids.sqlite3")
+    assert_that(len(reopened)).is_equal_to(2)
+    assert_that(reopened.get_id("Agent 1")).is_equal_to(
+        ConversationDataTransformer.string_to_int_id("Agent 1")
+    )
+
+
+def test_agent_id_registry_resolves_collisions(tmp_path, monkeypatch):
+    # every name hashes to the same id on the first attempt
+    monkeypatch.setattr(
+        agent_ids,
+        "short_hash_id",
+        lambda input_string: (
+            int(input_string.rpartition("#")[2] or 0)
+            if "#" in input_string
+            else 12345678
+        ),
+    )
+    registry = AgentIdRegistry(tmp_path / "agent_ids.sqlite3")
+
+    ids = [registry.get_id(name) for name in ["Alice", "Bob", "Carol", "Bob"]]
+
+    assert_that(ids).is_equal_to([12345678, 1, 2, 1])
+    assert_that(registry.collisions).is_equal_to(3)
+
+
+def test_transform_uses_agent_id_registry(tmp_path):
+    registry = AgentIdRegistry(tmp_path / "agent_ids.sqlite3")
+    transformer = ConversationDataTransformer(
+        tmp_path / "all_calls.csv",
+        tmp_path / "conversations",
+        "test-bucket",
+        "ccai",
+        bucket=object(),
+        agent_id_registry=registry,
+    )
+    df_calls = make_synthetic_calls(num_interactions=10, messages_per_interaction=5)
+
+    assert_that(json.dumps(run_vectorized(transformer, df_calls))).is_equal_to(
+        json.dumps(run_per_row(transformer, df_calls))
+    )
+    assert_that(len(registry)).is_equal_to(df_calls["message_agent_name"].nunique())
+
+
+class StubCCAIHandler(BaseHTTPRequestHandler):
+    """Rejects the first request for each URI with a 429, then returns a long-running
+    operation that reports done on the second poll. URIs containing "bad" always 400,
+    "nameless" get an operation without a name and "slow" never answer in time."""
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        bucket_uri = body["gcsSource"]["bucketUri"]
+        server = self.server
+        if self.headers["Authorization"] in server.revoked_tokens:
+            self._reply(401, {"error": "token expired"})
+            return
+        with server.lock:
+            server.auth_headers.add(self.headers["Authorization"])
+            server.posts[bucket_uri] = server.posts.get(bucket_uri, 0) + 1
+            first_attempt = server.posts[bucket_uri] == 1
+        if "bad" in bucket_uri:
+            self._reply(400, {"error": "bad request"})
+        elif "nameless" in bucket_uri:
+            self._reply(200, {})
+        elif "slow" in bucket_uri:
+            time.sleep(0.5)
+            self._reply(200, {})
+        elif first_attempt:
+            self._reply(429, {"error": "quota"})
+        else:
+            self._reply(200, {"name": f"operations/{bucket_uri.rsplit('/', 1)[1]}"})
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.polls[self.path] = server.polls.get(self.path, 0) + 1
+            done = server.polls[self.path] >= 2
+        self._reply(200, {"name": self.path, "done": done})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def ccai_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubCCAIHandler)
+    server.lock = threading.Lock()
+    server.posts, server.polls, server.auth_headers = {}, {}, set()
+    server.revoked_tokens = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def test_ingest_concurrently_retries_and_polls(ccai_server):
+    ingestor = IngestToCCAI(
+        "test-bucket",
+        "ccai",
+        api_root=f"http://127.0.0.1:{ccai_server.server_port}/v1",
+        requests_per_second=1000,
+        backoff_seconds=0.01,
+        poll_seconds=0.01,
+    )
+    ingestor._set_bearer_token("test-token")
+    uris = [f"gs://test-bucket/ccai/conversation_{i}.json" for i in range(6)]
+
+    stats = ingestor.ingest_concurrently(
+        uris + ["gs://test-bucket/ccai/bad.json"],
+        max_workers=3,
+        wait_for_operations=True,
+    )
+
+    assert_that(stats.succeeded).is_equal_to(6)
+    assert_that(stats.failed).is_equal_to(1)
+    assert_that(stats.retries).is_equal_to(6)
+    assert_that(stats.latencies).is_length(7)
+    assert_that(sorted(ingestor.successful_conversations)).is_equal_to(sorted(uris))
+    assert_that(ingestor.failed_conversations).is_equal_to(
+        ["gs://test-bucket/ccai/bad.json"]
+    )
+    assert_that(ccai_server.auth_headers).is_equal_to({"Bearer test-token"})
+
+
+def test_ingest_concurrently_records_timeouts_and_malformed_responses(ccai_server):
+    ingestor = IngestToCCAI(
+        "test-bucket",
+        "ccai",
+        api_root=f"http://127.0.0.1:{ccai_server.server_port}/v1",
+        max_retries=1,
+        backoff_seconds=0.01,
+        poll_seconds=0.01,
+        request_timeout=0.1,
+    )
+    ingestor._set_bearer_token("test-token")
+    failing = [
+        "gs://test-bucket/ccai/nameless.json",
+        "gs://test-bucket/ccai/slow.json",
+    ]
+
+    stats = ingestor.ingest_concurrently(
+        failing + ["gs://test-bucket/ccai/conversation_0.json"],
+        max_workers=1,
+        wait_for_operations=True,
+    )
+
+    assert_that(stats.succeeded).is_equal_to(1)
+    assert_that(stats.failed).is_equal_to(2)
+    assert_that(sorted(ingestor.failed_conversations)).is_equal_to(failing)
+    # the slow conversation was retried once after timing out
+    assert_that(ccai_server.posts["gs://test-bucket/ccai/slow.json"]).is_equal_to(2)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def counting_fetcher(lifetime_seconds, clock):
+    fetched = []
+
+    def fetch_token():
+        fetched.append(f"token-{len(fetched)}")
+        return fetched[-1], clock() + lifetime_seconds
+
+    return fetch_token
+
+
+def test_token_provider_caches_until_refresh_margin():
+    clock = FakeClock()
+    provider = CachedTokenProvider(
+        counting_fetcher(3600, clock),
+        refresh_margin_seconds=300,
+        background_refresh=False,
+        clock=clock,
+    )
+
+    assert_that(provider.token()).is_equal_to("token-0")
+    clock.now += 3000
+    assert_that(provider.token()).is_equal_to("token-0")
+    clock.now += 301  # inside the refresh margin
+    assert_that(provider.token()).is_equal_to("token-1")
+    assert_that(provider.refresh_count).is_equal_to(2)
+
+
+def test_token_provider_clamps_refresh_margin_to_token_lifetime():
+    clock = FakeClock()
+    provider = CachedTokenProvider(
+        counting_fetcher(60, clock),
+        refresh_margin_seconds=300,
+        background_refresh=False,
+        clock=clock,
+    )
+
+    assert_that([provider.token(), provider.token()]).is_equal_to(["token-0"] * 2)
+    clock.now += 31  # past half of the lifetime
+    assert_that(provider.token()).is_equal_to("token-1")
+    assert_that(provider.refresh_count).is_equal_to(2)
+
+
+def test_token_provider_never_returns_an_invalidated_none():
+    clock = FakeClock()
+    provider = CachedTokenProvider(
+        counting_fetcher(3600, clock), background_refresh=False, clock=clock
+    )
+    provider.token()
+
+    def invalidate_during_freshness_check():
+        # e.g. another thread got a 401 between the check and the return
+        provider.clock = clock
+        provider.invalidate()
+        return clock()
+
+    provider.clock = invalidate_during_freshness_check
+    assert_that(provider.token()).is_equal_to("token-0")
+    assert_that(provider.token()).is_equal_to("token-1")
+
+
+def test_token_provider_refreshes_in_background():
+    provider = CachedTokenProvider(
+        counting_fetcher(0.3, time.time), refresh_margin_seconds=0.2
+    )
+    provider.token()
+
+    deadline = time.time() + 5
+    while provider.refresh_count < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    provider.stop()
+
+    assert_that(provider.refresh_count).is_greater_than_or_equal_to(3)
+
+
+def test_ingest_refreshes_token_on_401(ccai_server):
+    ccai_server.revoked_tokens.add("Bearer token-0")
+    provider = CachedTokenProvider(
+        counting_fetcher(3600, time.time), background_refresh=False
+    )
+    ingestor = IngestToCCAI(
+        "test-bucket",
+        "ccai",
+        api_root=f"http://127.0.0.1:{ccai_server.server_port}/v1",
+        backoff_seconds=0.01,
+        token_provider=provider,
+    )
+
+    ingestor.ingest_concurrently(["gs://test-bucket/ccai/conversation_0.json"])
+
+    assert_that(ingestor.successful_conversations).is_length(1)
+    assert_that(ccai_server.auth_headers).is_equal_to({"Bearer token-1"})
+
+
+def test_ingest_refreshes_token_on_401_only_once(ccai_server):
+    ccai_server.revoked_tokens.update({"Bearer token-0", "Bearer token-1"})
+    provider = CachedTokenProvider(
+        counting_fetcher(3600, time.time), background_refresh=False
+    )
+    ingestor = IngestToCCAI(
+        "test-bucket",
+        "ccai",
+        api_root=f"http://127.0.0.1:{ccai_server.server_port}/v1",
+        backoff_seconds=0.01,
+        token_provider=provider,
+    )
+
+    stats = ingestor.ingest_concurrently(["gs://test-bucket/ccai/conversation_0.json"])
+
+    assert_that(ingestor.failed_conversations).is_length(1)
+    assert_that(provider.refresh_count).is_equal_to(2)
+    assert_that(stats.retries).is_equal_to(1)
@@ -0,0 +1,256 @@
+"""Tests and benchmarks for `llm_experiments.cx_support.data_engineering`."""
+
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+from assertpy import assert_that
+
+from benchmarks.cx_support.benchmark_data_engineering import (
+    clean_conversation_ids_per_group,
+    convert_to_jsonl_joined,
+    make_synthetic_messages,
+)
+from llm_experiments.cx_support import data_engineering2
+from llm_experiments.cx_support.data_engineering import (
+    build_dataset_sharded,
+    clean_conversation_ids,
+    clean_for_training,
+    convert_to_jsonl,
+    is_consecutive,
+    iter_training_records,
+    write_jsonl,
+)
+from llm_experiments.scrub import TextScrubber
+
+# the 1M and 10M row benchmarks take a while, run them with LARGE_BENCHMARKS=1
+large = pytest.mark.skipif(
+    not os.environ.get("LARGE_BENCHMARKS"), reason="set LARGE_BENCHMARKS=1 to run"
+)
+
+
+@pytest.mark.parametrize(
+    "ids, consecutive",
+    [
+        ([1, 2, 3], True),
+        ([7], True),
+        ([1, 2, 4], False),  # gap
+        ([2, 1, 3], False),  # out of order
+        ([1, 2, 2], False),  # repeated
+    ],
+)
+@pytest.mark.parametrize(
+    "clean", [clean_conversation_ids, data_engineering2.clean_conversation_ids]
+)
+def test_clean_conversation_ids(clean, ids, consecutive):
+    df = pd.DataFrame(
+        {
+            "conversation_id": [1] * len(ids) + [2, 2],
+            "id": ids + [10, 11],
+        }
+    )
+
+    df_cleaned = clean(df)
+
+    assert_that(is_consecutive(pd.Series(ids))).is_equal_to(consecutive)
+    assert_that(df_cleaned["conversation_id"].unique().tolist()).is_equal_to(
+        [1, 2] if consecutive else [2]
+    )
+
+
+def test_clean_conversation_ids_handles_interleaved_conversations():
+    df = pd.DataFrame(
+        {
+            "conversation_id": [1, 2, 1, 2, np.nan],
+            "id": [1, 5, 2, 7, 3],
+        }
+    )
+
+    df_cleaned = clean_conversation_ids(df)
+
+    # conversation 2 skips id 6, rows without a conversation are left alone
+    assert_that(df_cleaned.index.tolist()).is_equal_to([0, 2, 4])
+
+
+def test_clean_conversation_ids_matches_per_group():
+    df = make_synthetic_messages(20000, broken_share=0.2).sample(frac=1, random_state=0)
+
+    pd.testing.assert_frame_equal(
+        clean_conversation_ids(df), clean_conversation_ids_per_group(df)
+    )
+
+
+@pytest.mark.parametrize(
+    "num_rows",
+    [
+        10000,
+        100000,
+        pytest.param(1000000, marks=large),
+        pytest.param(10000000, marks=large),
+    ],
+)
+def test_benchmark_clean_conversation_ids(benchmark, num_rows):
+    df = make_synthetic_messages(num_rows)
+
+    df_cleaned = benchmark(clean_conversation_ids, df)
+
+    assert_that(len(df_cleaned)).is_less_than(num_rows)
+
+
+def test_benchmark_clean_conversation_ids_per_group(benchmark):
+    # the per-group implementation, to compare with the 100000 row case above
+    df = make_synthetic_messages(100000)
+
+    df_cleaned = benchmark(clean_conversation_ids_per_group, df)
+
+    assert_that(len(df_cleaned)).is_less_than(100000)
+
+
+def make_conversation_frame():
+    return pd.DataFrame(
+        {
+            "conversation_id": [2, 1, 1, 1, 1, 2, 3],
+            "id": [20, 4, 2, 1, 3, 21, 30],
+            "sender": [
+                "Agent",
+                "Agent",
+                "Agent",
+                "Customer",
+                "Customer",
+                "Customer",
+                "Customer",
+            ],
+            "content": [
+                "agent first",
+                "anything else?",
+                "see https://motorway.co.uk/help <~~macro~~>",
+                "hi",
+                "thanks",
+                "hello",
+                np.nan,
+            ],
+        }
+    )
+
+
+def test_iter_training_records_matches_joined_conversion():
+    df = make_conversation_frame()
+
+    records = list(iter_training_records(df))
+
+    assert_that(records).is_equal_to(
+        [
+            {"input_text": "Customer: hi Agent:", "output_text": "see  "},
+            {
+                "input_text": "Customer: hi Agent: see   Customer: thanks Agent:",
+                "output_text": "anything else?",
+            },
+        ]
+    )
+    assert_that("\n".join(json.dumps(record) for record in records)).is_equal_to(
+        convert_to_jsonl_joined(df)
+    )
+    assert_that(data_engineering2.convert_to_jsonl(df)).is_equal_to(
+        convert_to_jsonl(df)
+    )
+
+
+def test_iter_training_records_scrubs_content():
+    df = make_conversation_frame()
+    df.loc[df["content"] == "thanks", "content"] = "thanks, I'm on (555) 123-4567"
+
+    records = list(iter_training_records(df, text_scrubber=TextScrubber()))
+
+    # URLs are still stripped rather than replaced with the scrubber's placeholder
+    assert_that(records[1]["input_text"]).is_equal_to(
+        "Customer: hi Agent: see   Customer: thanks, I'm on[phone] Agent:"
+    )
+    assert_that(data_engineering2.convert_to_jsonl(df, TextScrubber())).contains(
+        "[phone]"
+    )
+
+
+def test_strip_unwanted_text_keeps_placeholders_within_a_record():
+    records = [
+        {"input_text": "Customer: a <~~ Agent:", "output_text": "reply"},
+        {"input_text": "Customer: b Agent:", "output_text": "kept"},
+        {"input_text": "Customer: c ~~> Agent:", "output_text": "<~~x~~>done"},
+    ]
+    jsonl_output = "\n".join(json.dumps(record) for record in records)
+
+    stripped = data_engineering2.strip_unwanted_text(jsonl_output)
+
+    assert_that(stripped.splitlines()).is_length(3)
+    assert_that(stripped).contains('"kept"').contains('"done"')
+    assert_that(stripped).does_not_contain("<~~x~~>")
+
+
+def test_iter_training_records_limits_context_window():
+    df = make_conversation_frame()
+
+    records = list(iter_training_records(df, max_context_messages=1))
+
+    assert_that([record["input_text"] for record in records]).is_equal_to(
+        ["Customer: hi Agent:", "Customer: thanks Agent:"]
+    )
+
+
+def test_build_dataset_sharded_removes_its_own_work_folder(tmp_path, monkeypatch):
+    df = make_synthetic_messages(200)
+    input_csv_path = tmp_path / "export.csv"
+    df.to_csv(input_csv_path, index=False)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path / "tmp"))
+    (tmp_path / "tmp").mkdir()
+
+    build_dataset_sharded(
+        input_csv_path, tmp_path / "sharded.jsonl", num_shards=2, max_workers=1
+    )
+
+    assert_that(list((tmp_path / "tmp").iterdir())).is_empty()
+
+
+def test_write_jsonl_streams_records_to_file(tmp_path):
+    df = make_synthetic_messages(1000)
+    output_path = tmp_path / "fine_tuning_dataset.jsonl"
+
+    count = write_jsonl(iter_training_records(df), output_path)
+
+    assert_that(output_path.read_text()).is_equal_to(convert_to_jsonl_joined(df) + "\n")
+    assert_that(output_path.read_text().count("\n")).is_equal_to(count)
+
+
+def test_build_dataset_sharded_matches_single_process(tmp_path):
+    df = make_synthetic_messages(5000, messages_per_conversation=7, broken_share=0.2)
+    # a few conversations with repeated senders and rows without a conversation
+    df.loc[df.index % 50 == 3, "sender"] = "Agent"
+    df.loc[df.index % 997 == 0, "conversation_id"] = np.nan
+    input_csv_path = tmp_path / "export.csv"
+    df.sample(frac=1, random_state=0).to_csv(input_csv_path, index=False)
+    sharded_path = tmp_path / "sharded.jsonl"
+    (tmp_path / "shards").mkdir()
+    (tmp_path / "shards" / "keep.txt").write_text("not ours")
+
+    count = build_dataset_sharded(
+        input_csv_path,
+        sharded_path,
+        num_shards=5,
+        max_workers=2,
+        work_folder=tmp_path / "shards",
+        chunksize=777,
+    )
+
+    serial_path = tmp_path / "serial.jsonl"
+    serial_count = write_jsonl(
+        iter_training_records(clean_for_training(pd.read_csv(input_csv_path))),
+        serial_path,
+    )
+    assert_that(count).is_equal_to(serial_count).is_greater_than(0)
+    assert_that(sharded_path.read_text()).is_equal_to(serial_path.read_text())
+    # the caller's work folder survives with only the shard files removed
+    assert_that(str(tmp_path / "shards")).is_directory()
+    assert_that(list((tmp_path / "shards").iterdir())).is_equal_to(
+        [tmp_path / "shards" / "keep.txt"]
+    )
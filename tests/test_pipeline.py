@@ -0,0 +1,213 @@
+"""Tests for `llm_experiments.cx_insights.pipeline`."""
+
+import json
+import sqlite3
+import zipfile
+
+import pandas as pd
+import pytest
+from assertpy import assert_that
+
+from benchmarks.cx_insights.benchmark_transform import make_synthetic_calls
+from llm_experiments.cx_insights.agent_ids import AgentIdRegistry
+from llm_experiments.cx_insights.pipeline import PipelineState, TalkdeskToCCAIPipeline
+
+
+class FakeIngestor:
+    def __init__(self):
+        self.successful_conversations = []
+
+    def ingest_concurrently(self, gcs_uris, max_workers=8):
+        self.successful_conversations.extend(gcs_uris)
+
+
+def write_transcript_zip(zip_file_path, df_transcripts):
+    with zipfile.ZipFile(zip_file_path, "w") as zip_ref:
+        zip_ref.writestr(
+            zip_file_path.stem + ".csv", df_transcripts.to_csv(index=False)
+        )
+
+
+@pytest.fixture
+def talkdesk_export(tmp_path):
+    df_calls = make_synthetic_calls(num_interactions=6, messages_per_interaction=3)
+    df_calls = df_calls.drop(columns="filename").sort_values(
+        "interaction_id", kind="stable"
+    )
+    df_calls["_merge"] = "both"
+    transcription_folder = tmp_path / "transcriptions"
+    transcription_folder.mkdir()
+    pd.DataFrame(
+        {"interaction_id": list(df_calls["interaction_id"].unique()) + ["int-missing"]}
+    ).to_csv(tmp_path / "ids.csv", index=False)
+    return df_calls, transcription_folder
+
+
+def make_pipeline(tmp_path, transcription_folder, bucket, ingestor):
+    return TalkdeskToCCAIPipeline(
+        "test-bucket",
+        "ccai",
+        transcription_folder=transcription_folder,
+        ids_path=tmp_path / "ids.csv",
+        work_folder=tmp_path / "outs",
+        bucket=bucket,
+        ingestor=ingestor,
+        chunksize=4,
+    )
+
+
+def test_pipeline_only_processes_new_zip_files(tmp_path, talkdesk_export, fake_bucket):
+    df_calls, transcription_folder = talkdesk_export
+    first_ids = df_calls["interaction_id"].unique()[:4]
+    write_transcript_zip(
+        transcription_folder / "day1.zip",
+        df_calls[df_calls["interaction_id"].isin(first_ids)],
+    )
+    bucket, ingestor = fake_bucket, FakeIngestor()
+
+    make_pipeline(tmp_path, transcription_folder, bucket, ingestor).run()
+    assert_that(bucket.objects).is_length(4)
+    assert_that(ingestor.successful_conversations).is_length(4)
+
+    write_transcript_zip(
+        transcription_folder / "day2.zip",
+        df_calls[~df_calls["interaction_id"].isin(first_ids)],
+    )
+    make_pipeline(tmp_path, transcription_folder, bucket, ingestor).run()
+
+    assert_that(bucket.upload_count).is_equal_to(6)
+    assert_that(ingestor.successful_conversations).is_length(6)
+    missing_ids = pd.read_csv(tmp_path / "outs" / "missing_ids.csv")
+    assert_that(missing_ids["interaction_id"].tolist()).is_equal_to(["int-missing"])
+
+
+def test_pipeline_resumes_after_crash(tmp_path, talkdesk_export, fake_bucket):
+    df_calls, transcription_folder = talkdesk_export
+    write_transcript_zip(transcription_folder / "day1.zip", df_calls)
+    bucket = fake_bucket
+    bucket.fail_names.add("ccai/conversation_int-00000002.json")
+    ingestor = FakeIngestor()
+
+    # first run stops after transform, and one upload fails
+    pipeline = make_pipeline(tmp_path, transcription_folder, bucket, ingestor)
+    pipeline.run(stages=("unzip", "join", "transform"))
+    pipeline.run(stages=("upload", "ingest"))
+    assert_that(ingestor.successful_conversations).is_length(5)
+
+    bucket.fail_names.clear()
+    make_pipeline(tmp_path, transcription_folder, bucket, ingestor).run()
+
+    assert_that(bucket.upload_count).is_equal_to(6)
+    assert_that(ingestor.successful_conversations).is_length(6)
+    assert_that(ingestor.successful_conversations[-1]).is_equal_to(
+        "gs://test-bucket/ccai/conversation_int-00000002.json"
+    )
+
+
+def test_pipeline_reprocesses_interactions_with_late_rows(
+    tmp_path, talkdesk_export, fake_bucket
+):
+    df_calls, transcription_folder = talkdesk_export
+    first_ids = df_calls["interaction_id"].unique()[:4]
+    df_first = df_calls[df_calls["interaction_id"].isin(first_ids)]
+    # the last message of the first interaction only arrives with the next export
+    late_row = df_first.index[2]
+    write_transcript_zip(transcription_folder / "day1.zip", df_first.drop(late_row))
+    ingestor = FakeIngestor()
+    make_pipeline(tmp_path, transcription_folder, fake_bucket, ingestor).run()
+
+    # the next export repeats both rows of the first interaction and the second one
+    # unchanged, and adds the late row and two new interactions
+    write_transcript_zip(
+        transcription_folder / "day2.zip",
+        pd.concat(
+            [
+                df_first[df_first["interaction_id"].isin(first_ids[:2])],
+                df_calls[~df_calls["interaction_id"].isin(first_ids)],
+            ]
+        ),
+    )
+    make_pipeline(tmp_path, transcription_folder, fake_bucket, ingestor).run()
+
+    conversation = json.loads(
+        fake_bucket.objects["ccai/conversation_int-00000000.json"]
+    )
+    assert_that(conversation["entries"]).is_length(3)
+    # the first interaction was uploaded and ingested again, the second one wasn't
+    assert_that(fake_bucket.upload_count).is_equal_to(7)
+    assert_that(ingestor.successful_conversations).is_length(7)
+    assert_that(ingestor.successful_conversations[4:]).contains(
+        "gs://test-bucket/ccai/conversation_int-00000000.json"
+    )
+
+
+def test_pipeline_uses_agent_id_registry(tmp_path, talkdesk_export, fake_bucket):
+    df_calls, transcription_folder = talkdesk_export
+    write_transcript_zip(transcription_folder / "day1.zip", df_calls)
+    pipeline = make_pipeline(
+        tmp_path, transcription_folder, fake_bucket, FakeIngestor()
+    )
+    pipeline.run()
+
+    registry = pipeline.transformer.agent_id_registry
+    assert_that(registry.db_path).is_equal_to(tmp_path / "outs" / "agent_ids.sqlite3")
+    conversation = json.loads(
+        fake_bucket.objects["ccai/conversation_int-00000000.json"]
+    )
+    first_rows = df_calls[df_calls["interaction_id"] == "int-00000000"]
+    agent_ids = {
+        entry["user_id"]
+        for entry in conversation["entries"]
+        if entry["role"] != "CUSTOMER"
+    }
+    agent_names = first_rows.loc[
+        first_rows["message_participant"] != "CUSTOMER", "message_agent_name"
+    ]
+    assert_that(agent_ids).is_equal_to({registry.get_id(name) for name in agent_names})
+    registry.close()
+    # every agent got an id that a later run reads back
+    reopened = AgentIdRegistry(tmp_path / "outs" / "agent_ids.sqlite3")
+    is_agent = df_calls["message_participant"] != "CUSTOMER"
+    assert_that(len(reopened)).is_equal_to(
+        df_calls.loc[is_agent, "message_agent_name"].nunique()
+    )
+    reopened.close()
+
+
+class FailingConnection:
+    """Wraps a sqlite3 connection, failing statements that mention `fail_on`."""
+
+    def __init__(self, connection, fail_on):
+        self.connection = connection
+        self.fail_on = fail_on
+
+    def __enter__(self):
+        return self.connection.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.connection.__exit__(*exc_info)
+
+    def execute(self, sql, *args):
+        return self.connection.execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        if self.fail_on in sql:
+            raise sqlite3.OperationalError("simulated crash")
+        return self.connection.executemany(sql, *args)
+
+
+def test_record_join_is_one_transaction(tmp_path):
+    state = PipelineState(tmp_path / "state.sqlite3")
+    state.record_join("calls_day1.parquet", ["int-1"], [], ["day1.zip"])
+    state.mark_completed("transform", ["int-1"])
+    state._connection = FailingConnection(state._connection, fail_on="zip_files")
+
+    with pytest.raises(sqlite3.OperationalError):
+        state.record_join(
+            "calls_day2.parquet", ["int-1", "int-2"], ["int-1"], ["day2.zip"]
+        )
+
+    assert_that(state.calls_files()).is_equal_to({"int-1": "calls_day1.parquet"})
+    assert_that(state.completed("join")).is_equal_to({"int-1"})
+    assert_that(state.completed("transform")).is_equal_to({"int-1"})
+    assert_that(state.processed_zip_files()).is_equal_to({"day1.zip"})
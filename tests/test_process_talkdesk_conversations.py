@@ -0,0 +1,129 @@
+"""Tests for `llm_experiments.cx_insights.process_talkdesk_conversations`."""
+
+import zipfile
+
+import pandas as pd
+import pytest
+from assertpy import assert_that
+
+from benchmarks.cx_insights.benchmark_ingest import write_synthetic_zips
+from llm_experiments.cx_insights.convert_to_ccai import ConversationDataTransformer
+from llm_experiments.cx_insights.process_talkdesk_conversations import (
+    join_with_ids,
+    list_zip_files,
+    main,
+    read_and_join_with_ids,
+    read_transcripts,
+    read_transcripts_parallel,
+)
+
+
+@pytest.fixture
+def zip_file_paths(tmp_path):
+    write_synthetic_zips(tmp_path, num_zips=3, files_per_zip=2, interactions_per_file=4)
+    return list_zip_files(tmp_path)
+
+
+def test_read_transcripts_parallel_matches_serial(zip_file_paths):
+    df_parallel = read_transcripts_parallel(zip_file_paths, max_workers=2)
+
+    pd.testing.assert_frame_equal(df_parallel, read_transcripts(zip_file_paths))
+    assert_that(df_parallel["filename"].unique().tolist()).is_length(6)
+
+
+def test_read_and_join_with_ids_filters_while_parsing(zip_file_paths):
+    df_all = read_transcripts(zip_file_paths)
+    wanted = df_all["interaction_id"].drop_duplicates().iloc[::3].tolist()
+    df_ids = pd.DataFrame({"interaction_id": wanted + ["int-not-in-transcripts"]})
+
+    df_calls, missing_ids = read_and_join_with_ids(
+        zip_file_paths, df_ids, max_workers=2, chunksize=5
+    )
+
+    pd.testing.assert_frame_equal(
+        df_calls.reset_index(drop=True),
+        df_all[df_all["interaction_id"].isin(wanted)].reset_index(drop=True),
+    )
+    assert_that(missing_ids["interaction_id"].tolist()).is_equal_to(
+        ["int-not-in-transcripts"]
+    )
+
+
+def test_read_and_join_with_ids_scrubs_message_text(tmp_path):
+    pd.DataFrame(
+        {
+            "interaction_id": ["int-1", "int-1", "int-2"],
+            "message_text": ["email me at jo@example.com", None, "call (555) 123-4567"],
+        }
+    ).to_csv(tmp_path / "transcripts.csv", index=False)
+    with zipfile.ZipFile(tmp_path / "transcripts.zip", "w") as zip_file:
+        zip_file.write(tmp_path / "transcripts.csv", "transcripts.csv")
+    df_ids = pd.DataFrame({"interaction_id": ["int-1", "int-2"]})
+
+    df_calls, _ = read_and_join_with_ids(
+        list_zip_files(tmp_path), df_ids, max_workers=1, scrub_text=True
+    )
+
+    # missing messages stay missing rather than becoming "nan"
+    assert_that(df_calls["message_text"].fillna("<missing>").tolist()).is_equal_to(
+        ["email me at {{EMAIL}}", "<missing>", "call[phone]"]
+    )
+
+
+def test_read_and_join_with_ids_drops_rows_on_only_one_side(tmp_path):
+    df_transcripts = pd.DataFrame(
+        {
+            "interaction_id": ["int-1", "int-1", "int-2", "int-3", "int-4"],
+            "message_text": ["hi", "bye", "only transcript", "only export", "hello"],
+            "_merge": ["both", "both", "left_only", "right_only", "both"],
+        }
+    )
+    df_transcripts.to_csv(tmp_path / "transcripts.csv", index=False)
+    with zipfile.ZipFile(tmp_path / "transcripts.zip", "w") as zip_file:
+        zip_file.write(tmp_path / "transcripts.csv", "transcripts.csv")
+    df_ids = pd.DataFrame({"interaction_id": ["int-1", "int-2", "int-3"]})
+
+    df_calls, missing_ids = read_and_join_with_ids(
+        list_zip_files(tmp_path), df_ids, max_workers=1
+    )
+
+    assert_that(df_calls["message_text"].tolist()).is_equal_to(["hi", "bye"])
+    assert_that(missing_ids["interaction_id"].tolist()).is_equal_to(["int-2", "int-3"])
+    # the same rows as the legacy join on `_merge`, restricted to the wanted ids
+    df_legacy, legacy_missing_ids = join_with_ids(df_transcripts, df_ids)
+    assert_that(df_calls["message_text"].tolist()).is_equal_to(
+        df_legacy.loc[
+            df_legacy["interaction_id"].isin(df_ids["interaction_id"]), "message_text"
+        ].tolist()
+    )
+    pd.testing.assert_frame_equal(missing_ids, legacy_missing_ids)
+
+
+def test_main_writes_calls_that_convert_in_chunks(tmp_path):
+    zip_files_dir = tmp_path / "zips"
+    zip_files_dir.mkdir()
+    # the synthetic transcripts interleave the rows of their interactions
+    write_synthetic_zips(
+        zip_files_dir, num_zips=1, files_per_zip=1, interactions_per_file=6
+    )
+    df_all = read_transcripts(list_zip_files(zip_files_dir))
+    ids_path = tmp_path / "ids.csv"
+    df_all[["interaction_id"]].drop_duplicates().to_csv(ids_path, index=False)
+    output_folder = tmp_path / "output"
+    output_folder.mkdir()
+
+    main(ids_path, zip_files_dir, output_folder, export_csv=True)
+
+    for input_path in ["all_calls.csv", "all_calls.parquet"]:
+        transformer = ConversationDataTransformer(
+            output_folder / input_path,
+            tmp_path / "conversations",
+            "test-bucket",
+            "ccai",
+            bucket=object(),
+        )
+        chunked = dict(transformer.iter_conversations(vectorized=True, chunksize=3))
+        assert_that(chunked).is_equal_to(
+            dict(transformer.iter_conversations(vectorized=True))
+        )
+        assert_that(chunked).is_length(df_all["interaction_id"].nunique())
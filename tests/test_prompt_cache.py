@@ -0,0 +1,149 @@
+"""Tests for `llm_experiments.prompt_cache`."""
+
+import pytest
+from assertpy import assert_that
+
+from llm_experiments import prompt_cache
+from llm_experiments.prompt_cache import PromptCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def make_cache(tmp_path, clock, **kwargs):
+    return PromptCache(tmp_path / "prompt_cache.sqlite3", clock=clock, **kwargs)
+
+
+def counting_completion(calls):
+    def compute():
+        calls.append(1)
+        return f"completion {len(calls)}"
+
+    return compute
+
+
+def test_prompt_cache_hits_memory_then_disk(tmp_path, clock):
+    calls = []
+    cache = make_cache(tmp_path, clock)
+    parameters = {"temperature": 0, "max_tokens": 10}
+
+    first = cache.get_or_compute(
+        "model", parameters, "prompt", counting_completion(calls)
+    )
+    second = cache.get_or_compute(
+        "model", parameters, "prompt", counting_completion(calls)
+    )
+    # a new process only has the on-disk tier
+    reopened = make_cache(tmp_path, clock)
+    third = reopened.get_or_compute(
+        "model", parameters, "prompt", counting_completion(calls)
+    )
+    # any change to the request is a different key
+    cache.get_or_compute(
+        "model",
+        {"temperature": 0, "max_tokens": 20},
+        "prompt",
+        counting_completion(calls),
+    )
+
+    assert_that([first, second, third]).is_equal_to(["completion 1"] * 3)
+    assert_that(calls).is_length(2)
+    assert_that(cache.stats()).contains_entry({"memory_hits": 1}, {"misses": 2})
+    assert_that(reopened.stats()).contains_entry({"disk_hits": 1}, {"misses": 0})
+
+
+def test_prompt_cache_expires_and_evicts(tmp_path, clock):
+    cache = make_cache(tmp_path, clock, ttl_seconds=100, max_entries=2, memory_size=1)
+    for prompt in ["a", "b"]:
+        cache.put("model", {}, prompt, prompt.upper())
+        clock.now += 10
+    cache.get("model", {}, "a")  # "b" is now least recently used
+    cache.put("model", {}, "c", "C")
+
+    assert_that(len(cache)).is_equal_to(2)
+    assert_that(cache.get("model", {}, "b")).is_none()
+    assert_that(cache.get("model", {}, "a")).is_equal_to("A")
+
+    clock.now += 200
+    assert_that(cache.get("model", {}, "a")).is_none()
+    assert_that(len(cache)).is_equal_to(1)
+
+
+def test_prompt_cache_memory_hits_count_as_use_on_disk(tmp_path, clock):
+    cache = make_cache(tmp_path, clock, max_entries=2, memory_size=10)
+    for prompt in ["a", "b"]:
+        cache.put("model", {}, prompt, prompt.upper())
+        clock.now += 10
+    cache.get("model", {}, "a")  # served from memory
+    cache.put("model", {}, "c", "C")
+    cache.close()
+
+    reopened = make_cache(tmp_path, clock)
+    assert_that(len(reopened)).is_equal_to(2)
+    assert_that(reopened.get("model", {}, "b")).is_none()
+    assert_that(reopened.get("model", {}, "a")).is_equal_to("A")
+    # least recently used entries are found through an index rather than a table scan
+    plan = reopened._connection.execute(
+        "EXPLAIN QUERY PLAN SELECT key FROM prompt_cache ORDER BY accessed_at LIMIT 1"
+    ).fetchall()
+    assert_that(str(plan)).contains("prompt_cache_accessed_at")
+
+
+def test_prompt_cache_bypasses_nonzero_temperature_and_when_disabled(tmp_path, clock):
+    calls = []
+    cache = make_cache(tmp_path, clock)
+    for _ in range(2):
+        cache.get_or_compute(
+            "model", {"temperature": 0.7}, "prompt", counting_completion(calls)
+        )
+    disabled = make_cache(tmp_path, clock, enabled=False)
+    for _ in range(2):
+        disabled.get_or_compute(
+            "model", {"temperature": 0}, "prompt", counting_completion(calls)
+        )
+    opted_in = make_cache(tmp_path, clock, cache_nonzero_temperature=True)
+    for _ in range(2):
+        opted_in.get_or_compute(
+            "model", {"temperature": 0.7}, "prompt", counting_completion(calls)
+        )
+
+    assert_that(calls).is_length(5)
+    assert_that(cache.bypassed).is_equal_to(2)
+    assert_that(disabled.bypassed).is_equal_to(2)
+    assert_that(len(cache)).is_equal_to(1)
+
+
+def test_default_prompt_cache_opts_in_to_nonzero_temperature(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        prompt_cache, "DEFAULT_CACHE_PATH", tmp_path / "prompt_cache.sqlite3"
+    )
+    monkeypatch.setattr(prompt_cache, "_default_caches", {})
+    monkeypatch.delenv(prompt_cache.CACHE_ENV_VAR, raising=False)
+    calls = []
+    parameters = {"temperature": 0.3}
+
+    sampled = prompt_cache.default_prompt_cache(cache_nonzero_temperature=True)
+    for _ in range(2):
+        sampled.get_or_compute(
+            "model", parameters, "prompt", counting_completion(calls)
+        )
+    default = prompt_cache.default_prompt_cache()
+    default.get_or_compute("model", parameters, "prompt", counting_completion(calls))
+
+    assert_that(
+        prompt_cache.default_prompt_cache(cache_nonzero_temperature=True)
+    ).is_same_as(sampled)
+    assert_that(default).is_not_same_as(sampled)
+    assert_that(calls).is_length(2)
+    assert_that(sampled.hits).is_equal_to(1)
+    assert_that(default.bypassed).is_equal_to(1)
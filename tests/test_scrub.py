@@ -0,0 +1,114 @@
+"""Tests for `llm_experiments.scrub`."""
+
+import warnings
+
+import pandas as pd
+import pytest
+from assertpy import assert_that
+
+from benchmarks.benchmark_scrub import make_messages, scrub_df_applymap
+from llm_experiments.scrub import ScrubCache, TextScrubber, scrub_csv, scrub_df
+
+EDGE_CASES = [
+    "",
+    "no pii here",
+    "mail me: jo.bloggs@example.co.uk or call +44 20 7946 0958",
+    "write to bob at example dot com",
+    "username: jo password: hunter",
+    "login jo pw hunter",
+    "see www.example.com or http://example.com/path",
+    "ping @someone on twitter",
+    "card 4111 1111 1111 1111, ssn 078-05-1120",
+    "GIR 0AA and EC1A 1BB and M1 1AE",
+    "call (555) 123-4567 now",
+    "Lorem Ipsum at the top",
+    "SW1A 1AAa@b.com+44 1234567890-x",
+]
+
+
+def scrub_legacy(values):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        return scrub_df_applymap(pd.DataFrame({"content": values}))["content"].tolist()
+
+
+def test_clean_text_matches_original_scrub():
+    assert_that(TextScrubber().clean_values(EDGE_CASES)).is_equal_to(
+        scrub_legacy(EDGE_CASES)
+    )
+
+
+def test_clean_text_skips_text_without_candidates():
+    text_scrubber = TextScrubber()
+
+    cleaned = text_scrubber.clean_values(["no pii here", "call (555) 123-4567"])
+
+    # the phone pattern takes the space before the number too
+    assert_that(cleaned).is_equal_to(["no pii here", "call[phone]"])
+    assert_that(text_scrubber.skipped).is_equal_to(1)
+    assert_that(text_scrubber.cleaned).is_equal_to(1)
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_scrub_df_only_scrubs_text_columns(max_workers):
+    df = make_messages(300)
+
+    scrubbed = scrub_df(df, columns=["content"], max_workers=max_workers, chunksize=50)
+
+    pd.testing.assert_frame_equal(scrubbed[["id", "sender"]], df[["id", "sender"]])
+    assert_that(scrubbed["content"].tolist()).is_equal_to(
+        scrub_legacy(df["content"].tolist())
+    )
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".csv.gz"])
+def test_scrub_csv_streams_chunks_matching_scrub_df(tmp_path, suffix):
+    df = make_messages(250)
+    input_path = tmp_path / f"messages{suffix}"
+    output_path = tmp_path / f"scrubbed{suffix}"
+    df.to_csv(input_path, index=False)
+
+    rows = scrub_csv(input_path, output_path, columns=["content"], rows_per_chunk=60)
+
+    assert_that(rows).is_equal_to(250)
+    if suffix.endswith(".gz"):
+        assert_that(output_path.read_bytes()[:2]).is_equal_to(b"\x1f\x8b")
+    pd.testing.assert_frame_equal(
+        pd.read_csv(output_path), scrub_df(df, columns=["content"])
+    )
+
+
+class CountingScrubber:
+    """Stand-in for `scrubadub.Scrubber` that counts the texts it cleans."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def clean(self, text):
+        self.calls += 1
+        return text.replace("secret", "{{SECRET}}")
+
+
+def test_text_scrubber_scrubs_repeated_texts_once_across_runs(tmp_path):
+    texts = ["ref 1 secret", "ref 2", "hello", "ref 1 secret", "ref 2"] * 20
+    expected = ["ref 1 {{SECRET}}", "ref 2", "hello", "ref 1 {{SECRET}}", "ref 2"] * 20
+
+    first_run = TextScrubber(
+        CountingScrubber(), cache=ScrubCache(tmp_path / "scrub_cache.sqlite3")
+    )
+    assert_that(first_run.clean_values(texts[:50])).is_equal_to(expected[:50])
+    assert_that(first_run.clean_values(texts[50:])).is_equal_to(expected[50:])
+    assert_that(first_run.scrubber.calls).is_equal_to(2)
+    assert_that(first_run.skipped).is_equal_to(20)
+    assert_that(first_run.hit_rate).is_equal_to(1 - 2 / 80)
+    assert_that(first_run.cache.stats()).is_equal_to(
+        {"memory_hits": 2, "disk_hits": 0, "misses": 2, "hit_rate": 0.5}
+    )
+    first_run.cache.close()
+
+    second_run = TextScrubber(
+        CountingScrubber(), cache=ScrubCache(tmp_path / "scrub_cache.sqlite3")
+    )
+    assert_that(second_run.clean_values(texts)).is_equal_to(expected)
+    assert_that(second_run.scrubber.calls).is_equal_to(0)
+    assert_that(second_run.cache.disk_hits).is_equal_to(2)
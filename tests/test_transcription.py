@@ -0,0 +1,178 @@
+"""Tests for `llm_experiments.transcription`, with fake speech and storage clients."""
+
+import io
+import threading
+import time
+import wave
+
+import pytest
+from assertpy import assert_that
+
+from llm_experiments.transcription import TranscriptionRunner, transcript_path
+
+
+def write_stereo_wav(path, seconds, frame_rate=16000):
+    with wave.open(str(path), "wb") as wav_file:
+        wav_file.setnchannels(2)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(frame_rate)
+        wav_file.writeframes(b"\x01\x00\x02\x00" * int(seconds * frame_rate))
+
+
+def wav_format(data):
+    """(channels, sample width, frame rate) of WAV bytes."""
+    with wave.open(io.BytesIO(data), "rb") as wav_file:
+        return wav_file.getnchannels(), wav_file.getsampwidth(), wav_file.getframerate()
+
+
+class FakeStorageClient:
+    """Stand-in for `storage.Client` whose buckets are all the conftest `FakeBucket`."""
+
+    def __init__(self, bucket):
+        self._bucket = bucket
+
+    def bucket(self, name):
+        return self._bucket
+
+
+class FakeAlternative:
+    def __init__(self, transcript):
+        self.transcript = transcript
+        self.confidence = 0.9
+
+
+class FakeResult:
+    def __init__(self, transcript):
+        self.alternatives = [FakeAlternative(transcript)]
+
+
+class FakeResponse:
+    def __init__(self, transcript):
+        self.results = [FakeResult(transcript)]
+
+
+class FakeOperation:
+    """Done `duration` seconds of `client.clock` after starting, never if it's None."""
+
+    def __init__(self, client, uri, duration):
+        self.client = client
+        self.uri = uri
+        self.duration = duration
+        self.started = client.clock()
+
+    def done(self):
+        if self.duration is None or self.client.clock() < self.started + self.duration:
+            return False
+        self.client.running.discard(self.uri)
+        return True
+
+    def result(self):
+        return FakeResponse(f"transcript of {self.uri.rsplit('/', 1)[1]}")
+
+
+class FakeSpeechClient:
+    """Stand-in for `speech.SpeechClient`; operations last `duration_for(uri)`s."""
+
+    def __init__(self, duration_for, clock=time.monotonic):
+        self.duration_for = duration_for
+        self.clock = clock
+        self.running = set()
+        self.max_running = 0
+
+    def long_running_recognize(self, config, audio):
+        self.running.add(audio.uri)
+        self.max_running = max(self.max_running, len(self.running))
+        return FakeOperation(self, audio.uri, self.duration_for(audio.uri))
+
+
+def make_runner(tmp_path, speech_client, storage_client, **kwargs):
+    return TranscriptionRunner(
+        "gs://bucket/interviews",
+        tmp_path / "outs",
+        speech_client=speech_client,
+        storage_client=storage_client,
+        convert_workers=2,
+        upload_workers=4,
+        **kwargs,
+    )
+
+
+@pytest.fixture
+def audio_paths(tmp_path):
+    paths = []
+    for i in range(4):
+        path = tmp_path / f"interview_{i}.wav"
+        write_stereo_wav(path, seconds=0.1 * (i + 1))
+        paths.append(path)
+    return paths
+
+
+def test_runner_transcribes_every_file_concurrently(tmp_path, audio_paths, fake_bucket):
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    speech_client = FakeSpeechClient(
+        duration_for=lambda uri: 1.0, clock=lambda: clock[0]
+    )
+    # every upload waits for all the others, so they can only finish if run at once
+    fake_bucket.upload_barrier = threading.Barrier(len(audio_paths))
+    runner = make_runner(
+        tmp_path,
+        speech_client,
+        FakeStorageClient(fake_bucket),
+        frame_rate=8000,
+        poll_interval=0.5,
+        sleep=sleep,
+        clock=lambda: clock[0],
+    )
+
+    transcripts = runner.run(audio_paths)
+
+    expected = {
+        path: f"transcript of {path.stem}_isolated_channel.wav" for path in audio_paths
+    }
+    assert_that(transcripts).is_equal_to(expected)
+    for path, transcript in expected.items():
+        assert_that(transcript_path(path, tmp_path / "outs").read_text()).is_equal_to(
+            transcript
+        )
+    # mono, 16-bit and resampled
+    assert_that(
+        {wav_format(data) for data in fake_bucket.objects.values()}
+    ).is_equal_to({(1, 2, 8000)})
+    assert_that(fake_bucket.max_in_flight).is_equal_to(len(audio_paths))
+    # every operation ran at once, so the files took as long as one of them
+    assert_that(speech_client.max_running).is_equal_to(len(audio_paths))
+    assert_that(clock[0]).is_equal_to(1.0)
+    assert_that(runner.failed).is_empty()
+
+
+def test_runner_isolates_failures_and_times_out(tmp_path, audio_paths, fake_bucket):
+    broken_path = tmp_path / "broken.wav"
+    broken_path.write_bytes(b"not audio")
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += 1
+
+    speech_client = FakeSpeechClient(
+        duration_for=lambda uri: None if "interview_3" in uri else 3,
+        clock=lambda: clock[0],
+    )
+    runner = make_runner(
+        tmp_path,
+        speech_client,
+        FakeStorageClient(fake_bucket),
+        poll_interval=0,
+        timeout=100,
+        sleep=sleep,
+        clock=lambda: clock[0],
+    )
+
+    transcripts = runner.run(audio_paths + [broken_path])
+
+    assert_that(sorted(transcripts)).is_equal_to(audio_paths[:3])
+    assert_that(runner.failed).contains_only(broken_path, audio_paths[3])
+    assert_that(runner.failed[audio_paths[3]]).is_instance_of(TimeoutError)